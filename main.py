@@ -1,8 +1,12 @@
 # main.py
 # Owner TMCooper
 
+import time
+STARTUP_ORIGIN = time.perf_counter()
+
 import sys
 import os
+import threading
 
 project_root = os.path.dirname(os.path.abspath(__file__))
 
@@ -13,45 +17,95 @@ if project_root not in sys.path:
 
 import keyboard
 from dotenv import load_dotenv
-import google.generativeai as genai
 
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtWidgets import QApplication
 
-from src.command_bar import CommandBar
+from src.config import env_flag, env_float, env_str
+from src.startup_timing import StartupTimer
+
+# Le backend (httpx ou google.generativeai) et src.command_bar (PIL, markdown, Pygments)
+# sont chargés en arrière-plan une fois le raccourci enregistré, ou au premier appui.
+backend = None
+CommandBar = None
+modules_lock = threading.Lock()
+startup_timer = StartupTimer(STARTUP_ORIGIN)
+
+HOTKEY_READY = "raccourci enregistré"
+MODEL_NAME = 'gemini-1.5-flash-latest'
 
 
 class HotkeyEmitter(QObject):
     show_command_bar_signal = Signal()
+    prewarm_signal = Signal()
 
 command_bar_instance = None
-chat_session = None
 
-def show_command_bar():
-    global command_bar_instance, chat_session
+def load_heavy_modules():
+    global backend, CommandBar
+    with modules_lock:
+        if CommandBar is not None:
+            return
+        with startup_timer.measure("src.model_backend"):
+            from src.model_backend import create_backend
+            model_backend = create_backend(MODEL_NAME, os.environ.get("GEMINI_API_KEY"))
+        with startup_timer.measure("src.command_bar"):
+            from src.command_bar import CommandBar as command_bar_class
+        backend, CommandBar = model_backend, command_bar_class
+        startup_timer.mark("modules lourds chargés")
+
+def preload_heavy_modules(emitter):
+    load_heavy_modules()
+    if env_flag("AIBAR_PREWARM"):
+        # La création des widgets doit se faire dans le thread de l'interface
+        emitter.prewarm_signal.emit()
+        prewarm_connection()
+    budget_ms = env_float("AIBAR_STARTUP_BUDGET_MS", 1000)
+    if env_flag("AIBAR_STARTUP_REPORT") or startup_timer.is_over_budget(HOTKEY_READY, budget_ms):
+        print(startup_timer.report(HOTKEY_READY, budget_ms))
+
+def prewarm_connection():
+    # Ouvre la connexion à l'API et charge les lexers Pygments avant le premier appui
+    backend.warm_up()
+    from src.highlight_cache import highlight_code
+    highlight_code("print('AIBar')", "python")
+    startup_timer.mark("connexion pré-chauffée")
+
+def ensure_command_bar():
+    global command_bar_instance
     if not command_bar_instance:
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        chat_session = model.start_chat(history=[])
-        command_bar_instance = CommandBar(chat_session)
-    command_bar_instance.show_and_focus()
+        load_heavy_modules()
+        command_bar_instance = CommandBar(backend)
+        startup_timer.mark("première barre créée")
+    return command_bar_instance
+
+def prewarm_command_bar():
+    ensure_command_bar().prewarm()
+    startup_timer.mark("barre pré-chauffée")
+
+def show_command_bar():
+    ensure_command_bar().show_and_focus()
 
 def main():
     load_dotenv()
     api_key = os.environ.get("GEMINI_API_KEY")
-    if not api_key:
+    # Le backend local de test n'a pas besoin de clé
+    if not api_key and env_str("AIBAR_BACKEND", "http").lower() != "local":
         print("Erreur: Clé API 'GEMINI_API_KEY' manquante dans le fichier .env")
         return
-    genai.configure(api_key=api_key)
-    
+
     app = QApplication(sys.argv)
-    
+
     emitter = HotkeyEmitter()
     emitter.show_command_bar_signal.connect(show_command_bar)
-    
+    emitter.prewarm_signal.connect(prewarm_command_bar)
+
     print("Programme en arrière-plan. Raccourci : ctrl+shift+a")
     keyboard.add_hotkey('ctrl+shift+a', lambda: emitter.show_command_bar_signal.emit())
-    
+    startup_timer.mark(HOTKEY_READY)
+    threading.Thread(target=preload_heavy_modules, args=(emitter,), daemon=True).start()
+
     sys.exit(app.exec())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,92 @@
+# src/attachment_store.py
+# Owner TMCooper
+
+import os
+import hashlib
+
+# Distance de Hamming maximale entre deux dHash pour considérer deux images semblables
+# (simple présélection : deux captures d'un même terminal ont souvent le même dHash)
+IMAGE_HASH_TOLERANCE = 4
+# Écart maximal de luminosité moyenne (0-255), le dHash seul ne distingue pas deux aplats
+IMAGE_LUMA_TOLERANCE = 8
+
+def dhash_from_rows(width, height, rows):
+    """ Empreinte perceptuelle : taille, dHash 64 bits sur une grille 9x8 et luminosité moyenne. """
+    value = 0
+    for row in rows:
+        for x in range(8):
+            value = (value << 1) | (row[x] > row[x + 1])
+    luma = sum(sum(row[:9]) for row in rows) // (9 * len(rows))
+    return (width, height, value, luma)
+
+def same_image(a, b):
+    return (a[:2] == b[:2] and hamming_distance(a[2], b[2]) <= IMAGE_HASH_TOLERANCE
+            and abs(a[3] - b[3]) <= IMAGE_LUMA_TOLERANCE)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def content_hash(data):
+    if isinstance(data, dict):
+        return hashlib.sha256(data['data']).hexdigest()
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class AttachmentStore:
+    """ Pièces jointes de la session, adressées par leur contenu : un fichier ou une capture
+    déjà vus ne sont ni relus ni ré-encodés, et une seule copie encodée est gardée.
+    Une image n'est reprise que si ses pixels sont identiques, l'empreinte perceptuelle sert à présélectionner. """
+    def __init__(self):
+        self.entries = {}
+        self.path_index = {}
+        self.image_hashes = {}
+
+    def lookup_path(self, path):
+        try:
+            key = self.path_index.get(file_fingerprint(path))
+        except OSError:
+            return None
+        return self.entries.get(key)
+
+    def lookup_image(self, image_hash, pixel_digest):
+        """ Image déjà jointe aux pixels identiques : l'empreinte perceptuelle présélectionne,
+        l'empreinte exacte des pixels confirme. """
+        for key, (known_hash, known_digest) in self.image_hashes.items():
+            if same_image(known_hash, image_hash) and known_digest == pixel_digest:
+                return self.entries[key]
+        return None
+
+    def add(self, file_info, data, path=None, image_hash=None, pixel_digest=None):
+        key = content_hash(data)
+        entry = self.entries.get(key)
+        if entry is None and image_hash is not None and pixel_digest is not None:
+            # Même image ré-encodée autrement (capture collée deux fois, PNG et JPEG d'une même image...)
+            entry = self.lookup_image(image_hash, pixel_digest)
+        if entry is None:
+            entry = {'key': key, 'type': file_info['type'], 'data': data, 'name': file_info['name'], 'sent_turn': None}
+            self.entries[key] = entry
+            if image_hash is not None and pixel_digest is not None:
+                self.image_hashes[key] = (image_hash, pixel_digest)
+        if path is not None:
+            try:
+                self.path_index[file_fingerprint(path)] = entry['key']
+            except OSError:
+                pass
+        return entry
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def forget_turn(self, turn_index):
+        for entry in self.entries.values():
+            if entry['sent_turn'] == turn_index:
+                entry['sent_turn'] = None
+
+    def clear(self):
+        self.entries.clear()
+        self.path_index.clear()
+        self.image_hashes.clear()
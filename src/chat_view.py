@@ -0,0 +1,648 @@
+# src/chat_view.py
+# Owner TMCooper
+
+import re
+import math
+import itertools
+from collections import OrderedDict
+
+import markdown
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex, QPoint, QPointF, QRect, QRectF, QSize, QTimer, QEvent, QUrl, Signal
+from PySide6.QtGui import (QColor, QFont, QFontMetrics, QPainter, QPalette, QTextDocument, QAbstractTextDocumentLayout,
+                           QDesktopServices)
+from PySide6.QtWidgets import QApplication, QListView, QStyledItemDelegate, QAbstractItemView, QMenu
+
+from src.highlight_cache import highlight_code
+
+MessageRole = Qt.ItemDataRole.UserRole + 1
+
+BUBBLE_COLORS = {'user': QColor("#404eed"), 'ai': QColor("#45475a")}
+CODE_BACKGROUND = QColor("#1e1f22")
+COPY_BUTTON_BACKGROUND = QColor("#313338")
+TEXT_COLOR = QColor("#dbdee1")
+LABEL_COLOR = QColor("#8a9099")
+BUBBLE_PADDING = 12
+CODE_PADDING = 8
+CODE_HEADER_HEIGHT = 28
+COPY_BUTTON_SIZE = QSize(64, 22)
+# Au-delà de cette taille (HTML ou markdown), le document est préparé par le RenderWorker
+ASYNC_RENDER_MIN_CHARS = 4000
+PLACEHOLDER_TEXT = "Mise en forme…"
+# Gros blocs de code : découpés en morceaux d'au plus CODE_CHUNK_LINES lignes colorés à la demande, repliés
+# sur leurs collapse_lines premières lignes. Déplié, le bloc s'étend sur plusieurs lignes du fil
+# (QListView limite la hauteur d'une ligne à 32767 px)
+CODE_CHUNK_LINES = 60
+CHUNKS_PER_ROW = 8
+CODE_FOOTER_HEIGHT = 26
+# Interligne du <pre> généré par Pygments (line-height: 125%)
+CODE_LINE_HEIGHT_RATIO = 1.25
+DOCUMENT_MARGIN = 4
+
+_message_ids = itertools.count()
+# Un seul convertisseur, réinitialisé à chaque message : le construire coûte plus que la conversion
+_markdown = markdown.Markdown()
+
+class ChatMessage:
+    """ Un message du fil : bulle de texte (HTML ou markdown) ou bloc de code coloré. """
+    def __init__(self, role, kind='text', text="", is_markdown=False, raw_code="", lang="", code_html=""):
+        self.id = next(_message_ids)
+        self.role = role
+        self.kind = kind
+        self.text = text
+        self.is_markdown = is_markdown
+        self.raw_code = raw_code
+        self.lang = lang
+        self.code_html = code_html
+        # Document vivant tant que la réponse est en cours de streaming (jamais évincé)
+        self.live_document = None
+        self.row = None
+        self.version = 0
+        self.height_cache = None
+        self.copied = False
+        self.line_count = raw_code.count("\n") + 1 if kind == 'code' else 0
+        self.line_starts = None
+        self.expanded = False
+        # Hauteur de chaque morceau déjà mis en page (sans les marges du document)
+        self.chunk_heights = {}
+        # Suite d'un bloc déplié : le message du bloc et son premier morceau
+        self.block = None
+        self.first_chunk = 0
+        self.parts = []
+
+    def to_html(self):
+        if self.kind == 'code':
+            return self.code_html
+        return _markdown.reset().convert(self.text) if self.is_markdown else self.text
+
+    def code_lines(self, start, end):
+        """ Lignes [start, end) du code brut, sans redécouper tout le bloc à chaque morceau. """
+        if self.line_starts is None:
+            self.line_starts = [0] + [match.end() for match in re.finditer("\n", self.raw_code)]
+        stop = self.line_starts[end] - 1 if end < len(self.line_starts) else len(self.raw_code)
+        return self.raw_code[self.line_starts[start]:stop]
+
+
+class ChatModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.messages = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == MessageRole:
+            return self.messages[index.row()]
+        return None
+
+    def append_message(self, message):
+        row = len(self.messages)
+        message.row = row
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append(message)
+        self.endInsertRows()
+        return message
+
+    def prepend_messages(self, messages):
+        # Messages plus anciens relus depuis l'historique enregistré, insérés en tête du fil
+        self.insert_messages(0, messages)
+
+    def insert_messages(self, row, messages):
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), row, row + len(messages) - 1)
+        self.messages[row:row] = messages
+        for position in range(row, len(self.messages)):
+            self.messages[position].row = position
+        self.endInsertRows()
+
+    def remove_messages(self, row, count):
+        if count <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row + count - 1)
+        for message in self.messages[row:row + count]:
+            message.row = None
+        del self.messages[row:row + count]
+        for position in range(row, len(self.messages)):
+            self.messages[position].row = position
+        self.endRemoveRows()
+
+    def message_changed(self, message):
+        message.version += 1
+        message.height_cache = None
+        self.refresh(message)
+
+    def contains(self, message):
+        return message.row is not None and message.row < len(self.messages) and self.messages[message.row] is message
+
+    def refresh(self, message):
+        if self.contains(message):
+            index = self.index(message.row)
+            self.dataChanged.emit(index, index)
+
+    def clear(self):
+        self.beginResetModel()
+        self.messages.clear()
+        self.endResetModel()
+
+
+class ChatDelegate(QStyledItemDelegate):
+    """ Dessine les messages à partir de QTextDocument mis en cache (LRU) : seules les
+    lignes visibles sont rendues, les hauteurs sont gardées à part pour la mise en page.
+    Les gros messages et les blocs de code à colorer sont préparés par le RenderWorker, les blocs
+    de plus de collapse_lines lignes morceau par morceau, quand ils arrivent à l'écran. """
+    # Document préparé hors du thread de l'interface et installé : (message, durée dans le worker en ms)
+    document_ready = Signal(object, float)
+    def __init__(self, max_cached_documents=64, renderer=None, collapse_lines=150, parent=None):
+        super().__init__(parent)
+        self.max_cached_documents = max_cached_documents
+        self.documents = OrderedDict()
+        self.renderer = renderer
+        # Un bloc replié montre autant de lignes que le seuil qui le replie : le seuil est découpé en morceaux
+        # égaux (au plus CODE_CHUNK_LINES lignes, au plus une ligne du fil), arrondi à un multiple de leur taille
+        collapse_lines = min(max(collapse_lines, CODE_CHUNK_LINES), CHUNKS_PER_ROW * CODE_CHUNK_LINES)
+        self.preview_chunks = math.ceil(collapse_lines / CODE_CHUNK_LINES)
+        self.chunk_lines = math.ceil(collapse_lines / self.preview_chunks)
+        self.collapse_lines = self.chunk_lines * self.preview_chunks
+        self.rendering = set()
+        self.font = QFont()
+        self.font.setPixelSize(14)
+        self.label_font = QFont()
+        self.label_font.setPixelSize(12)
+        self.line_height = QFontMetrics(self.font).lineSpacing()
+        # Hauteur d'une ligne de code, corrigée par la mesure du premier morceau mis en page
+        self.code_line_pitch = self.line_height * CODE_LINE_HEIGHT_RATIO
+
+    def bubble_rect(self, message, rect):
+        ratio = 0.85 if message.kind == 'code' else 0.80
+        width = int(rect.width() * ratio)
+        x = rect.right() - width if message.role == 'user' else rect.left()
+        return QRect(x, rect.top(), width, rect.height())
+
+    def copy_button_rect(self, message, rect):
+        bubble = self.bubble_rect(message, rect)
+        return QRect(bubble.right() - COPY_BUTTON_SIZE.width() - CODE_PADDING,
+                     bubble.top() + (CODE_HEADER_HEIGHT - COPY_BUTTON_SIZE.height()) // 2 + 2,
+                     COPY_BUTTON_SIZE.width(), COPY_BUTTON_SIZE.height())
+
+    def toggle_rect(self, message, rect):
+        bubble = self.bubble_rect(message, rect)
+        return QRect(bubble.left() + CODE_PADDING, bubble.bottom() - CODE_PADDING - CODE_FOOTER_HEIGHT + 1,
+                     bubble.width() - 2 * CODE_PADDING, CODE_FOOTER_HEIGHT)
+
+    def text_width(self, message, bubble_width):
+        padding = CODE_PADDING if message.kind == 'code' else BUBBLE_PADDING
+        return max(50, bubble_width - 2 * padding)
+
+    def document_for(self, message, text_width):
+        document = message.live_document
+        if document is None:
+            entry = self.documents.get(message.id)
+            if entry is not None and entry[1] == message.version:
+                self.documents.move_to_end(message.id)
+                document = entry[0]
+            elif self.needs_async_render(message):
+                # Affiché en attente, le document arrive par document_ready
+                self.request_render(message, text_width)
+                return None
+            else:
+                document = self.create_document()
+                document.setHtml(message.to_html())
+                self.store(message, document, message.version)
+        # Le code n'est jamais replié (<pre>) : changer sa largeur referait toute la mise en page pour rien
+        if message.kind != 'code' and document.textWidth() != text_width:
+            document.setTextWidth(text_width)
+        return document
+
+    def store(self, message, document, version, key=None):
+        self.documents[message.id if key is None else key] = (document, version)
+        while len(self.documents) > self.max_cached_documents:
+            self.documents.popitem(last=False)
+
+    def needs_async_render(self, message):
+        if self.renderer is None:
+            return False
+        if message.kind == 'code':
+            return not message.code_html or len(message.code_html) >= ASYNC_RENDER_MIN_CHARS
+        return len(message.text) >= ASYNC_RENDER_MIN_CHARS
+
+    def is_chunked(self, message):
+        return message.block is not None or (message.kind == 'code' and message.line_count > self.collapse_lines)
+
+    def chunk_count(self, block):
+        return math.ceil(block.line_count / self.chunk_lines)
+
+    def row_chunks(self, message):
+        # Morceaux dessinés par cette ligne du fil : ceux des collapse_lines premières lignes tant que le bloc est replié
+        block = message.block or message
+        count = CHUNKS_PER_ROW if block.expanded else self.preview_chunks
+        return range(message.first_chunk, min(self.chunk_count(block), message.first_chunk + count))
+
+    def has_toggle(self, message):
+        # Le bouton suit le code : sous l'aperçu replié, sous le dernier morceau déplié
+        block = message.block or message
+        return self.row_chunks(message).stop == self.chunk_count(block) if block.expanded else message is block
+
+    def chunk_height(self, block, chunk):
+        # Le code n'est jamais replié : avant sa mise en page, un morceau mesure son nombre de lignes
+        if chunk in block.chunk_heights:
+            return block.chunk_heights[chunk]
+        return min(self.chunk_lines, block.line_count - chunk * self.chunk_lines) * self.code_line_pitch
+
+    def chunk_document(self, message, chunk):
+        block = message.block or message
+        key = (block.id, chunk)
+        entry = self.documents.get(key)
+        if entry is not None and entry[1] == block.version:
+            self.documents.move_to_end(key)
+            return entry[0]
+        if self.renderer is not None:
+            self.request_chunk(message, chunk)
+            return None
+        document = self.create_document()
+        document.setHtml(highlight_code(self.chunk_text(block, chunk), block.lang))
+        self.store_chunk(block, chunk, document, block.version)
+        return document
+
+    def chunk_text(self, block, chunk):
+        start = chunk * self.chunk_lines
+        return block.code_lines(start, min(start + self.chunk_lines, block.line_count))
+
+    def request_chunk(self, message, chunk):
+        # Chaque morceau est coloré seul : une chaîne sur plusieurs lignes coupée entre deux morceaux
+        # peut y perdre sa couleur, le prix d'un affichage qui ne dépend pas de la taille du bloc
+        block = message.block or message
+        key = (block.id, chunk)
+        if key in self.rendering:
+            return
+        self.rendering.add(key)
+        version = block.version
+        def on_rendered(html, document, worker_ms):
+            self.rendering.discard(key)
+            if block.version != version:
+                return
+            if document is None:
+                document = self.create_document()
+                document.setHtml(html)
+            self.store_chunk(block, chunk, document, version)
+            message.height_cache = None
+            self.document_ready.emit(message, worker_ms)
+        self.renderer.submit('code', self.chunk_text(block, chunk), on_rendered, block.lang, self.font)
+
+    def store_chunk(self, block, chunk, document, version):
+        self.store(block, document, version, (block.id, chunk))
+        lines = min(self.chunk_lines, block.line_count - chunk * self.chunk_lines)
+        height = document.size().height() - 2 * document.documentMargin()
+        self.code_line_pitch = height / lines
+        block.chunk_heights[chunk] = height
+
+    def toggle_block(self, block, model):
+        """ Déplie ou replie un gros bloc : ses suites sont des lignes du fil, colorées à leur arrivée à l'écran. """
+        block.expanded = not block.expanded
+        block.height_cache = None
+        if block.expanded:
+            block.parts = []
+            for first_chunk in range(CHUNKS_PER_ROW, self.chunk_count(block), CHUNKS_PER_ROW):
+                part = ChatMessage(block.role, 'code', lang=block.lang)
+                part.block = block
+                part.first_chunk = first_chunk
+                block.parts.append(part)
+            model.insert_messages(block.row + 1, block.parts)
+        else:
+            model.remove_messages(block.row + 1, len(block.parts))
+            block.parts = []
+        model.refresh(block)
+
+    def request_render(self, message, text_width):
+        if self.is_chunked(message):
+            # Bloc replié : seuls ses premiers morceaux sont affichés, les autres à leur arrivée à l'écran
+            self.request_chunk(message, 0)
+            return
+        if message.id in self.rendering:
+            return
+        self.rendering.add(message.id)
+        version = message.version
+        if message.kind == 'code':
+            kind, text = ('html', message.code_html) if message.code_html else ('code', message.raw_code)
+        else:
+            kind, text = ('markdown' if message.is_markdown else 'html'), message.text
+        def on_rendered(html, document, worker_ms):
+            self.rendering.discard(message.id)
+            if message.kind == 'code' and not message.code_html:
+                message.code_html = html
+            if message.version != version or message.live_document is not None:
+                return
+            if document is None:
+                document = self.create_document()
+                document.setHtml(html)
+            self.store(message, document, version)
+            message.height_cache = None
+            self.document_ready.emit(message, worker_ms)
+        self.renderer.submit(kind, text, on_rendered, message.lang, self.font,
+                             text_width if message.kind != 'code' else None)
+
+    def create_document(self):
+        document = QTextDocument()
+        document.setDefaultFont(self.font)
+        return document
+
+    def forget(self, message):
+        self.documents.pop(message.id, None)
+
+    def adopt(self, message):
+        # Fin du streaming : le document vivant rejoint le cache au lieu d'être re-rendu
+        if message.live_document is not None:
+            self.documents[message.id] = (message.live_document, message.version)
+            message.live_document = None
+
+    def clear(self):
+        self.documents.clear()
+        self.rendering.clear()
+
+    def sizeHint(self, option, index):
+        message = index.data(MessageRole)
+        # option.rect n'est pas fiable ici : la largeur disponible vient de la vue
+        view = self.parent()
+        row_width = view.viewport().width() - 2 * view.spacing()
+        width = self.bubble_rect(message, QRect(0, 0, row_width, 0)).width()
+        if message.height_cache and message.height_cache[0] == width:
+            return QSize(row_width, message.height_cache[1])
+        if self.is_chunked(message):
+            block = message.block or message
+            height = math.ceil(sum(self.chunk_height(block, chunk) for chunk in self.row_chunks(message)))
+            if message.block is None:
+                height += CODE_HEADER_HEIGHT + DOCUMENT_MARGIN
+            if self.has_toggle(message):
+                height += DOCUMENT_MARGIN + CODE_FOOTER_HEIGHT + CODE_PADDING
+            message.height_cache = (width, height)
+            return QSize(row_width, height)
+        document = self.document_for(message, self.text_width(message, width))
+        if document is None:
+            # Hauteur estimée en attendant le document, pour que le fil ne saute pas à son arrivée
+            if message.kind == 'code':
+                return QSize(row_width, (message.raw_code.count("\n") + 1) * self.line_height + CODE_HEADER_HEIGHT + CODE_PADDING)
+            return QSize(row_width, self.line_height + 2 * BUBBLE_PADDING)
+        if message.kind == 'code':
+            height = int(document.size().height()) + CODE_HEADER_HEIGHT + CODE_PADDING
+        else:
+            height = int(document.size().height()) + 2 * BUBBLE_PADDING
+        message.height_cache = (width, height)
+        return QSize(row_width, height)
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        bubble = self.bubble_rect(message, option.rect)
+        chunked = self.is_chunked(message)
+        document = None if chunked else self.document_for(message, self.text_width(message, bubble.width()))
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        painter.setPen(Qt.PenStyle.NoPen)
+        context = QAbstractTextDocumentLayout.PaintContext()
+        context.palette.setColor(QPalette.ColorRole.Text, TEXT_COLOR)
+        if message.block is not None:
+            self.paint_block_part(painter, option, message, bubble, context)
+            painter.restore()
+            return
+        if message.kind == 'code':
+            painter.setBrush(CODE_BACKGROUND)
+            self.draw_code_background(painter, message, bubble)
+            painter.setFont(self.label_font)
+            painter.setPen(LABEL_COLOR)
+            label = message.lang or "code"
+            if chunked:
+                label += f" · {message.line_count} lignes"
+            painter.drawText(QRect(bubble.left() + CODE_PADDING, bubble.top() + 2, bubble.width() // 2, CODE_HEADER_HEIGHT),
+                             Qt.AlignmentFlag.AlignVCenter | Qt.AlignmentFlag.AlignLeft, label)
+            button = self.copy_button_rect(message, option.rect)
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(COPY_BUTTON_BACKGROUND)
+            painter.drawRoundedRect(QRectF(button), 5, 5)
+            painter.setPen(QColor("#d0d0d0"))
+            painter.drawText(button, Qt.AlignmentFlag.AlignCenter, "Copié !" if message.copied else "Copier")
+            if chunked and self.has_toggle(message):
+                self.draw_toggle(painter, message, option.rect)
+            origin = QPoint(bubble.left() + CODE_PADDING, bubble.top() + CODE_HEADER_HEIGHT)
+        else:
+            painter.setBrush(BUBBLE_COLORS.get(message.role, BUBBLE_COLORS['ai']))
+            painter.drawRoundedRect(QRectF(bubble), 18, 18)
+            origin = QPoint(bubble.left() + BUBBLE_PADDING, bubble.top() + BUBBLE_PADDING)
+        painter.translate(origin)
+        if chunked:
+            self.paint_chunks(painter, option, message, bubble, origin, context)
+        elif document is None:
+            painter.setFont(self.label_font)
+            painter.setPen(LABEL_COLOR)
+            painter.drawText(QRect(0, 0, bubble.width(), self.line_height), Qt.AlignmentFlag.AlignVCenter, PLACEHOLDER_TEXT)
+        else:
+            # Seule la partie visible est dessinée : un long bloc de code ne coûte que ses lignes à l'écran
+            visible = option.rect.intersected(self.parent().viewport().rect())
+            context.clip = QRectF(visible.translated(-origin))
+            document.documentLayout().draw(painter, context)
+        painter.restore()
+
+    def draw_code_background(self, painter, message, bubble):
+        painter.drawRoundedRect(QRectF(bubble), 8, 8)
+        # Les lignes d'un bloc déplié se raccordent : coins carrés et espacement comblé de part et d'autre,
+        # chacune pouvant être redessinée seule
+        gap = 2 * self.parent().spacing()
+        if message.block is not None:
+            painter.drawRect(QRectF(bubble.left(), bubble.top() - gap, bubble.width(), gap + 8))
+        if self.is_chunked(message) and not self.has_toggle(message):
+            painter.drawRect(QRectF(bubble.left(), bubble.bottom() + 1 - 8, bubble.width(), gap + 8))
+
+    def draw_toggle(self, painter, message, rect):
+        block = message.block or message
+        toggle = self.toggle_rect(message, rect)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(COPY_BUTTON_BACKGROUND)
+        painter.drawRoundedRect(QRectF(toggle), 5, 5)
+        painter.setPen(QColor("#d0d0d0"))
+        hidden = block.line_count - self.collapse_lines
+        painter.drawText(toggle, Qt.AlignmentFlag.AlignCenter,
+                         "Réduire" if block.expanded else f"Afficher les {hidden} lignes suivantes")
+
+    def paint_block_part(self, painter, option, message, bubble, context):
+        painter.setBrush(CODE_BACKGROUND)
+        self.draw_code_background(painter, message, bubble)
+        if self.has_toggle(message):
+            self.draw_toggle(painter, message, option.rect)
+        origin = QPoint(bubble.left() + CODE_PADDING, bubble.top() - DOCUMENT_MARGIN)
+        painter.translate(origin)
+        self.paint_chunks(painter, option, message, bubble, origin, context)
+
+    def paint_chunks(self, painter, option, message, bubble, origin, context):
+        # Seuls les morceaux à l'écran sont colorés (à leur premier affichage) et dessinés
+        block = message.block or message
+        visible = QRectF(option.rect.intersected(self.parent().viewport().rect()).translated(-origin))
+        top = 0.0
+        for chunk in self.row_chunks(message):
+            height = self.chunk_height(block, chunk)
+            if top + height + 2 * DOCUMENT_MARGIN > visible.top() and top < visible.bottom():
+                document = self.chunk_document(message, chunk)
+                if document is None:
+                    painter.setFont(self.label_font)
+                    painter.setPen(LABEL_COLOR)
+                    painter.drawText(QRect(DOCUMENT_MARGIN, int(top) + DOCUMENT_MARGIN, bubble.width(), self.line_height),
+                                     Qt.AlignmentFlag.AlignVCenter, PLACEHOLDER_TEXT)
+                else:
+                    painter.save()
+                    painter.translate(0, top)
+                    context.clip = visible.translated(0, -top)
+                    document.documentLayout().draw(painter, context)
+                    painter.restore()
+            top += height
+
+    def anchor_at(self, message, rect, position):
+        """ Lien sous le point position (coordonnées de la vue) dans une bulle de texte, "" sinon. """
+        if message.kind == 'code':
+            return ""
+        bubble = self.bubble_rect(message, rect)
+        document = self.document_for(message, self.text_width(message, bubble.width()))
+        if document is None:
+            return ""
+        origin = QPoint(bubble.left() + BUBBLE_PADDING, bubble.top() + BUBBLE_PADDING)
+        return document.documentLayout().anchorAt(QPointF(position - origin))
+
+    def plain_text(self, message):
+        """ Texte à copier : le code brut, la source markdown d'une réponse ou le texte d'une bulle HTML. """
+        if message.kind == 'code':
+            return (message.block or message).raw_code
+        if message.live_document is not None:
+            return message.live_document.toPlainText()
+        if message.is_markdown:
+            return message.text
+        document = QTextDocument()
+        document.setHtml(message.text)
+        return document.toPlainText()
+
+    def editorEvent(self, event, model, option, index):
+        message = index.data(MessageRole)
+        if (message.kind != 'code' and event.type() == QEvent.Type.MouseButtonRelease
+                and event.button() == Qt.MouseButton.LeftButton):
+            anchor = self.anchor_at(message, option.rect, event.position().toPoint())
+            if anchor:
+                QDesktopServices.openUrl(QUrl(anchor))
+                return True
+        if (self.is_chunked(message) and self.has_toggle(message) and event.type() == QEvent.Type.MouseButtonRelease
+                and self.toggle_rect(message, option.rect).contains(event.position().toPoint())):
+            block = message.block or message
+            self.toggle_block(block, model)
+            if not block.expanded:
+                self.parent().scrollTo(model.index(block.row))
+            return True
+        if (message.kind == 'code' and message.block is None and event.type() == QEvent.Type.MouseButtonRelease
+                and self.copy_button_rect(message, option.rect).contains(event.position().toPoint())):
+            QApplication.clipboard().setText(message.raw_code)
+            message.copied = True
+            model.refresh(message)
+            def reset_copy_label():
+                message.copied = False
+                model.refresh(message)
+            QTimer.singleShot(1200, reset_copy_label)
+            return True
+        return super().editorEvent(event, model, option, index)
+
+
+class ChatView(QListView):
+    """ Fil de discussion virtualisé : un seul widget, quelle que soit la longueur du chat. """
+    # Le haut du fil est atteint : les messages plus anciens peuvent être chargés
+    top_reached = Signal()
+    def __init__(self, parent=None, renderer=None, collapse_lines=150):
+        super().__init__(parent)
+        self.setObjectName("chat_view")
+        self.chat_model = ChatModel(self)
+        self.chat_delegate = ChatDelegate(renderer=renderer, collapse_lines=collapse_lines, parent=self)
+        self.chat_delegate.document_ready.connect(self.on_document_ready)
+        self.setModel(self.chat_model)
+        self.setItemDelegate(self.chat_delegate)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.ResizeMode.Adjust)
+        self.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+        self.setFocusPolicy(Qt.FocusPolicy.NoFocus)
+        self.setSpacing(4)
+        self.setMouseTracking(True)
+        self.verticalScrollBar().valueChanged.connect(self.on_scrolled)
+
+    def add_message(self, message):
+        self.chat_model.append_message(message)
+        self.scroll_to_bottom_later()
+        return message
+
+    def message_changed(self, message, follow=True):
+        # Les tailles ne sont recalculées que pour ce message, les autres gardent leur hauteur en cache
+        at_bottom = self.verticalScrollBar().value() >= self.verticalScrollBar().maximum() - 4
+        self.chat_delegate.forget(message)
+        self.chat_model.message_changed(message)
+        self.scheduleDelayedItemsLayout()
+        if follow and at_bottom:
+            self.scroll_to_bottom_later()
+
+    def on_document_ready(self, message, _):
+        # Document préparé par le RenderWorker : seule sa ligne change de hauteur
+        if not self.chat_model.contains(message):
+            return
+        at_bottom = self.verticalScrollBar().value() >= self.verticalScrollBar().maximum() - 4
+        self.chat_model.refresh(message)
+        self.scheduleDelayedItemsLayout()
+        if at_bottom:
+            self.scroll_to_bottom_later()
+
+    def prepend_messages(self, messages):
+        # La position de lecture est conservée : le message en haut de l'écran y reste
+        anchor = -1
+        if self.chat_model.messages:
+            # Point juste sous l'espacement du haut, sinon aucun message n'est trouvé
+            anchor = max(0, self.indexAt(QPoint(self.viewport().width() // 2, self.spacing() + 1)).row())
+        self.chat_model.prepend_messages(messages)
+        if anchor >= 0:
+            self.scrollTo(self.chat_model.index(anchor + len(messages)), QAbstractItemView.ScrollHint.PositionAtTop)
+
+    def on_scrolled(self, value):
+        if value == self.verticalScrollBar().minimum() and self.chat_model.messages:
+            self.top_reached.emit()
+
+    def wheelEvent(self, event):
+        # Fil trop court pour défiler : la molette vers le haut suffit à demander la suite
+        if event.angleDelta().y() > 0 and self.verticalScrollBar().value() == self.verticalScrollBar().minimum():
+            self.top_reached.emit()
+        super().wheelEvent(event)
+
+    def scroll_to_bottom_later(self):
+        QTimer.singleShot(50, self.scrollToBottom)
+
+    def clear_messages(self):
+        self.chat_model.clear()
+        self.chat_delegate.clear()
+
+    def mouseMoveEvent(self, event):
+        index = self.indexAt(event.position().toPoint())
+        message = index.data(MessageRole) if index.isValid() else None
+        position = event.position().toPoint()
+        over_button = message is not None and message.kind == 'code' and (
+            message.block is None and self.chat_delegate.copy_button_rect(message, self.visualRect(index)).contains(position)
+            or self.chat_delegate.is_chunked(message) and self.chat_delegate.has_toggle(message)
+            and self.chat_delegate.toggle_rect(message, self.visualRect(index)).contains(position))
+        over_button = over_button or message is not None and bool(
+            self.chat_delegate.anchor_at(message, self.visualRect(index), position))
+        self.viewport().setCursor(Qt.CursorShape.PointingHandCursor if over_button else Qt.CursorShape.ArrowCursor)
+        super().mouseMoveEvent(event)
+
+    def contextMenuEvent(self, event):
+        # Les bulles sont dessinées, pas éditables : le texte (ou le lien) se copie depuis ce menu
+        index = self.indexAt(event.pos())
+        if not index.isValid():
+            return
+        message = index.data(MessageRole)
+        anchor = self.chat_delegate.anchor_at(message, self.visualRect(index), event.pos())
+        menu = QMenu(self)
+        copy_text = menu.addAction("Copier le code" if message.kind == 'code' else "Copier le message")
+        copy_link = menu.addAction("Copier le lien") if anchor else None
+        chosen = menu.exec(event.globalPos())
+        if chosen is copy_text:
+            QApplication.clipboard().setText(self.chat_delegate.plain_text(message))
+        elif chosen is not None and chosen is copy_link:
+            QApplication.clipboard().setText(anchor)
@@ -2,22 +2,56 @@
 # Owner TMCooper
 
 import os
-import io
 import re
 import sys
+import html
+import time
+import threading
 import markdown
-from PIL import Image
-from pygments.formatters import HtmlFormatter
+from collections import deque
+from contextlib import nullcontext
 
-from PySide6.QtCore import (Qt, QObject, Signal, QThread, QTimer, QPoint, 
+from PySide6.QtCore import (Qt, QObject, Signal, Slot, QThread, QTimer, QPoint, 
                             QEasingCurve, QPropertyAnimation, QRect, QSize)
-from PySide6.QtGui import QKeySequence, QImage, QIcon
+from PySide6.QtGui import (QKeySequence, QImage, QIcon, QTextCursor, QTextDocument,
+                           QTextDocumentFragment, QTextCharFormat)
 from PySide6.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, 
-                               QLineEdit, QLabel, QScrollArea, QTextBrowser, 
-                               QPushButton, QFileDialog, QFrame)
+                               QLineEdit, QLabel, QPushButton, QFileDialog)
 
 from src.styles import STYLESHEET
 from src.file_preview_widget import FilePreviewWidget
+from src.config import env_flag, env_int, env_float, env_str, data_path
+from src.highlight_cache import HighlightCache
+from src.chat_view import ChatView, ChatMessage
+from src.image_pipeline import ImagePipeline, IMAGE_EXTS
+from src.text_loader import TextLoader, SCRIPT_EXTS, TEXT_EXTS
+from src.text_compactor import compaction_summary
+from src.folder_loader import FolderLoader
+from src.attachment_store import AttachmentStore
+from src.context_manager import ContextManager, estimate_prompt_tokens
+from src.response_cache import ResponseCache, prompt_hash
+from src.request_timing import RequestTimingLog
+from src.request_scheduler import RequestScheduler
+from src.fence_parser import FenceParser
+from src.render_worker import RenderPipeline, StallMonitor
+from src.conversation_store import ConversationStore, SNIPPET_START, SNIPPET_END
+from src.model_backend import RequestCancelled
+
+NO_CACHE_COMMAND = "/nocache"
+STATS_COMMAND = "/stats"
+CONVERSATIONS_COMMAND = "/conversations"
+RESUME_COMMAND = "/resume"
+SEARCH_COMMAND = "/search"
+COMPARE_COMMAND = "/compare"
+
+# Début d'un élément de liste markdown (à puces ou numéroté)
+LIST_ITEM_PATTERN = re.compile(r"\s{0,3}(?:[-*+]|\d+[.)])\s")
+
+def format_tokens(tokens):
+    return f"{tokens / 1000:.1f}k" if tokens >= 1000 else str(tokens)
+
+def escape_html(text):
+    return html.escape(text, quote=False)
 
 def resource_path(relative_path):
     """ Obtient le chemin absolu vers une ressource, fonctionne pour le dev et pour PyInstaller. """
@@ -29,11 +63,29 @@ def resource_path(relative_path):
 
 class BlockStreamer(QObject):
     stream_finished = Signal()
-    def __init__(self, browser: QTextBrowser, markdown_text: str, parent=None):
+    updated = Signal()
+    # Tous les blocs sont dans le document (après stream_finished quand le rendu est asynchrone)
+    rendered = Signal()
+    def __init__(self, document: QTextDocument, markdown_text: str, parent=None, timings=None, renderer=None):
         super().__init__(parent)
-        self.browser = browser
+        self.document = document
+        # Durées de la demande à laquelle appartient ce rendu (voir request_timing)
+        self.timings = timings
+        # Markdown -> HTML -> QTextDocument préparés par le RenderWorker, seule l'insertion reste ici
+        self.renderer = renderer
         self.blocks_to_display = markdown_text.split('\n\n')
         self.displayed_blocks = []
+        # Blocs de la liste en cours : une liste "aérée" (éléments séparés par une ligne vide) ne forme
+        # qu'une seule liste en markdown, elle est re-rendue en entier tant qu'elle peut continuer
+        self.list_blocks = []
+        # Rendu incrémental : seuls les nouveaux blocs sont convertis puis ajoutés
+        # au document existant, le bloc en cours de réception est le seul re-rendu.
+        self.cursor = QTextCursor(document)
+        self.committed_end = 0
+        self.pending_text = ""
+        # Blocs envoyés au worker, insérés dans l'ordre d'envoi : [définitif ?, document préparé]
+        self.render_jobs = deque()
+        self.done = False
         self.timer = QTimer(self)
     def start(self):
         self.timer.setInterval(350) 
@@ -41,42 +93,408 @@ class BlockStreamer(QObject):
         self.timer.start()
     def _add_block(self):
         if self.blocks_to_display:
-            next_block = self.blocks_to_display.pop(0)
-            self.displayed_blocks.append(next_block)
-            current_markdown = "\n\n".join(self.displayed_blocks)
-            html_to_display = markdown.markdown(current_markdown)
-            self.browser.setHtml(html_to_display)
+            self._finish_block(self.blocks_to_display.pop(0))
+            if self.list_blocks:
+                self._submit("\n\n".join(self.list_blocks), False)
         else:
-            self.timer.stop()
-            self.stream_finished.emit()
+            self.finish()
+    def feed(self, text):
+        # Mode streaming : le texte est affiché dès sa réception, sans délai artificiel
+        *finished_blocks, self.pending_text = (self.pending_text + text).split('\n\n')
+        for block in finished_blocks:
+            self._finish_block(block)
+        self._submit("\n\n".join(self.list_blocks + [self.pending_text]), False)
+    def _finish_block(self, block):
+        self.displayed_blocks.append(block)
+        if LIST_ITEM_PATTERN.match(block) or (self.list_blocks and block[:1] in (" ", "\t")):
+            # Élément ou suite indentée de la liste en cours : elle reste ouverte
+            self.list_blocks.append(block)
+            return
+        self._close_list()
+        self._submit(block, True)
+    def _close_list(self):
+        if self.list_blocks:
+            self._submit("\n\n".join(self.list_blocks), True)
+            self.list_blocks = []
+    def finish(self):
+        # Termine aussi une animation en cours : les blocs restants sont affichés d'un coup
+        if self.done:
+            return
+        self.done = True
+        self.timer.stop()
+        remaining = self.blocks_to_display + ([self.pending_text] if self.pending_text else [])
+        self.blocks_to_display = []
+        self.pending_text = ""
+        for block in remaining:
+            self._finish_block(block)
+        self._close_list()
+        self.stream_finished.emit()
+        self._apply_ready()
+    def _span(self):
+        return self.timings.span("render") if self.timings is not None else nullcontext()
+    def markdown_source(self):
+        return "\n\n".join(self.displayed_blocks)
+    def _submit(self, block, final):
+        if not block.strip() and final:
+            return
+        job = [final, None]
+        self.render_jobs.append(job)
+        if self.renderer is None or not block.strip():
+            with self._span():
+                job[1] = self._block_document(markdown.markdown(block.strip()))
+            self._apply_ready()
+            return
+        def on_rendered(_, document, worker_ms):
+            job[1] = document or self._block_document(markdown.markdown(block.strip()))
+            if self.timings is not None:
+                self.timings.add("markdown", worker_ms)
+            self._apply_ready()
+        self.renderer.submit('markdown', block.strip(), on_rendered, layout=False)
+    def _apply_ready(self):
+        changed = False
+        with self._span():
+            while self.render_jobs and self.render_jobs[0][1] is not None:
+                final, block_document = self.render_jobs.popleft()
+                if final:
+                    self._remove_pending()
+                    if self._insert_block(block_document):
+                        self.committed_end = self.cursor.position()
+                    changed = True
+                elif not self.render_jobs:
+                    # Bloc en cours de réception : seule sa version la plus récente est affichée
+                    self._remove_pending()
+                    self._insert_block(block_document)
+                    changed = True
+        if changed:
+            self.updated.emit()
+        if self.done and not self.render_jobs:
+            self.rendered.emit()
+    def _block_document(self, html):
+        block_document = QTextDocument()
+        block_document.setHtml(html)
+        return block_document
+    def _remove_pending(self):
+        self.cursor.setPosition(self.committed_end)
+        self.cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        self.cursor.removeSelectedText()
+    def _insert_block(self, block_document):
+        if block_document.isEmpty():
+            return False
+        # Le premier bloc du fragment fusionne avec le bloc courant : on lui donne
+        # d'abord le format (marges, titre) qu'il aurait eu avec un setHtml complet.
+        # Une liste aussi a besoin de son propre bloc, sinon elle se colle au dernier élément de la précédente
+        first_block = block_document.begin()
+        if self.cursor.position() > 0:
+            self.cursor.insertBlock(first_block.blockFormat(), QTextCharFormat())
+        elif not first_block.textList():
+            self.cursor.setBlockFormat(first_block.blockFormat())
+        self.cursor.insertFragment(QTextDocumentFragment(block_document))
+        return True
+
+class CancelToken(threading.Event):
+    """ Jeton d'annulation d'une demande, vérifié par le worker entre deux morceaux. """
+    def __init__(self):
+        super().__init__()
+        self.keep_partial = True
+    def cancel(self, keep_partial=True):
+        self.keep_partial = keep_partial
+        self.set()
 
 class GeminiWorker(QObject):
-    finished = Signal(str)
-    error = Signal(str)
-    def __init__(self, chat_session, prompt_parts):
+    # Chaque signal porte l'identifiant de la demande, pour ignorer ceux d'une demande annulée
+    chunk_received = Signal(int, str)
+    context_updated = Signal(int, int)
+    cached_result = Signal(int, str)
+    fan_out_result = Signal(int, object)
+    throttled = Signal(int, str)
+    stage_timings = Signal(int, object)
+    finished = Signal(int, str)
+    error = Signal(int, str)
+    # Worker unique et persistant : il vit dans son propre QThread pendant toute la
+    # session et traite les demandes une par une via le signal request_submitted.
+    def __init__(self, chat_session, stream=False, context_manager=None, response_cache=None, scheduler=None,
+                 conversation_store=None):
         super().__init__()
+        self.conversation_store = conversation_store
         self.chat_session = chat_session
-        self.prompt_parts = prompt_parts
-    def run(self):
+        self.stream = stream
+        self.context_manager = context_manager
+        self.response_cache = response_cache
+        # Sans ordonnanceur : ni limite de débit ni nouvel essai
+        self.scheduler = scheduler or RequestScheduler(0, 0, max_attempts=1)
+        self.model_name = getattr(chat_session, 'model_name', '')
+    def trim_context(self, prompt_parts):
+        # L'historique est compacté dans ce thread, juste avant l'envoi qui le lit
+        try:
+            context_tokens = self.context_manager.apply(self.chat_session, prompt_parts)
+            self.context_updated.emit(context_tokens, self.context_manager.tokens_saved)
+        except Exception as e:
+            print(f"Impossible de compacter l'historique : {e}")
+    def record_turn(self, prompt_parts, response_text, history=None):
+        # Réponse servie par le cache ou interrompue : l'historique est mis à jour à la main
+        try:
+            history = list(self.chat_session.history) if history is None else history
+            turn = [{'role': 'user', 'parts': prompt_parts}, {'role': 'model', 'parts': [response_text]}]
+            self.chat_session.history = history + (turn if response_text else [])
+        except Exception as e:
+            print(f"Impossible de mettre à jour l'historique : {e}")
+    @Slot(object)
+    def set_history(self, history):
+        # Passe par la file du thread : une demande en cours ne peut plus réécrire l'ancien historique après coup
+        try:
+            self.chat_session.history = history
+        except Exception as e:
+            print(f"Impossible de remplacer l'historique : {e}")
+    @Slot(int)
+    def resume_history(self, conversation_id):
+        # Relu ici plutôt que dans le thread de l'interface : 500 tours, c'est quelques dizaines de ms
+        try:
+            full_turns = self.context_manager.keep_recent_turns if self.context_manager is not None else 2
+            self.chat_session.history = self.conversation_store.load_history(conversation_id, full_turns)
+        except Exception as e:
+            print(f"Impossible de relire la conversation : {e}")
+    def store_in_cache(self, cache_key, response_text):
         try:
+            self.response_cache.put(cache_key, self.model_name, response_text)
+        except Exception as e:
+            print(f"Impossible d'enregistrer la réponse dans le cache : {e}")
+    @Slot(object)
+    def run(self, request):
+        request_id = request.get('request_id', 0)
+        prompt_parts = request['prompt_parts']
+        cancel_event = request.get('cancel_event') or CancelToken()
+        if cancel_event.is_set():
+            # Annulée alors qu'elle attendait son tour dans ce thread
+            return
+        # Durées mesurées dans ce thread, envoyées avant le signal de fin de la demande
+        stages = {}
+        def elapsed_since(start):
+            return (time.perf_counter() - start) * 1000
+        if self.context_manager is not None:
+            # Avant le cache : la clé porte sur l'historique tel qu'il sera envoyé
+            started = time.perf_counter()
+            self.trim_context(prompt_parts)
+            stages['context'] = elapsed_since(started)
+        cache_key = None
+        if self.response_cache is not None:
+            started = time.perf_counter()
+            try:
+                cache_key = prompt_hash(self.model_name, prompt_parts, self.chat_session.history)
+                cached_text = self.response_cache.get(cache_key) if request.get('use_cache', True) else None
+            except Exception as e:
+                print(f"Cache de réponses indisponible : {e}")
+                cache_key, cached_text = None, None
+            stages['cache'] = elapsed_since(started)
+            if cached_text is not None:
+                self.record_turn(prompt_parts, cached_text)
+                self.stage_timings.emit(request_id, stages)
+                self.cached_result.emit(request_id, cached_text)
+                return
+        def on_wait(status):
+            self.throttled.emit(request_id, status)
+        # Le contexte complet (historique compris) compte dans la limite de tokens par minute
+        tokens = self.context_manager.context_tokens if self.context_manager is not None else estimate_prompt_tokens(prompt_parts)
+        model_count = len(request.get('fan_out') or [None])
+        waited_before = self.scheduler.waited
+        def record_throttle():
+            waited_ms = (self.scheduler.waited - waited_before) * 1000
+            if waited_ms > 0:
+                stages['throttle'] = waited_ms
+            return waited_ms
+        try:
+            self.scheduler.wait_for_slot(tokens * model_count, cancel_event, on_wait, requests=model_count)
+        except RequestCancelled:
+            return
+        slot_waited_ms = record_throttle()
+        if request.get('fan_out'):
+            self.run_fan_out(request_id, prompt_parts, request['fan_out'], cancel_event, stages)
+            return
+        history_before = list(self.chat_session.history)
+        full_text = ""
+        attempts = []
+        def send():
+            nonlocal full_text
+            if attempts:
+                # Un essai raté ne doit pas laisser de trace dans l'historique
+                self.chat_session.history = history_before
+            attempts.append(time.perf_counter())
             # Print pour débugger ce qui est envoyé
-            # print("DEBUG: Sending to Gemini API:", self.prompt_parts) 
-            response = self.chat_session.send_message(self.prompt_parts)
-            self.finished.emit(response.text)
+            # print("DEBUG: Sending to Gemini API:", prompt_parts) 
+            if self.stream:
+                response = self.chat_session.send_message(prompt_parts, stream=True)
+                for chunk in response:
+                    if cancel_event.is_set():
+                        # Backend sans annulation native : on arrête simplement de lire le flux
+                        if hasattr(response, 'close'):
+                            response.close()
+                        break
+                    try:
+                        text = chunk.text
+                    except ValueError:
+                        # Chunk sans partie texte (fin de génération, filtre...)
+                        continue
+                    if text:
+                        if not full_text:
+                            stages['api_first_chunk'] = elapsed_since(attempts[-1])
+                        full_text += text
+                        self.chunk_received.emit(request_id, text)
+            else:
+                full_text = self.chat_session.send_message(prompt_parts).text
+        started = time.perf_counter()
+        try:
+            # Nouvel essai automatique sur 429 / 5xx, tant que rien n'a encore été affiché
+            self.scheduler.call(send, cancel_event, on_wait, can_retry=lambda: not full_text)
+            record_throttle()
+            stages['api'] = elapsed_since(attempts[-1])
+            if cancel_event.is_set():
+                self.record_cancelled_turn(history_before, prompt_parts, full_text, cancel_event)
+                return
+            if cache_key is not None:
+                self.store_in_cache(cache_key, full_text)
+            self.stage_timings.emit(request_id, stages)
+            self.finished.emit(request_id, full_text)
         except Exception as e:
-            # Ce bloc devrait attraper les erreurs explicites de l'API
+            if cancel_event.is_set():
+                # L'erreur vient de la requête interrompue, l'interface est déjà passée à la suite
+                self.record_cancelled_turn(history_before, prompt_parts, full_text, cancel_event)
+                return
+            # Ce bloc devrait attraper les erreurs explicites de l'API, une fois les nouveaux essais épuisés
             print(f"Erreur API Gemini : {e}")
-            self.error.emit(f"Une erreur est survenue : {e}")
+            # Les attentes entre deux essais sont comptées à part
+            stages['api'] = elapsed_since(started) - (record_throttle() - slot_waited_ms)
+            self.stage_timings.emit(request_id, stages)
+            self.error.emit(request_id, f"Une erreur est survenue : {e}")
+
+    def run_fan_out(self, request_id, prompt_parts, model_names, cancel_event, stages):
+        # Même question à plusieurs modèles en parallèle, réponses affichées côte à côte
+        history_before = list(self.chat_session.history)
+        started = time.perf_counter()
+        try:
+            results = self.chat_session.fan_out(prompt_parts, model_names)
+        except Exception as e:
+            if cancel_event.is_set():
+                self.record_turn(prompt_parts, "", history_before)
+                return
+            print(f"Erreur API Gemini : {e}")
+            self.error.emit(request_id, f"Une erreur est survenue : {e}")
+            return
+        stages['api'] = (time.perf_counter() - started) * 1000
+        self.stage_timings.emit(request_id, stages)
+        # Texte ou exception, laissés tels quels : une erreur ne doit pas passer pour une réponse
+        self.fan_out_result.emit(request_id, list(results))
+
+    def record_cancelled_turn(self, history_before, prompt_parts, full_text, cancel_event):
+        # Seule la réponse partielle déjà affichée (streaming, "Arrêter") est gardée dans l'historique
+        keep = self.stream and cancel_event.keep_partial
+        self.record_turn(prompt_parts, full_text if keep else "", history_before)
 
 
 class CommandBar(QWidget):
-    def __init__(self, chat_session):
+    request_submitted = Signal(object)
+    history_replaced = Signal(object)
+    conversation_resumed = Signal(int)
+    def __init__(self, chat_session, streaming=None):
         super().__init__()
         self.chat_session = chat_session
+        self.streaming = env_flag("AIBAR_STREAMING", True) if streaming is None else streaming
         self.is_processing = False
+        self.stream_parser = FenceParser()
+        self.stream_streamer = None
+        # Réponse complète affichée segment par segment, dans l'ordre (prose animée, puis code...)
+        self.render_queue = deque()
+        self.streamer = None
+        # Durées de la demande dont la réponse est encore en train de s'afficher
+        self.render_timings = None
+        self.request_started_at = None
+        self.last_ttft_ms = None
+        self.highlight_cache = HighlightCache(
+            env_int("AIBAR_HIGHLIGHT_CACHE_SIZE", 256),
+            data_path("highlight_cache.json") if env_flag("AIBAR_HIGHLIGHT_CACHE_PERSIST") else None
+        )
+        # Markdown, coloration et mise en page des documents hors du thread de l'interface
+        self.render_pipeline = RenderPipeline(self.highlight_cache, self)
+        self.stall_monitor = StallMonitor(parent=self)
+        # Blocs de code en cours de préparation : durées de la demande à compléter à leur arrivée
+        self.code_timings = {}
+        QApplication.instance().aboutToQuit.connect(self.on_about_to_quit)
+        self.image_pipeline = ImagePipeline(
+            env_int("AIBAR_IMAGE_MAX_EDGE", 1600),
+            env_str("AIBAR_IMAGE_FORMAT", "WEBP"),
+            env_int("AIBAR_IMAGE_QUALITY", 85),
+            env_int("AIBAR_IMAGE_WORKERS", 2),
+            self
+        )
+        self.image_pipeline.image_ready.connect(self.on_attachment_ready)
+        self.image_pipeline.image_failed.connect(self.on_attachment_failed)
+        self.text_loader = TextLoader(
+            env_int("AIBAR_TEXT_MAX_KB", 512) * 1024,
+            env_int("AIBAR_LOG_TAIL_LINES", 2000),
+            compact=env_flag("AIBAR_COMPACT_ATTACHMENTS", True),
+            strip_comments=env_flag("AIBAR_COMPACT_STRIP_COMMENTS"),
+            trim_json=env_flag("AIBAR_COMPACT_TRIM_JSON"),
+            parent=self
+        )
+        self.text_loader.text_ready.connect(self.on_attachment_ready)
+        self.text_loader.text_failed.connect(self.on_attachment_failed)
+        self.text_loader.progress.connect(self.on_attachment_progress)
+        self.folder_loader = FolderLoader(
+            env_int("AIBAR_FOLDER_MAX_TOKENS", 24000),
+            env_int("AIBAR_TEXT_MAX_KB", 512) * 1024,
+            [pattern.strip() for pattern in env_str("AIBAR_FOLDER_EXCLUDE").split(",") if pattern.strip()],
+            env_int("AIBAR_FOLDER_WORKERS", 8),
+            compact=env_flag("AIBAR_COMPACT_ATTACHMENTS", True),
+            strip_comments=env_flag("AIBAR_COMPACT_STRIP_COMMENTS"),
+            trim_json=env_flag("AIBAR_COMPACT_TRIM_JSON"),
+            parent=self
+        )
+        self.folder_loader.folder_ready.connect(self.on_attachment_ready)
+        self.folder_loader.folder_failed.connect(self.on_attachment_failed)
+        self.folder_loader.progress.connect(self.on_attachment_progress)
+        self.context_manager = ContextManager(
+            env_int("AIBAR_CONTEXT_MAX_TOKENS", 32000),
+            env_int("AIBAR_CONTEXT_KEEP_TURNS", 2)
+        )
+        self.response_cache = ResponseCache(
+            data_path("response_cache.sqlite3"),
+            env_float("AIBAR_RESPONSE_CACHE_TTL_HOURS", 24) * 3600,
+            env_int("AIBAR_RESPONSE_CACHE_MAX_MB", 50) * 1024 * 1024
+        ) if env_flag("AIBAR_RESPONSE_CACHE") else None
+        self.request_scheduler = RequestScheduler(
+            env_int("AIBAR_RATE_LIMIT_RPM", 15),
+            env_int("AIBAR_RATE_LIMIT_TPM", 1000000),
+            env_int("AIBAR_RETRY_MAX_ATTEMPTS", 6),
+            max_delay=env_float("AIBAR_RETRY_MAX_DELAY_S", 60)
+        )
+        self.conversation_store = ConversationStore(
+            data_path("conversations.sqlite3"),
+            env_int("AIBAR_CONVERSATION_KEEP", 100)
+        ) if env_flag("AIBAR_CONVERSATION_STORE", True) else None
+        # Conversation enregistrée en cours (créée au premier échange réussi)
+        self.conversation_id = None
+        self.unsaved_messages = []
+        # Rapports de compactage des derniers fichiers joints, affichés par /stats
+        self.compaction_reports = deque(maxlen=10)
+        self.has_older_messages = False
+        self.oldest_loaded_position = None
+        self.active_prompt_parts = None
+        self.active_title = ""
+        self.attachment_store = AttachmentStore()
+        self.turn_index = 0
+        self.timing_log = RequestTimingLog(
+            data_path("timings.jsonl") if env_flag("AIBAR_TIMING_LOG", True) else None,
+            env_int("AIBAR_TIMING_LOG_MAX_KB", 1024) * 1024
+        )
+        self.timing_log.on_close = self.record_stall
+        self.request_timings = None
+        self.request_counter = 0
+        self.active_request_id = None
+        self.active_cancel_event = None
+        self.pending_requests = deque()
+        self.status_parts = {}
         self.files_to_send = [] 
         self.drag_position = None
         self.init_ui()
+        self.start_worker()
         self.setAcceptDrops(True)
         self.setWindowOpacity(0.0)
 
@@ -87,14 +505,10 @@ class CommandBar(QWidget):
         self.setStyleSheet(STYLESHEET)
         self.main_layout = QVBoxLayout(self)
         self.main_layout.setContentsMargins(10, 10, 10, 10)
-        self.scroll_area = QScrollArea(self)
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_content_widget = QWidget()
-        self.scroll_content_widget.setObjectName("scroll_content")
-        self.scroll_layout = QVBoxLayout(self.scroll_content_widget)
-        self.scroll_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-        self.scroll_area.setWidget(self.scroll_content_widget)
-        self.scroll_area.hide()
+        self.chat_view = ChatView(self, self.render_pipeline, env_int("AIBAR_CODE_COLLAPSE_LINES", 150))
+        self.chat_view.chat_delegate.document_ready.connect(self.on_code_block_ready)
+        self.chat_view.top_reached.connect(self.load_older_messages)
+        self.chat_view.hide()
         self.bottom_container = QWidget(self)
         self.bottom_layout = QVBoxLayout(self.bottom_container)
         self.bottom_layout.setContentsMargins(0, 0, 0, 0)
@@ -122,13 +536,54 @@ class CommandBar(QWidget):
         self.input_field = QLineEdit(self)
         self.input_field.setPlaceholderText("Poser une question à Gemini...")
         self.input_field.returnPressed.connect(self.process_input)
+        self.stop_btn = QPushButton("\u25A0")
+        self.stop_btn.setObjectName("stop_btn")
+        self.stop_btn.setToolTip("Arrêter la génération")
+        self.stop_btn.setCursor(Qt.CursorShape.PointingHandCursor)
+        self.stop_btn.setFixedSize(34, 34)
+        self.stop_btn.clicked.connect(self.stop_generating)
+        self.stop_btn.hide()
         input_line_layout.addWidget(self.add_file_btn)
         input_line_layout.addWidget(self.input_field)
+        input_line_layout.addWidget(self.stop_btn)
         self.input_area_layout.addLayout(input_line_layout)
+        self.status_label = QLabel(self)
+        self.status_label.setObjectName("status_label")
+        self.status_label.hide()
+        self.bottom_layout.addWidget(self.status_label)
         self.bottom_layout.addWidget(self.input_area_widget)
-        self.main_layout.addWidget(self.scroll_area)
+        self.main_layout.addWidget(self.chat_view)
         self.main_layout.addWidget(self.bottom_container)
 
+    def start_worker(self):
+        self.worker_thread = QThread(self)
+        self.worker = GeminiWorker(self.chat_session, stream=self.streaming, context_manager=self.context_manager,
+                                   response_cache=self.response_cache, scheduler=self.request_scheduler,
+                                   conversation_store=self.conversation_store)
+        self.worker.moveToThread(self.worker_thread)
+        self.request_submitted.connect(self.worker.run)
+        self.history_replaced.connect(self.worker.set_history)
+        self.conversation_resumed.connect(self.worker.resume_history)
+        self.worker.chunk_received.connect(self.on_worker_chunk)
+        self.worker.finished.connect(self.on_worker_finished)
+        self.worker.error.connect(self.on_worker_error)
+        self.worker.cached_result.connect(self.on_worker_cached_result)
+        self.worker.fan_out_result.connect(self.on_worker_fan_out)
+        self.worker.throttled.connect(self.on_worker_throttled)
+        self.worker.context_updated.connect(self.on_context_updated)
+        self.worker.stage_timings.connect(self.on_stage_timings)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+        self.worker_thread.start()
+
+    def set_status(self, key, text):
+        # Ligne d'état sous la zone de saisie (file d'attente, etc.)
+        if text:
+            self.status_parts[key] = text
+        else:
+            self.status_parts.pop(key, None)
+        self.status_label.setText(" · ".join(self.status_parts.values()))
+        self.status_label.setVisible(bool(self.status_parts))
+
     def run_show_animation(self):
         self.pos_anim = QPropertyAnimation(self, b"pos")
         start_pos = self.pos()
@@ -144,7 +599,7 @@ class CommandBar(QWidget):
         self.opacity_anim.start()
 
     def animate_window_expansion(self):
-        self.scroll_area.show()
+        self.chat_view.show()
         start_geo = self.geometry()
         end_geo = QRect(start_geo.x(), start_geo.y(), start_geo.width(), 600)
         self.expand_anim = QPropertyAnimation(self, b"geometry")
@@ -179,6 +634,7 @@ class CommandBar(QWidget):
             
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Escape:
+            # closeEvent annule la demande en cours et vide la file d'attente
             self.close()
         elif event.matches(QKeySequence.StandardKey.Paste):
             if cb := QApplication.clipboard():
@@ -188,43 +644,37 @@ class CommandBar(QWidget):
             super().keyPressEvent(event)
 
     def handle_file(self, file_data):
-        IMAGE_EXTS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp']
-        # Séparation des scripts et des autres fichiers texte
-        SCRIPT_EXTS = ['.bat', '.sh']
-        TEXT_EXTS = ['.txt', '.py', '.js', '.html', '.css', '.json', '.md', '.log', '.c', '.cpp', '.h']
-        
         file_info = None
         try:
-            if isinstance(file_data, str):
+            if isinstance(file_data, str) and os.path.isdir(file_data):
+                # Dossier entier : parcouru et lu en arrière-plan, dans la limite d'un budget de tokens
+                file_info = {'type': 'folder', 'data': None, 'name': os.path.basename(os.path.normpath(file_data)) + "/",
+                             'pending': True}
+                self.folder_loader.submit(file_info, file_data)
+
+            elif isinstance(file_data, str):
                 filename = os.path.basename(file_data)
                 _, ext = os.path.splitext(filename.lower())
                 
-                if ext in IMAGE_EXTS:
-                    img = Image.open(file_data)
-                    file_info = {'type': 'image', 'data': img, 'name': filename}
+                if (ext in IMAGE_EXTS or ext in SCRIPT_EXTS or ext in TEXT_EXTS) and (entry := self.attachment_store.lookup_path(file_data)):
+                    # Fichier déjà joint pendant la session et inchangé : ni relu ni ré-encodé
+                    file_info = {'type': entry['type'], 'data': entry['data'], 'name': filename, 'key': entry['key']}
+                elif ext in IMAGE_EXTS:
+                    file_info = {'type': 'image', 'data': None, 'name': filename, 'pending': True, 'path': file_data}
+                    self.image_pipeline.submit(file_info, file_data)
+                elif ext in SCRIPT_EXTS or ext in TEXT_EXTS:
+                    # Lecture en arrière-plan, plafonnée pour les très gros fichiers (logs...)
+                    file_type = 'script' if ext in SCRIPT_EXTS else 'text'
+                    file_info = {'type': file_type, 'data': None, 'name': filename, 'pending': True, 'path': file_data}
+                    self.text_loader.submit(file_info, file_data)
                 else:
-                    content = ""
-                    # On tente de lire le fichier avec un encodage robuste
-                    try:
-                        with open(file_data, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                    except UnicodeDecodeError:
-                        # Si l'UTF-8 échoue, on essaye un encodage latin, courant sur Windows
-                        with open(file_data, 'r', encoding='latin-1', errors='ignore') as f:
-                            content = f.read()
-
-                    if ext in SCRIPT_EXTS:
-                        file_info = {'type': 'script', 'data': content, 'name': filename}
-                    elif ext in TEXT_EXTS:
-                        file_info = {'type': 'text', 'data': content, 'name': filename}
-                    else:
-                        self.add_message_to_view(f"Type de fichier non supporté : {filename}", "ai")
+                    self.add_message_to_view(f"Type de fichier non supporté : {filename}", "ai")
             
             elif isinstance(file_data, QImage):
-                buffer = io.BytesIO()
-                file_data.save(buffer, "PNG")
-                img_pil = Image.open(io.BytesIO(buffer.getvalue()))
-                file_info = {'type': 'image', 'data': img_pil, 'name': 'capture.png'}
+                # Conversion, réduction et empreintes faites hors du thread de l'interface ; une capture
+                # déjà jointe est reconnue par AttachmentStore.add, qui reprend la copie déjà encodée
+                file_info = {'type': 'image', 'data': None, 'name': 'capture.png', 'pending': True}
+                self.image_pipeline.submit(file_info, file_data)
 
             if file_info:
                 self.files_to_send.append(file_info)
@@ -234,6 +684,34 @@ class CommandBar(QWidget):
         except Exception as e:
             self.add_message_to_view(f"Impossible de lire le fichier : {e}", "ai")
     
+    def on_attachment_ready(self, file_info, data):
+        entry = self.attachment_store.add(file_info, data, file_info.get('path'), file_info.get('image_hash'),
+                                          file_info.get('pixel_digest'))
+        file_info['data'] = entry['data']
+        file_info['key'] = entry['key']
+        file_info['pending'] = False
+        if report := file_info.get('compaction'):
+            self.compaction_reports.append(report)
+            if report['dropped']:
+                # Contenu retiré, pas seulement sa mise en forme : l'utilisateur doit le savoir avant d'envoyer
+                self.add_message_to_view(f"{escape_html(file_info['name'])} sera envoyé raccourci : "
+                                         f"{escape_html(', '.join(report['dropped']))} "
+                                         f"(~{report['original_tokens']} -> ~{report['tokens']} tokens).", "ai", persist=False)
+        if summary := file_info.get('summary'):
+            # Fichiers hors budget, doublons ou raccourcis : visible avant que la réponse n'arrive
+            self.add_message_to_view(f"Dossier {escape_html(file_info['name'])} : {escape_html(summary)}", "ai", persist=False)
+        self.set_status("loading", "")
+        self.dispatch_next_request()
+
+    def on_attachment_failed(self, file_info, error_text):
+        file_info['pending'] = False
+        self.set_status("loading", "")
+        self.add_message_to_view(f"Impossible de lire le fichier : {error_text}", "ai")
+        self.dispatch_next_request()
+
+    def on_attachment_progress(self, file_info, percent):
+        self.set_status("loading", f"Lecture de {file_info['name']} : {percent}%" if percent < 100 else "")
+
     def open_file_dialog(self):
         file_paths, _ = QFileDialog.getOpenFileNames(self, "Sélectionner un ou plusieurs fichiers")
         if file_paths:
@@ -255,160 +733,596 @@ class CommandBar(QWidget):
         if not self.files_to_send:
             self.input_field.setPlaceholderText("Poser une question à Gemini...")
             
-    def add_message_to_view(self, text, role):
-        bubble = QWidget()
-        bubble.setObjectName("bubble_widget")
-        bubble.setProperty("role", role)
-        bubble.setMaximumWidth(self.width() * 0.80)
-        bubble_layout = QVBoxLayout(bubble)
-        bubble_layout.setContentsMargins(12, 12, 12, 12)
-        message_browser = QTextBrowser()
-        message_browser.setHtml(text)
-        message_browser.setReadOnly(True)
-        message_browser.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        message_browser.document().documentLayout().documentSizeChanged.connect(lambda size: message_browser.setFixedHeight(int(size.height())))
-        bubble_layout.addWidget(message_browser)
-        if role == 'user':
-            self.scroll_layout.addWidget(bubble, alignment=Qt.AlignmentFlag.AlignRight)
-        else:
-            self.scroll_layout.addWidget(bubble, alignment=Qt.AlignmentFlag.AlignLeft)
-        QTimer.singleShot(100, lambda: self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum()))
-        return message_browser
+    def add_message_to_view(self, text, role, persist=True):
+        return self.show_message(ChatMessage(role, text=text), persist)
+
+    def show_message(self, message, persist=True):
+        # persist=False : message de service (/stats...) qui n'est pas enregistré avec la conversation
+        if persist:
+            self.unsaved_messages.append(message)
+        return self.chat_view.add_message(message)
+
+    def timing_span(self, stage):
+        timings = self.active_timings()
+        return timings.span(stage) if timings is not None else nullcontext()
+
+    def active_timings(self):
+        return self.request_timings if self.request_timings is not None else self.render_timings
 
     def add_code_block(self, raw_code, lang):
-        container = QWidget()
-        container.setObjectName("code_container")
-        container.setMaximumWidth(self.width() * 0.85)
-        container_layout = QVBoxLayout(container)
-        container_layout.setSpacing(0)
-        top_bar_layout = QHBoxLayout()
-        lang_label = QLabel(lang if lang else "code")
-        lang_label.setObjectName("language_label")
-        copy_btn = QPushButton("Copier")
-        copy_btn.setObjectName("copy_btn")
-        copy_btn.setCursor(Qt.CursorShape.PointingHandCursor)
-        copy_btn.clicked.connect(lambda: self.copy_to_clipboard(raw_code, copy_btn))
-        top_bar_layout.addWidget(lang_label)
-        top_bar_layout.addStretch()
-        top_bar_layout.addWidget(copy_btn)
-        formatter_callable = lambda **kwargs: HtmlFormatter(style='monokai', nobackground=True, noclasses=True)
-        html_code = markdown.markdown(
-            f"```{lang}\n{raw_code}\n```",
-            extensions=['fenced_code', 'codehilite'],
-            extension_configs={'codehilite': {'pygments_formatter': formatter_callable}}
-        )
-        code_browser = QTextBrowser()
-        code_browser.setHtml(html_code)
-        code_browser.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
-        code_browser.document().documentLayout().documentSizeChanged.connect(lambda size: code_browser.setFixedHeight(int(size.height())))
-        container_layout.addLayout(top_bar_layout)
-        container_layout.addWidget(code_browser)
-        self.scroll_layout.addWidget(container, alignment=Qt.AlignmentFlag.AlignLeft)
-        QTimer.singleShot(50, lambda: self.scroll_area.verticalScrollBar().setValue(self.scroll_area.verticalScrollBar().maximum()))
-
-    def copy_to_clipboard(self, text, button):
-        QApplication.clipboard().setText(text)
-        original_text = button.text()
-        button.setText("Copié !")
-        QTimer.singleShot(1200, lambda: button.setText(original_text))
-
-    def on_gemini_result(self, response_text):
-        self.is_processing = False # S'assurer que le traitement est marqué comme terminé
-        code_pattern = re.compile(r"```(\w*)\n([\s\S]*?)```")
-        last_index = 0
-        text_parts = []
-        for match in code_pattern.finditer(response_text):
-            text_part = response_text[last_index:match.start()].strip()
-            if text_part:
-                text_parts.append(text_part)
-            lang = match.group(1)
-            raw_code = match.group(2)
-            self.add_code_block(raw_code, lang)
-            last_index = match.end()
-        remaining_text = response_text[last_index:].strip()
-        if remaining_text:
-            text_parts.append(remaining_text)
-        if text_parts:
-            full_text = "\n\n".join(text_parts)
-            ai_browser = self.add_message_to_view("", "ai")
-            self.streamer = BlockStreamer(ai_browser, full_text)
-            # On ne met is_processing à False qu'à la fin du stream
-            self.streamer.stream_finished.connect(lambda: setattr(self, 'is_processing', False))
+        # La bulle apparaît tout de suite à sa place, la coloration arrive du RenderWorker
+        message = self.show_message(ChatMessage('ai', 'code', raw_code=raw_code, lang=lang))
+        timings = self.active_timings()
+        if timings is not None:
+            timings.hold()
+            self.code_timings[message.id] = timings
+        self.chat_view.chat_delegate.request_render(message, None)
+        return message
+
+    def on_code_block_ready(self, message, worker_ms):
+        if timings := self.code_timings.pop(message.id, None):
+            timings.add("highlight", worker_ms)
+            timings.release()
+
+    def start_ai_message(self, markdown_text=""):
+        # Bulle IA dont le document est rempli au fil de l'eau par un BlockStreamer
+        message = self.add_message_to_view("", "ai")
+        message.is_markdown = True
+        message.live_document = self.chat_view.chat_delegate.create_document()
+        timings = self.active_timings()
+        streamer = BlockStreamer(message.live_document, markdown_text, self, timings, self.render_pipeline)
+        streamer.updated.connect(lambda: self.chat_view.message_changed(message))
+        if timings is not None:
+            # Les durées de la demande ne sont journalisées qu'une fois son rendu terminé
+            timings.hold()
+        def on_stream_finished():
+            message.text = streamer.markdown_source()
+        def on_rendered():
+            self.chat_view.chat_delegate.adopt(message)
+            if timings is not None:
+                timings.release()
+        streamer.stream_finished.connect(on_stream_finished)
+        streamer.rendered.connect(on_rendered)
+        return streamer
+
+    def on_gemini_result(self, response_text, instant=False):
+        with self.timing_span("parse"):
+            self.render_result(response_text, instant)
+
+    def render_result(self, response_text, instant):
+        self.mark_first_paint()
+        self.finish_pending_render()
+        self.render_timings = self.request_timings
+        if self.render_timings is not None:
+            # Gardées ouvertes jusqu'au dernier segment, affiché bien après la fin de la demande
+            self.render_timings.hold()
+        parser = FenceParser()
+        self.render_queue.extend(parser.feed(response_text) + parser.finish())
+        self.render_next_segment(instant)
+
+    def render_next_segment(self, instant=False):
+        # Un bloc de code n'apparaît qu'une fois la prose qui le précède entièrement affichée
+        while self.render_queue:
+            segment = self.render_queue.popleft()
+            if segment[0] == 'code':
+                self.add_code_block(segment[1], segment[2])
+                continue
+            text = segment[1].strip()
+            if not text:
+                continue
+            if instant:
+                self.streamer = self.start_ai_message()
+                self.streamer.feed(text)
+                self.streamer.finish()
+                continue
+            self.streamer = self.start_ai_message(text)
+            self.streamer.stream_finished.connect(self.render_next_segment)
             self.streamer.start()
+            return
+        self.streamer = None
+        if self.render_timings is not None:
+            self.render_timings.release()
+            self.render_timings = None
+
+    def finish_pending_render(self):
+        # Réponse précédente encore animée : elle est terminée d'un coup avant d'afficher la suite
+        streamer = self.streamer
+        if streamer is not None:
+            streamer.stream_finished.disconnect(self.render_next_segment)
+            streamer.finish()
+            self.render_next_segment(instant=True)
+
+    def is_current(self, request_id):
+        # Les signaux d'une demande annulée peuvent arriver après coup : ils sont ignorés
+        return self.is_processing and request_id == self.active_request_id
+
+    def on_worker_chunk(self, request_id, chunk):
+        if self.is_current(request_id):
+            self.on_gemini_chunk(chunk)
+
+    def on_worker_finished(self, request_id, response_text):
+        if not self.is_current(request_id):
+            return
+        self.save_turn(response_text)
+        if self.streaming:
+            self.on_gemini_stream_finished(response_text)
+        else:
+            self.on_gemini_result(response_text)
+        self.on_request_done()
+
+    def on_worker_error(self, request_id, error_text):
+        if self.is_current(request_id):
+            self.on_gemini_error(error_text)
+            self.on_request_done()
+
+    def on_worker_cached_result(self, request_id, response_text):
+        if self.is_current(request_id):
+            self.save_turn(response_text)
+            self.on_cached_result(response_text)
+
+    def on_worker_throttled(self, request_id, status):
+        # Limite de débit ou attente avant un nouvel essai : la demande reste en cours
+        if self.is_current(request_id):
+            self.set_status("throttle", status)
+
+    def on_worker_fan_out(self, request_id, results):
+        if not self.is_current(request_id):
+            return
+        for model_name, result in results:
+            self.add_message_to_view(f"<b>{model_name.removeprefix('models/')}</b>", "ai")
+            if isinstance(result, str):
+                self.on_gemini_result(result, instant=True)
+            else:
+                self.add_message_to_view(f"<i>Erreur : {escape_html(str(result))}</i>", "ai")
+        # Seule la réponse du modèle principal fait partie de l'historique
+        if isinstance(results[0][1], str):
+            self.save_turn(results[0][1])
         else:
-            # S'il n'y a que des blocs de code, is_processing doit être False aussi
-            self.is_processing = False
+            # Comme on_gemini_error : le backend n'a pas gardé ce tour, ses pièces jointes devront être renvoyées
+            self.attachment_store.forget_turn(self.turn_index)
+        self.on_request_done()
+
+    def on_cached_result(self, response_text):
+        self.on_gemini_result(response_text, instant=True)
+        self.on_request_done()
+
+    def on_gemini_chunk(self, chunk):
+        with self.timing_span("parse"):
+            self.render_stream_segments(self.stream_parser.feed(chunk))
+
+    def on_gemini_stream_finished(self, response_text):
+        with self.timing_span("parse"):
+            self.flush_stream_buffer()
+        self.end_stream_prose()
+
+    def flush_stream_buffer(self):
+        # Fin du flux : texte retenu par le parseur et bloc de code jamais refermé
+        self.render_stream_segments(self.stream_parser.finish())
+
+    def render_stream_segments(self, segments):
+        # Prose et blocs de code complets, dans l'ordre où ils sont arrivés
+        for segment in segments:
+            if segment[0] == 'prose':
+                self.stream_prose(segment[1])
+            else:
+                self.end_stream_prose()
+                self.mark_first_paint()
+                self.add_code_block(segment[1], segment[2])
+
+    def stream_prose(self, text):
+        if self.stream_streamer is None:
+            if not text.strip():
+                return
+            self.stream_streamer = self.start_ai_message()
+            text = text.lstrip()
+        self.mark_first_paint()
+        self.stream_streamer.feed(text)
+
+    def end_stream_prose(self):
+        if self.stream_streamer is not None:
+            self.stream_streamer.finish()
+            self.stream_streamer = None
+
+    def mark_first_paint(self):
+        # Temps entre l'envoi de la demande et le premier contenu visible
+        if self.request_started_at is not None:
+            self.last_ttft_ms = (time.perf_counter() - self.request_started_at) * 1000
+            self.request_started_at = None
+            if self.request_timings is not None:
+                self.request_timings.add("first_paint", self.last_ttft_ms)
 
     def process_input(self):
         demande = self.input_field.text().strip()
         if demande.lower() == "exit":
             QApplication.quit()
             return
-        if self.is_processing or (not demande and not self.files_to_send):
+        if demande.lower() == STATS_COMMAND:
+            # Durées par étape (p50/p95) des demandes de la session
+            if not self.chat_view.isVisible():
+                self.animate_window_expansion()
+            self.add_message_to_view(self.timing_log.report_html() + self.hedge_report_html() + self.retry_report_html()
+                                     + self.cache_report_html() + self.compaction_report_html(), "ai", persist=False)
+            self.input_field.clear()
+            return
+        if demande.lower() in (CONVERSATIONS_COMMAND, SEARCH_COMMAND) or \
+                demande.lower().startswith((RESUME_COMMAND, SEARCH_COMMAND + " ")):
+            # "/conversations" liste les dernières conversations, "/resume 2" reprend la deuxième,
+            # "/resume #12" la conversation n°12 et "/search nginx" cherche dans toutes les conversations
+            if not self.chat_view.isVisible():
+                self.animate_window_expansion()
+            self.input_field.clear()
+            if demande.lower() == CONVERSATIONS_COMMAND:
+                self.add_message_to_view(self.conversations_html(), "ai", persist=False)
+            elif demande.lower().startswith(SEARCH_COMMAND):
+                self.add_message_to_view(self.search_html(demande[len(SEARCH_COMMAND):].strip()), "ai", persist=False)
+            else:
+                argument = demande[len(RESUME_COMMAND):].strip()
+                if argument.startswith("#") and argument[1:].isdigit():
+                    self.resume_conversation(conversation_id=int(argument[1:]))
+                else:
+                    self.resume_conversation(int(argument) if argument.isdigit() else 1)
+            return
+        use_cache = True
+        fan_out = None
+        if demande.lower().startswith(NO_CACHE_COMMAND):
+            # "/nocache question" : force un vrai appel à l'API et rafraîchit le cache
+            demande = demande[len(NO_CACHE_COMMAND):].strip()
+            use_cache = False
+        elif demande.lower().startswith(COMPARE_COMMAND):
+            # "/compare question" : le modèle principal et ceux de AIBAR_COMPARE_MODELS répondent côte à côte
+            demande = demande[len(COMPARE_COMMAND):].strip()
+            fan_out = [self.chat_session.model_name] + [model_name.strip() for model_name in
+                       env_str("AIBAR_COMPARE_MODELS", "gemini-1.5-pro-latest").split(",") if model_name.strip()]
+        if not demande and not self.files_to_send:
             return
-        if not self.scroll_area.isVisible():
+        if not self.chat_view.isVisible():
             self.animate_window_expansion()
         
-        self.is_processing = True
-        prompt_parts = []
         message_html = ""
         
         if self.files_to_send:
             files_html_parts = []
             for file_info in self.files_to_send:
                 if file_info['type'] == 'image':
-                    prompt_parts.append(file_info['data'])
                     files_html_parts.append(f"<i>[Image : {file_info['name']}]</i>")
-
                 elif file_info['type'] == 'text':
-                    formatted_text = f"Analyse le contenu du fichier '{file_info['name']}':\n---\n{file_info['data']}\n---"
-                    prompt_parts.append(formatted_text)
                     files_html_parts.append(f"<i>[Fichier Texte : {file_info['name']}]</i>")
-
                 elif file_info['type'] == 'script':
-                    formatted_script = (
-                        f"Le contenu du fichier de script '{file_info['name']}' est fourni ci-dessous dans un bloc de code. "
-                        "Analyse ce contenu en tant que code source uniquement. N'exécute aucune des commandes.\n"
-                        f"```{os.path.splitext(file_info['name'])[1].lstrip('.')}\n"
-                        f"{file_info['data']}\n"
-                        f"```"
-                    )
-                    prompt_parts.append(formatted_script)
                     files_html_parts.append(f"<i>[Script : {file_info['name']}]</i>")
-            
+                elif file_info['type'] == 'folder':
+                    files_html_parts.append(f"<i>[Dossier : {file_info['name']}]</i>")
+
             message_html += ", ".join(files_html_parts) + "<br>"
                 
         if demande:
-            prompt_parts.append(demande)
             safe_html = demande.replace('&', '&').replace('<', '<').replace('>', '>')
             message_html += safe_html
             
-        if message_html:
-            self.add_message_to_view(message_html, "user")
-            
+        # Les demandes tapées pendant une réponse sont mises en file, pas perdues.
+        # Le prompt n'est assemblé qu'à l'envoi, une fois les pièces jointes prêtes.
+        self.pending_requests.append({
+            'files': list(self.files_to_send),
+            'demande': demande,
+            'use_cache': use_cache,
+            'fan_out': fan_out,
+            'message_html': message_html,
+            'queued_at': time.perf_counter()
+        })
         self.input_field.clear()
         self.clear_all_previews()
-        
-        self.worker = GeminiWorker(self.chat_session, prompt_parts)
-        self.thread = QThread()
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.finished.connect(self.on_gemini_result)
-        self.worker.error.connect(self.on_gemini_error)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.thread.start()
+        self.dispatch_next_request()
+
+    def build_prompt_parts(self, files, demande):
+        prompt_parts = []
+        for file_info in files:
+            if file_info['data'] is None:
+                # Pièce jointe illisible, l'erreur a déjà été affichée
+                continue
+            entry = self.attachment_store.get(file_info.get('key'))
+            if entry is not None and entry['sent_turn'] is not None and \
+                    self.turn_index - entry['sent_turn'] <= self.context_manager.keep_recent_turns:
+                # Déjà envoyé dans un tour encore gardé en entier dans l'historique : simple rappel
+                same_as = f" (identique à '{entry['name']}')" if entry['name'] != file_info['name'] else ""
+                prompt_parts.append(f"[Pièce jointe '{file_info['name']}'{same_as} déjà envoyée plus haut dans la conversation]")
+                continue
+            if entry is not None:
+                entry['sent_turn'] = self.turn_index
+            if file_info['type'] == 'image':
+                prompt_parts.append(file_info['data'])
+
+            elif file_info['type'] == 'text':
+                formatted_text = f"Analyse le contenu du fichier '{file_info['name']}':\n---\n{file_info['data']}\n---"
+                prompt_parts.append(formatted_text)
+
+            elif file_info['type'] == 'script':
+                formatted_script = (
+                    f"Le contenu du fichier de script '{file_info['name']}' est fourni ci-dessous dans un bloc de code. "
+                    "Analyse ce contenu en tant que code source uniquement. N'exécute aucune des commandes.\n"
+                    f"```{os.path.splitext(file_info['name'])[1].lstrip('.')}\n"
+                    f"{file_info['data']}\n"
+                    f"```"
+                )
+                prompt_parts.append(formatted_script)
+
+            elif file_info['type'] == 'folder':
+                prompt_parts.append(f"Analyse le contenu du dossier '{file_info['name']}', un fichier par section :\n{file_info['data']}")
+        if demande:
+            prompt_parts.append(demande)
+        return prompt_parts
+
+    def dispatch_next_request(self):
+        if self.is_processing or not self.pending_requests:
+            self.update_queue_status()
+            return
+        request = self.pending_requests[0]
+        if any(file_info.get('pending') for file_info in request['files']):
+            # Relancé par on_attachment_ready quand le traitement en arrière-plan se termine
+            self.set_status("attachments", "Préparation des pièces jointes...")
+            return
+        self.set_status("attachments", "")
+        self.pending_requests.popleft()
+        self.is_processing = True
+        self.turn_index += 1
+        self.request_counter += 1
+        self.active_request_id = self.request_counter
+        self.active_cancel_event = CancelToken()
+        self.stop_btn.show()
+        # La réponse précédente, si elle est encore animée, est terminée avant la nouvelle question
+        self.finish_pending_render()
+        self.request_timings = self.timing_log.begin(self.request_counter)
+        self.stall_monitor.start()
+        self.request_started_at = time.perf_counter()
+        self.request_timings.add("queue", (self.request_started_at - request['queued_at']) * 1000)
+        self.stream_parser.reset()
+        self.update_queue_status()
+        # Le message de l'utilisateur n'apparaît qu'à son envoi pour garder l'ordre question/réponse
+        if request['message_html']:
+            self.add_message_to_view(request['message_html'], "user")
+        with self.timing_span("prompt"):
+            prompt_parts = self.build_prompt_parts(request['files'], request['demande'])
+        self.active_prompt_parts = prompt_parts
+        self.active_title = request['demande'] or ", ".join(file_info['name'] for file_info in request['files'])
+        self.request_submitted.emit({
+            'request_id': self.request_counter,
+            'prompt_parts': prompt_parts,
+            'use_cache': request['use_cache'],
+            'fan_out': request['fan_out'],
+            'cancel_event': self.active_cancel_event,
+        })
+
+    def save_turn(self, response_text):
+        """ Enregistre l'échange terminé (historique de l'API) puis les bulles déjà affichées. """
+        if self.conversation_store is None or self.active_prompt_parts is None:
+            return
+        try:
+            if self.conversation_id is None:
+                self.conversation_id = self.conversation_store.create_conversation(self.active_title)
+            self.conversation_store.add_turn(self.conversation_id, self.active_prompt_parts, response_text)
+        except Exception as e:
+            print(f"Impossible d'enregistrer la conversation : {e}")
+        self.active_prompt_parts = None
+        self.save_messages()
+
+    def save_messages(self):
+        # Les bulles encore en cours d'affichage seront enregistrées au prochain passage
+        if self.conversation_store is None or self.conversation_id is None:
+            return
+        ready = 0
+        while ready < len(self.unsaved_messages) and self.unsaved_messages[ready].live_document is None:
+            ready += 1
+        if not ready:
+            return
+        try:
+            self.conversation_store.add_messages(self.conversation_id, self.unsaved_messages[:ready])
+        except Exception as e:
+            print(f"Impossible d'enregistrer les messages : {e}")
+        del self.unsaved_messages[:ready]
+
+    def conversations_html(self):
+        if self.conversation_store is None:
+            return "<i>L'enregistrement des conversations est désactivé (AIBAR_CONVERSATION_STORE).</i>"
+        rows = self.conversation_store.recent_conversations()
+        if not rows:
+            return "<i>Aucune conversation enregistrée pour l'instant.</i>"
+        lines = "".join(
+            f"<br>{index}. {escape_html(title)} "
+            f"<i>({turn_count} échange(s), {time.strftime('%d/%m %H:%M', time.localtime(updated_at))})</i>"
+            for index, (_, title, updated_at, turn_count) in enumerate(rows, 1)
+        )
+        return f"<b>Conversations récentes</b> (reprendre avec {RESUME_COMMAND} n){lines}"
+
+    def search_html(self, text):
+        if self.conversation_store is None:
+            return "<i>L'enregistrement des conversations est désactivé (AIBAR_CONVERSATION_STORE).</i>"
+        if not text:
+            return f"<i>Utilisation : {SEARCH_COMMAND} mots à chercher</i>"
+        started = time.perf_counter()
+        try:
+            rows = self.conversation_store.search(text)
+        except Exception as e:
+            return f"<i>Recherche impossible : {e}</i>"
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if not rows:
+            return f"<i>Aucun résultat pour « {escape_html(text)} ».</i>"
+        lines = "".join(
+            f"<br>{index}. <b>{escape_html(title)}</b> <i>({time.strftime('%d/%m %H:%M', time.localtime(updated_at))}, "
+            f"{kind}, {RESUME_COMMAND} #{conversation_id})</i><br>"
+            + escape_html(" ".join(snippet.split())).replace(SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+            for index, (conversation_id, title, updated_at, kind, snippet) in enumerate(rows, 1)
+        )
+        return f"<b>Résultats pour « {escape_html(text)} »</b> ({len(rows)} en {elapsed_ms:.1f} ms){lines}"
+
+    def resume_conversation(self, index=1, conversation_id=None):
+        if self.conversation_store is None:
+            row = None
+        elif conversation_id is not None:
+            row = self.conversation_store.conversation(conversation_id)
+        else:
+            rows = self.conversation_store.recent_conversations()
+            row = rows[index - 1] if 1 <= index <= len(rows) else None
+        if row is None:
+            number = f"#{conversation_id}" if conversation_id is not None else f"n°{index}"
+            self.add_message_to_view(f"<i>Aucune conversation {number}, voir {CONVERSATIONS_COMMAND}.</i>", "ai", persist=False)
+            return
+        conversation_id, _, _, turn_count = row
+        self.pending_requests.clear()
+        self.cancel_current_request(keep_partial=False)
+        self.update_queue_status()
+        self.clear_chat_view()
+        # Historique complet pour l'API (relu par le worker), mais seules les dernières bulles sont affichées
+        self.conversation_resumed.emit(conversation_id)
+        self.conversation_id = conversation_id
+        self.attachment_store.clear()
+        self.turn_index = turn_count
+        self.context_manager.context_tokens = 0
+        self.context_manager.tokens_saved = 0
+        self.set_status("context", "")
+        self.has_older_messages = True
+        self.oldest_loaded_position = None
+        self.load_older_messages()
+        self.chat_view.scroll_to_bottom_later()
+
+    def load_older_messages(self):
+        # Appelé à l'ouverture d'une conversation reprise, puis chaque fois que le haut du fil est atteint
+        if not self.has_older_messages:
+            return
+        page_size = env_int("AIBAR_RESUME_MESSAGES", 12)
+        rows = self.conversation_store.load_messages(self.conversation_id, self.oldest_loaded_position, page_size)
+        self.has_older_messages = len(rows) == page_size
+        if not rows:
+            return
+        self.oldest_loaded_position = rows[0][0]
+        messages = []
+        for _, role, kind, text, is_markdown, raw_code, lang in rows:
+            # Les blocs de code sont colorés par le RenderWorker quand ils deviennent visibles
+            messages.append(ChatMessage(role, kind, text=text, is_markdown=bool(is_markdown), raw_code=raw_code, lang=lang))
+        self.chat_view.prepend_messages(messages)
+
+    def hedge_report_html(self):
+        stats = self.chat_session.stats()
+        if not stats.get('requests'):
+            return ""
+        won = stats['hedge_won']
+        return (f"<br>Relances (hedging) : {stats['hedged']} sur {stats['requests']} demande(s), "
+                f"la relance a répondu en premier {won} fois"
+                + (f" ({won / stats['hedged']:.0%} des relances)" if stats['hedged'] else "") + ".")
+
+    def retry_report_html(self):
+        retries = self.request_scheduler.retry_count
+        return f"<br>Nouveaux essais automatiques (429, erreurs passagères) : {retries}." if retries else ""
+
+    def cache_report_html(self):
+        report = ""
+        if self.response_cache is not None and self.response_cache.hits:
+            cache = self.response_cache
+            report += f"<br>Réponses servies par le cache local : {cache.hits} sur {cache.hits + cache.misses} demande(s)."
+        stats = self.highlight_cache.stats()
+        if stats['hits'] or stats['misses']:
+            report += (f"<br>Cache de coloration : {stats['hits']} hits, {stats['misses']} misses "
+                       f"({stats['hit_rate']:.0%}), {stats['entries']} bloc(s) gardé(s).")
+        return report
+
+    def compaction_report_html(self):
+        if not self.compaction_reports:
+            return ""
+        lines = [f"{escape_html(report['name'])} : {escape_html(compaction_summary(report))}" for report in self.compaction_reports]
+        return "<br>Compactage des fichiers joints (tokens estimés avant -> après) :<br>" + "<br>".join(lines)
+
+    def record_stall(self, timings):
+        # Pire blocage du thread de l'interface entre l'envoi de la demande et la fin de son affichage
+        stall_ms = self.stall_monitor.take(keep_running=self.is_processing)
+        timings.peak("stall", stall_ms)
+
+    def on_stage_timings(self, request_id, stages):
+        if self.request_timings is not None and self.request_timings.request_id == request_id:
+            for stage, ms in stages.items():
+                self.request_timings.add(stage, ms)
+
+    def cancel_current_request(self, keep_partial=True):
+        """ Annule la demande en cours : le worker s'arrête, la requête HTTP est interrompue
+        et tout signal tardif de cette demande est ignoré. """
+        if not self.is_processing:
+            return False
+        self.active_cancel_event.cancel(keep_partial)
+        self.chat_session.cancel()
+        # Le worker ne garde le tour que si une partie de la réponse s'est déjà affichée (voir record_cancelled_turn)
+        if not (keep_partial and self.streaming and self.request_started_at is None):
+            self.attachment_store.forget_turn(self.turn_index)
+        if keep_partial:
+            # La réponse partielle déjà reçue reste affichée
+            self.flush_stream_buffer()
+            self.end_stream_prose()
+            self.add_message_to_view("<i>Génération interrompue.</i>", "ai")
+        else:
+            self.stream_parser.reset()
+            self.end_stream_prose()
+        self.request_started_at = None
+        self.on_request_done()
+        return True
+
+    def stop_generating(self):
+        self.cancel_current_request(keep_partial=True)
+        self.input_field.setFocus()
+
+    def closeEvent(self, event):
+        # Barre fermée (Échap) : plus personne ne lira les réponses en cours ou en attente
+        self.pending_requests.clear()
+        self.cancel_current_request(keep_partial=False)
+        self.update_queue_status()
+        super().closeEvent(event)
+
+    def on_request_done(self, *args):
+        self.active_request_id = None
+        self.active_cancel_event = None
+        self.stop_btn.hide()
+        self.set_status("throttle", "")
+        if self.request_timings is not None:
+            self.request_timings.add("total", (time.perf_counter() - self.request_timings.started_at) * 1000)
+            self.request_timings.release()
+            self.request_timings = None
+        self.is_processing = False
+        self.dispatch_next_request()
+
+    def on_context_updated(self, context_tokens, tokens_saved):
+        status = f"Contexte : ~{format_tokens(context_tokens)} tokens"
+        if tokens_saved:
+            status += f" ({format_tokens(tokens_saved)} économisés)"
+        self.set_status("context", status)
+
+    def update_queue_status(self):
+        queue_depth = len(self.pending_requests)
+        self.set_status("queue", f"{queue_depth} demande(s) en attente" if queue_depth else "")
         
     def on_gemini_error(self, error_text):
+        self.flush_stream_buffer()
+        self.end_stream_prose()
         self.add_message_to_view(f"<i>Erreur : {error_text}</i>", "ai")
-        self.is_processing = False
+        # Le tour en échec n'est pas dans l'historique : ses pièces jointes devront être renvoyées
+        self.attachment_store.forget_turn(self.turn_index)
     
+    def on_about_to_quit(self):
+        if self.active_cancel_event is not None:
+            # Sans ça, la fermeture attendrait la fin de la réponse en cours
+            self.active_cancel_event.cancel(keep_partial=False)
+            self.chat_session.cancel()
+        self.worker_thread.quit()
+        self.worker_thread.wait(2000)
+        self.chat_session.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+        if self.conversation_store is not None:
+            self.finish_pending_render()
+            self.save_messages()
+            self.conversation_store.close()
+        self.render_pipeline.stop()
+        self.highlight_cache.save()
+
     def clear_chat_view(self):
-        while self.scroll_layout.count():
-            item_to_remove = self.scroll_layout.takeAt(0)
-            if widget := item_to_remove.widget():
-                widget.deleteLater()
+        # La réponse encore animée est terminée d'un coup pour être enregistrée en entier
+        self.finish_pending_render()
+        self.save_messages()
+        self.unsaved_messages.clear()
+        self.chat_view.clear_messages()
                 
     def clear_all_previews(self):
         while self.file_previews_layout.count():
@@ -418,12 +1332,38 @@ class CommandBar(QWidget):
         self.files_to_send.clear()
         self.input_field.setPlaceholderText("Poser une question à Gemini...")
 
+    def prewarm(self):
+        # Prépare fenêtre native, style, mise en page et rendu HTML sans afficher la barre,
+        # pour que le premier show_and_focus coûte autant que les suivants.
+        self.ensurePolished()
+        for child in self.findChildren(QWidget):
+            child.ensurePolished()
+        self.winId()
+        self.main_layout.activate()
+        warmup_document = QTextDocument()
+        warmup_document.setHtml(markdown.markdown("**AIBar**"))
+        warmup_document.size()
+
     def show_and_focus(self):
+        # Nouvelle conversation : la réponse en cours et les demandes en file appartiennent à l'ancienne
+        self.pending_requests.clear()
+        self.cancel_current_request(keep_partial=False)
+        self.update_queue_status()
         self.clear_chat_view()
         self.clear_all_previews() 
         if self.chat_session:
-            self.chat_session.history.clear()
-        self.scroll_area.hide()
+            self.history_replaced.emit([])
+            # Ouvre la connexion au backend pendant que l'utilisateur tape sa question
+            self.chat_session.warm_up()
+        self.attachment_store.clear()
+        # Nouvelle conversation : elle ne sera enregistrée qu'au premier échange
+        self.conversation_id = None
+        self.has_older_messages = False
+        self.turn_index = 0
+        self.context_manager.context_tokens = 0
+        self.context_manager.tokens_saved = 0
+        self.set_status("context", "")
+        self.chat_view.hide()
         screen_geometry = QApplication.primaryScreen().geometry()
         self.setGeometry(int((screen_geometry.width() - 700) / 2), int((screen_geometry.height() - 80) / 4), 700, 80)
         self.setMaximumHeight(800)
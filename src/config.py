@@ -0,0 +1,35 @@
+# src/config.py
+# Owner TMCooper
+
+import os
+
+# Les options sont lues au moment de l'utilisation (et non à l'import)
+# pour que les valeurs chargées depuis le .env par load_dotenv soient prises en compte.
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on", "oui")
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def env_str(name, default=""):
+    value = os.environ.get(name)
+    return value.strip() if value and value.strip() else default
+
+def data_path(*parts):
+    # Dossier des données locales d'AIBar (caches, historiques, journaux)
+    base_dir = env_str("AIBAR_DATA_DIR", os.path.join(os.path.expanduser("~"), ".aibar"))
+    os.makedirs(base_dir, exist_ok=True)
+    return os.path.join(base_dir, *parts)
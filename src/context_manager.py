@@ -0,0 +1,143 @@
+# src/context_manager.py
+# Owner TMCooper
+
+import io
+import re
+import math
+from PIL import Image
+
+CHARS_PER_TOKEN = 4
+IMAGE_TILE_TOKENS = 258
+IMAGE_TILE_SIZE = 768
+ATTACHMENT_STUB_MIN_CHARS = 2000
+SUMMARY_PREFIX = "[Résumé des échanges précédents retirés du contexte]"
+MAX_SUMMARY_LINES = 10
+ATTACHMENT_NAME_PATTERN = re.compile(r"^(?:Analyse le contenu du (?:fichier|dossier)|Le contenu du fichier de script) '([^']+)'")
+IMAGE_STUB_TEXT = "[Image jointe précédemment, retirée du contexte]"
+
+def estimate_text_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def attachment_name(text):
+    """ Nom du fichier si ce texte est le contenu d'une pièce jointe assez longue pour être remplacée par un rappel. """
+    if len(text) >= ATTACHMENT_STUB_MIN_CHARS and (match := ATTACHMENT_NAME_PATTERN.match(text)):
+        return match.group(1)
+    return None
+
+def file_stub_text(name, tokens):
+    return f"[Contenu du fichier '{name}' déjà envoyé, retiré du contexte (~{tokens} tokens)]"
+
+def estimate_image_tokens(data):
+    # Gemini compte environ 258 tokens par tuile de 768x768
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+    except Exception:
+        return IMAGE_TILE_TOKENS
+    if width <= 384 and height <= 384:
+        return IMAGE_TILE_TOKENS
+    return IMAGE_TILE_TOKENS * math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+
+def estimate_prompt_tokens(prompt_parts):
+    tokens = 0
+    for part in prompt_parts:
+        if isinstance(part, str):
+            tokens += estimate_text_tokens(part)
+        elif isinstance(part, dict) and 'data' in part:
+            tokens += estimate_image_tokens(part['data'])
+    return tokens
+
+def part_tokens(part):
+    if "inline_data" in part:
+        return estimate_image_tokens(part.inline_data.data)
+    return estimate_text_tokens(part.text)
+
+def content_tokens(content):
+    return sum(part_tokens(part) for part in content.parts)
+
+
+class ContextManager:
+    """ Garde l'historique du chat sous un budget de tokens : les pièces jointes des anciens tours
+    sont remplacées par un court rappel, puis les plus vieux échanges sont résumés en une ligne. """
+    def __init__(self, max_tokens=32000, keep_recent_turns=2):
+        self.max_tokens = max_tokens
+        self.keep_recent_turns = keep_recent_turns
+        self.context_tokens = 0
+        self.tokens_saved = 0
+
+    def apply(self, chat_session, prompt_parts):
+        history = list(chat_session.history)
+        compacted, before, after = self.compact(history, estimate_prompt_tokens(prompt_parts))
+        if compacted is not history:
+            chat_session.history = compacted
+            self.tokens_saved += before - after
+        self.context_tokens = after + estimate_prompt_tokens(prompt_parts)
+        return self.context_tokens
+
+    def compact(self, history, pending_tokens=0):
+        before = sum(content_tokens(content) for content in history)
+        # Les pièces jointes des keep_recent_turns derniers tours restent intactes
+        user_indexes = [i for i, content in enumerate(history) if content.role == "user"]
+        recent_turns = user_indexes[-self.keep_recent_turns:] if self.keep_recent_turns > 0 else []
+        protected_from = recent_turns[0] if recent_turns else len(history)
+
+        compacted = []
+        changed = False
+        for i, content in enumerate(history):
+            if i < protected_from and content.role == "user":
+                stubbed = self.stub_attachments(content)
+                changed = changed or stubbed is not content
+                compacted.append(stubbed)
+            else:
+                compacted.append(content)
+
+        total = sum(content_tokens(content) for content in compacted)
+        if total + pending_tokens > self.max_tokens:
+            compacted, dropped = self.drop_oldest_turns(compacted, total + pending_tokens)
+            changed = changed or dropped
+            total = sum(content_tokens(content) for content in compacted)
+
+        return (compacted if changed else history), before, total
+
+    def stub_attachments(self, content):
+        new_parts = []
+        changed = False
+        for part in content.parts:
+            if "inline_data" in part:
+                new_parts.append(type(part)(text=IMAGE_STUB_TEXT))
+                changed = True
+            elif name := attachment_name(part.text):
+                new_parts.append(type(part)(text=file_stub_text(name, estimate_text_tokens(part.text))))
+                changed = True
+            else:
+                new_parts.append(part)
+        if not changed:
+            return content
+        return type(content)(role=content.role, parts=new_parts)
+
+    def drop_oldest_turns(self, history, total):
+        summary_lines = []
+        if history and history[0].role == "user" and history[0].parts and history[0].parts[0].text.startswith(SUMMARY_PREFIX):
+            summary_lines = history[0].parts[0].text.splitlines()[1:]
+            total -= content_tokens(history[0]) + (content_tokens(history[1]) if len(history) > 1 else 0)
+            history = history[2:]
+
+        dropped = False
+        minimum_kept = 2 * max(1, self.keep_recent_turns)
+        while total > self.max_tokens and len(history) > minimum_kept:
+            user_turn, model_turn = history[0], history[1]
+            # La question de l'utilisateur est la dernière partie texte du tour
+            question = next((part.text for part in reversed(user_turn.parts) if part.text and not part.text.startswith("[")), "")
+            summary_lines.append("- " + " ".join(question.split())[:80])
+            total -= content_tokens(user_turn) + content_tokens(model_turn)
+            history = history[2:]
+            dropped = True
+
+        if not summary_lines or not history:
+            return history, dropped
+        content_type, part_type = type(history[0]), type(history[0].parts[0])
+        summary_text = "\n".join([SUMMARY_PREFIX] + summary_lines[-MAX_SUMMARY_LINES:])
+        summary = [
+            content_type(role="user", parts=[part_type(text=summary_text)]),
+            content_type(role="model", parts=[part_type(text="D'accord, je garde ce contexte en tête.")]),
+        ]
+        return summary + history, True
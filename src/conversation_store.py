@@ -0,0 +1,231 @@
+# src/conversation_store.py
+# Owner TMCooper
+
+import re
+import json
+import time
+import sqlite3
+from contextlib import closing
+
+from src.attachment_store import content_hash
+from src.context_manager import IMAGE_STUB_TEXT, attachment_name, file_stub_text, estimate_text_tokens
+
+# Marques de début et de fin des mots trouvés dans les extraits, remplacées par du HTML après échappement
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+def fts_query(text):
+    """ Requête FTS5 sûre à partir du texte tapé : chaque mot entre guillemets (tous requis),
+    le dernier en préfixe pour trouver "ngin" pendant la frappe. """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+
+
+class ConversationStore:
+    """ Conversations enregistrées dans SQLite : l'historique envoyé à l'API (un enregistrement par message,
+    pièces jointes rangées à part et dédupliquées) et les bulles affichées, relues page par page. """
+    def __init__(self, path, max_conversations=100):
+        self.path = path
+        self.max_conversations = max_conversations
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            # WAL : chaque tour est écrit sans attendre une synchronisation complète du fichier
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            index_exists = self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'search_index'").fetchone() is not None
+            self.connection.executescript(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id INTEGER PRIMARY KEY, title TEXT, created_at REAL, updated_at REAL, turn_count INTEGER DEFAULT 0);"
+                "CREATE TABLE IF NOT EXISTS turns ("
+                "conversation_id INTEGER, position INTEGER, role TEXT, parts TEXT, PRIMARY KEY (conversation_id, position));"
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "conversation_id INTEGER, position INTEGER, role TEXT, kind TEXT, text TEXT, is_markdown INTEGER, "
+                "raw_code TEXT, lang TEXT, PRIMARY KEY (conversation_id, position));"
+                "CREATE TABLE IF NOT EXISTS attachments (key TEXT PRIMARY KEY, mime_type TEXT, data BLOB);"
+                "CREATE TABLE IF NOT EXISTS attachment_refs (conversation_id INTEGER, key TEXT);"
+                "CREATE INDEX IF NOT EXISTS attachment_refs_key ON attachment_refs (key);"
+                # Index plein texte des questions, réponses et fichiers joints (accents ignorés)
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                "conversation_id UNINDEXED, position UNINDEXED, kind UNINDEXED, content, "
+                "tokenize = 'unicode61 remove_diacritics 2');"
+            )
+            if not index_exists:
+                self.rebuild_search_index()
+            self.connection.commit()
+        return self.connection
+
+    def create_conversation(self, title):
+        connection = self.connect()
+        now = time.time()
+        conversation_id = connection.execute(
+            "INSERT INTO conversations (title, created_at, updated_at) VALUES (?, ?, ?)",
+            (" ".join(title.split())[:80], now, now)
+        ).lastrowid
+        self.prune()
+        connection.commit()
+        return conversation_id
+
+    def store_part(self, conversation_id, part):
+        # Les images et le contenu des fichiers joints sont rangés à part, une seule fois par contenu
+        if isinstance(part, dict) and 'data' in part:
+            key = content_hash(part)
+            self.store_attachment(conversation_id, key, part.get('mime_type', ''), part['data'])
+            return {'attachment': key, 'mime_type': part.get('mime_type', '')}
+        text = part if isinstance(part, str) else str(part)
+        if name := attachment_name(text):
+            key = content_hash(text)
+            self.store_attachment(conversation_id, key, "text/plain", text.encode("utf-8"))
+            return {'attachment': key, 'name': name, 'tokens': estimate_text_tokens(text)}
+        return {'text': text}
+
+    def store_attachment(self, conversation_id, key, mime_type, data):
+        connection = self.connect()
+        connection.execute("INSERT OR IGNORE INTO attachments (key, mime_type, data) VALUES (?, ?, ?)", (key, mime_type, data))
+        connection.execute("INSERT INTO attachment_refs (conversation_id, key) VALUES (?, ?)", (conversation_id, key))
+
+    def add_turn(self, conversation_id, prompt_parts, response_text):
+        connection = self.connect()
+        position = connection.execute("SELECT COUNT(*) FROM turns WHERE conversation_id = ?", (conversation_id,)).fetchone()[0]
+        user_parts = [self.store_part(conversation_id, part) for part in prompt_parts]
+        connection.executemany(
+            "INSERT INTO turns (conversation_id, position, role, parts) VALUES (?, ?, ?, ?)",
+            [(conversation_id, position, "user", json.dumps(user_parts, ensure_ascii=False)),
+             (conversation_id, position + 1, "model", json.dumps([{'text': response_text}], ensure_ascii=False))]
+        )
+        self.index_turn(conversation_id, position, prompt_parts, response_text)
+        connection.execute("UPDATE conversations SET updated_at = ?, turn_count = turn_count + 1 WHERE id = ?",
+                            (time.time(), conversation_id))
+        connection.commit()
+
+    def index_turn(self, conversation_id, position, prompt_parts, response_text):
+        # Mis à jour à chaque échange enregistré, dans la même transaction
+        question = []
+        entries = []
+        for part in prompt_parts:
+            if not isinstance(part, str):
+                continue
+            if name := attachment_name(part):
+                entries.append(("fichier", f"{name}\n{part}"))
+            else:
+                question.append(part)
+        if question:
+            entries.append(("question", "\n".join(question)))
+        if response_text:
+            entries.append(("réponse", response_text))
+        self.connect().executemany(
+            "INSERT INTO search_index (conversation_id, position, kind, content) VALUES (?, ?, ?, ?)",
+            [(conversation_id, position, kind, content) for kind, content in entries]
+        )
+
+    def rebuild_search_index(self):
+        # Conversations enregistrées avant l'ajout de l'index
+        connection = self.connect()
+        rows = connection.execute("SELECT conversation_id, position, role, parts FROM turns ORDER BY conversation_id, position").fetchall()
+        for (conversation_id, position, _, user_json), (_, _, _, model_json) in zip(rows[::2], rows[1::2]):
+            prompt_parts = [self.load_attachment(connection, part) if 'name' in part else part.get('text', "")
+                            for part in json.loads(user_json) if 'text' in part or 'name' in part]
+            self.index_turn(conversation_id, position, prompt_parts, json.loads(model_json)[0]['text'])
+
+    def search(self, text, limit=20):
+        """ Meilleurs résultats (bm25) : (conversation, titre, date, type, extrait balisé par SNIPPET_START/END). """
+        query = fts_query(text)
+        if query is None:
+            return []
+        return self.connect().execute(
+            "SELECT search_index.conversation_id, conversations.title, conversations.updated_at, search_index.kind, "
+            "snippet(search_index, 3, ?, ?, '…', 12) FROM search_index "
+            "JOIN conversations ON conversations.id = search_index.conversation_id "
+            "WHERE search_index MATCH ? ORDER BY rank LIMIT ?",
+            (SNIPPET_START, SNIPPET_END, query, limit)
+        ).fetchall()
+
+    def conversation(self, conversation_id):
+        return self.connect().execute(
+            "SELECT id, title, updated_at, turn_count FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+
+    def add_messages(self, conversation_id, messages):
+        connection = self.connect()
+        position = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM messages WHERE conversation_id = ?",
+                                      (conversation_id,)).fetchone()[0]
+        connection.executemany(
+            "INSERT INTO messages (conversation_id, position, role, kind, text, is_markdown, raw_code, lang) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(conversation_id, position + offset, message.role, message.kind, message.text, int(message.is_markdown),
+              message.raw_code, message.lang) for offset, message in enumerate(messages)]
+        )
+        connection.commit()
+
+    def recent_conversations(self, limit=10):
+        return self.connect().execute(
+            "SELECT id, title, updated_at, turn_count FROM conversations WHERE turn_count > 0 "
+            "ORDER BY updated_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+
+    def load_history(self, conversation_id, full_turns=2):
+        """ Historique au format des messages de l'API. Seules les pièces jointes des full_turns derniers
+        tours sont relues, les plus anciennes deviennent le rappel que le gestionnaire de contexte y mettrait.
+        Appelée depuis le thread du worker, avec sa propre connexion (WAL : lecture sans bloquer les écritures). """
+        with closing(sqlite3.connect(self.path)) as connection:
+            rows = connection.execute("SELECT role, parts FROM turns WHERE conversation_id = ? ORDER BY position",
+                                      (conversation_id,)).fetchall()
+            return self.rebuild_history(connection, rows, full_turns)
+
+    def rebuild_history(self, connection, rows, full_turns):
+        user_rows = [index for index, (role, _) in enumerate(rows) if role == "user"]
+        full_from = user_rows[-full_turns:][0] if full_turns > 0 and user_rows else len(rows)
+        history = []
+        for index, (role, parts_json) in enumerate(rows):
+            parts = []
+            for part in json.loads(parts_json):
+                if 'text' in part:
+                    parts.append(part['text'])
+                elif index < full_from:
+                    parts.append(file_stub_text(part['name'], part['tokens']) if 'name' in part else IMAGE_STUB_TEXT)
+                else:
+                    parts.append(self.load_attachment(connection, part))
+            history.append({'role': role, 'parts': parts})
+        return history
+
+    def load_attachment(self, connection, part):
+        row = connection.execute("SELECT mime_type, data FROM attachments WHERE key = ?", (part['attachment'],)).fetchone()
+        if row is None:
+            return IMAGE_STUB_TEXT if 'name' not in part else file_stub_text(part['name'], part['tokens'])
+        if 'name' in part:
+            return row[1].decode("utf-8")
+        return {'mime_type': row[0], 'data': row[1]}
+
+    def load_messages(self, conversation_id, before=None, limit=20):
+        """ Les limit dernières bulles avant la position before, dans l'ordre d'affichage. """
+        rows = self.connect().execute(
+            "SELECT position, role, kind, text, is_markdown, raw_code, lang FROM messages "
+            "WHERE conversation_id = ? AND position < ? ORDER BY position DESC LIMIT ?",
+            (conversation_id, before if before is not None else 2 ** 62, limit)
+        ).fetchall()
+        rows.reverse()
+        return rows
+
+    def prune(self):
+        # Seules les max_conversations plus récentes sont gardées, avec leurs pièces jointes
+        connection = self.connect()
+        old_ids = [row[0] for row in connection.execute(
+            "SELECT id FROM conversations ORDER BY updated_at DESC LIMIT -1 OFFSET ?", (self.max_conversations,)
+        ).fetchall()]
+        if not old_ids:
+            return
+        placeholders = ",".join("?" * len(old_ids))
+        for table, column in (("turns", "conversation_id"), ("messages", "conversation_id"), ("search_index", "conversation_id"),
+                              ("attachment_refs", "conversation_id"), ("conversations", "id")):
+            connection.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", old_ids)
+        connection.execute("DELETE FROM attachments WHERE key NOT IN (SELECT key FROM attachment_refs)")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,106 @@
+# src/fence_parser.py
+# Owner TMCooper
+
+import re
+
+FENCE = "```"
+INFO_PATTERN = re.compile(r"\w*")
+
+class FenceParser:
+    """ Découpe au fil de l'eau une réponse markdown en prose et en blocs de code ```lang ... ```.
+    feed() reçoit les morceaux tels qu'ils arrivent et retourne, dans l'ordre, des segments
+    ('prose', texte) et ('code', code, lang). Chaque caractère n'est examiné qu'une fois : seul
+    un début possible de balise (quelques caractères en fin de morceau) est retenu pour la suite. """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.in_code = False
+        self.lang = ""
+        self.code_parts = []
+        # Texte retenu en fin de morceau : début de balise ou de ligne de code encore ambigu
+        self.pending = ""
+        self.at_line_start = True
+
+    def feed(self, text):
+        data = self.pending + text
+        self.pending = ""
+        segments = []
+        position = 0
+        while position < len(data):
+            if self.in_code:
+                position = self.scan_code(data, position, segments)
+            else:
+                position = self.scan_prose(data, position, segments)
+        return segments
+
+    def finish(self):
+        """ Fin de la réponse : le texte retenu est rendu, un bloc jamais refermé est affiché quand même. """
+        segments = []
+        if self.in_code:
+            self.code_parts.append(self.pending)
+            segments.append(('code', "".join(self.code_parts), self.lang))
+        elif self.pending:
+            segments.append(('prose', self.pending))
+        self.reset()
+        return segments
+
+    @staticmethod
+    def add_prose(segments, text):
+        if not text:
+            return
+        if segments and segments[-1][0] == 'prose':
+            segments[-1] = ('prose', segments[-1][1] + text)
+        else:
+            segments.append(('prose', text))
+
+    def scan_prose(self, data, position, segments):
+        fence_index = data.find(FENCE, position)
+        if fence_index == -1:
+            # Un ou deux backticks en fin de morceau peuvent être le début d'une balise
+            rest = data[position:]
+            keep = len(rest) - len(rest.rstrip("`"))
+            self.add_prose(segments, data[position:len(data) - keep])
+            self.pending = data[len(data) - keep:]
+            return len(data)
+        info_end = INFO_PATTERN.match(data, fence_index + 3).end()
+        if info_end == len(data):
+            # Langage pas encore terminé : on attend le morceau suivant
+            self.add_prose(segments, data[position:fence_index])
+            self.pending = data[fence_index:]
+            return len(data)
+        if data[info_end] != "\n":
+            # Pas une balise d'ouverture (```x``` en ligne, ````...) : le premier backtick reste de la prose
+            self.add_prose(segments, data[position:fence_index + 1])
+            return fence_index + 1
+        self.add_prose(segments, data[position:fence_index])
+        self.in_code = True
+        self.lang = data[fence_index + 3:info_end]
+        self.code_parts = []
+        self.at_line_start = True
+        return info_end + 1
+
+    def scan_code(self, data, position, segments):
+        if self.at_line_start:
+            # La balise de fermeture est en début de ligne (jusqu'à trois espaces d'indentation)
+            line_end = data.find("\n", position)
+            line = data[position:line_end if line_end != -1 else len(data)]
+            stripped = line.lstrip(" ")
+            indent = len(line) - len(stripped)
+            if indent <= 3 and stripped.startswith(FENCE):
+                segments.append(('code', "".join(self.code_parts), self.lang))
+                self.in_code = False
+                self.code_parts = []
+                return position + indent + 3
+            if line_end == -1 and indent <= 3 and FENCE.startswith(stripped):
+                # Ligne incomplète qui peut encore devenir la balise de fermeture
+                self.pending = line
+                return len(data)
+        line_end = data.find("\n", position)
+        if line_end == -1:
+            self.code_parts.append(data[position:])
+            self.at_line_start = False
+            return len(data)
+        self.code_parts.append(data[position:line_end + 1])
+        self.at_line_start = True
+        return line_end + 1
@@ -0,0 +1,271 @@
+# src/folder_loader.py
+# Owner TMCooper
+
+import os
+import re
+import math
+import concurrent.futures
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+from src.text_loader import SCRIPT_EXTS, TEXT_EXTS, decode_text, load_text
+from src.attachment_store import content_hash
+from src.context_manager import CHARS_PER_TOKEN, estimate_text_tokens
+from src.text_compactor import compact_text
+
+# Ignorés même sans .gitignore (dépendances, environnements, fichiers générés)
+DEFAULT_EXCLUDES = [".git/", ".hg/", ".svn/", "node_modules/", "__pycache__/", ".venv/", "venv/", ".tox/",
+                    ".mypy_cache/", ".pytest_cache/", "dist/", "build/", "*.min.js", "*.min.css", "package-lock.json"]
+# Fichiers qui présentent le projet, envoyés en premier
+KEY_FILES = {"readme.md", "readme.txt", "main.py", "setup.py", "package.json", "requirements.txt", "index.html", "index.js"}
+BINARY_SNIFF_BYTES = 8192
+UTF16_BOMS = (b'\xff\xfe', b'\xfe\xff')
+MAX_LISTED_OMITTED = 50
+
+def gitignore_regex(pattern):
+    """ Traduit un motif .gitignore (*, **, ?, [abc]) en expression régulière sur un chemin relatif. """
+    # Sans "/" le motif vaut à toutes les profondeurs, sinon il part du dossier du .gitignore
+    regex = "" if "/" in pattern else "(?:.*/)?"
+    pattern = pattern.lstrip("/")
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and (end := pattern.find("]", i + 2)) != -1:
+            body = pattern[i + 1:end]
+            regex += "[" + ("^" + body[1:] if body.startswith("!") else body).replace("\\", "\\\\") + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + "$")
+
+def file_priority(relative_path, size):
+    # Fichiers de présentation, puis code source, documentation, tests et logs ; les moins profonds et les plus petits d'abord
+    name = relative_path.rsplit("/", 1)[-1].lower()
+    ext = os.path.splitext(name)[1]
+    depth = relative_path.count("/")
+    if depth == 0 and name in KEY_FILES:
+        group = 0
+    elif name.startswith("test_") or any(part in ("test", "tests") for part in relative_path.lower().split("/")[:-1]):
+        group = 3
+    elif ext == ".log":
+        group = 4
+    elif ext in (".md", ".txt", ".json"):
+        group = 2
+    else:
+        group = 1
+    return (group, depth, size)
+
+def read_project_file(path, size, max_bytes):
+    """ Contenu d'un fichier du dossier, None s'il est binaire. Les gros fichiers sont coupés comme une pièce jointe seule. """
+    with open(path, 'rb') as f:
+        data = f.read(size if size <= max_bytes else BINARY_SNIFF_BYTES)
+    if b"\0" in data[:BINARY_SNIFF_BYTES] and not data.startswith(UTF16_BOMS):
+        return None
+    if size <= max_bytes:
+        return decode_text(data)[0]
+    return load_text(path, max_bytes)
+
+
+class IgnoreRules:
+    """ Règles .gitignore cumulées en descendant dans l'arborescence : la dernière règle qui correspond l'emporte. """
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    def extended(self, lines, base=""):
+        rules = list(self.rules)
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            line = line.lstrip("!")
+            dir_only = line.endswith("/")
+            if line := line.rstrip("/"):
+                rules.append((base, gitignore_regex(line), negate, dir_only))
+        return IgnoreRules(rules)
+
+    def ignored(self, relative_path, is_dir):
+        ignored = False
+        for base, regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if base:
+                if not relative_path.startswith(base + "/"):
+                    continue
+                path = relative_path[len(base) + 1:]
+            else:
+                path = relative_path
+            if regex.match(path):
+                ignored = not negate
+        return ignored
+
+
+def scan_directory(relative_dir, directory, rules):
+    """ Un niveau de l'arborescence : fichiers texte retenus, sous-dossiers à parcourir et nombre d'entrées écartées. """
+    files, subdirs, skipped = [], [], 0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return files, subdirs, skipped
+    for entry in entries:
+        if entry.name == ".gitignore" and entry.is_file():
+            try:
+                with open(entry.path, encoding="utf-8", errors="replace") as f:
+                    rules = rules.extended(f.read().splitlines(), relative_dir)
+            except OSError:
+                pass
+    for entry in entries:
+        relative = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+        # Les liens symboliques vers des dossiers ne sont pas suivis (boucles)
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if rules.ignored(relative, is_dir):
+            skipped += 1
+        elif is_dir:
+            subdirs.append((relative, entry.path, rules))
+        elif os.path.splitext(entry.name.lower())[1] in TEXT_EXTS + SCRIPT_EXTS and entry.is_file():
+            try:
+                files.append((relative, entry.path, entry.stat().st_size))
+            except OSError:
+                skipped += 1
+        else:
+            skipped += 1
+    return files, subdirs, skipped
+
+def scan_folder(root, rules, executor):
+    # Parcours en largeur, chaque niveau de dossiers est lu en parallèle
+    files, skipped = [], 0
+    level = [("", root, rules)]
+    while level:
+        next_level = []
+        for level_files, subdirs, level_skipped in executor.map(lambda item: scan_directory(*item), level):
+            files.extend(level_files)
+            next_level.extend(subdirs)
+            skipped += level_skipped
+        level = next_level
+    return files, skipped
+
+def load_folder(root, max_tokens=24000, max_bytes=512 * 1024, excludes=DEFAULT_EXCLUDES, workers=8, progress=None,
+                compact=True, strip_comments=False, trim_json=False):
+    """ Rassemble les fichiers texte d'un dossier en une seule pièce jointe, par ordre de priorité et dans
+    la limite de max_tokens (chaque fichier compacté avant d'y être compté). Retourne le texte et un résumé d'une ligne. """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        files, skipped = scan_folder(root, IgnoreRules().extended(excludes), executor)
+        if progress:
+            progress(10)
+        files.sort(key=lambda file: file_priority(file[0], file[2]))
+
+        def read(file):
+            # Texte compacté, tokens gagnés et contenu retiré (lignes répétées, commentaires...)
+            try:
+                text = read_project_file(file[1], file[2], max_bytes)
+            except OSError:
+                return None, 0, False
+            if text is None or not compact:
+                return text, 0, False
+            text, report = compact_text(text, file[0], strip_comments, trim_json)
+            return text, report['original_tokens'] - report['tokens'], bool(report['dropped'])
+
+        sections, seen, omitted = [], {}, []
+        included = binaries = duplicates = saved = shortened = 0
+        remaining = max_tokens
+        pending = files
+        while pending:
+            # Lot choisi sur la taille (un majorant des tokens) puis lu en parallèle ; la place laissée
+            # par les binaires et les doublons profite au tour suivant
+            batch, rest, budget = [], [], remaining
+            for file in pending:
+                estimate = math.ceil(min(file[2], max_bytes) / CHARS_PER_TOKEN) + estimate_text_tokens(file[0]) + 4
+                if estimate <= budget:
+                    batch.append(file)
+                    budget -= estimate
+                else:
+                    rest.append(file)
+            if not batch:
+                # À la suite des fichiers déjà écartés, trop gros une fois lus
+                omitted.extend(file[0] for file in rest)
+                break
+            for (relative, _, _), (text, saved_tokens, dropped) in zip(batch, executor.map(read, batch)):
+                if text is None:
+                    binaries += 1
+                    continue
+                key = content_hash(text)
+                if key in seen:
+                    duplicates += 1
+                    sections.append(f"--- {relative} : identique à {seen[key]} ---\n")
+                    continue
+                seen[key] = relative
+                section = f"--- {relative} ---\n{text}\n"
+                tokens = estimate_text_tokens(section)
+                if tokens > remaining:
+                    omitted.append(relative)
+                    continue
+                remaining -= tokens
+                included += 1
+                saved += saved_tokens
+                shortened += dropped
+                sections.append(section)
+            pending = rest
+            if progress:
+                progress(min(99, 10 + int(90 * (max_tokens - remaining) / max(1, max_tokens))))
+
+    summary = (f"{included} fichier(s) inclus sur {len(files)} (~{max_tokens - remaining} tokens), "
+               f"{len(omitted)} hors budget, {binaries} binaire(s) ou illisible(s), {duplicates} doublon(s), "
+               f"{skipped} entrée(s) ignorée(s)" + (f", ~{saved} tokens gagnés au compactage" if saved else "")
+               + (f" dont {shortened} fichier(s) au contenu raccourci" if shortened else ""))
+    header = [f"[Dossier : {summary}]"]
+    if omitted:
+        names = ", ".join(omitted[:MAX_LISTED_OMITTED])
+        more = f" (+{len(omitted) - MAX_LISTED_OMITTED} autres)" if len(omitted) > MAX_LISTED_OMITTED else ""
+        header.append(f"[Non inclus faute de place : {names}{more}]")
+    return "\n".join(header) + "\n" + "".join(sections), summary
+
+
+class FolderJob(QRunnable):
+    def __init__(self, loader, file_info, path):
+        super().__init__()
+        self.loader = loader
+        self.file_info = file_info
+        self.path = path
+    def run(self):
+        try:
+            content, summary = load_folder(self.path, self.loader.max_tokens, self.loader.max_bytes,
+                                           self.loader.excludes, self.loader.workers,
+                                           lambda percent: self.loader.progress.emit(self.file_info, percent),
+                                           self.loader.compact, self.loader.strip_comments, self.loader.trim_json)
+            self.file_info['summary'] = summary
+            self.loader.folder_ready.emit(self.file_info, content)
+        except Exception as e:
+            self.loader.folder_failed.emit(self.file_info, str(e))
+
+
+class FolderLoader(QObject):
+    """ Joint un dossier entier : parcours et lectures en arrière-plan, filtrage .gitignore, budget de tokens. """
+    folder_ready = Signal(object, object)
+    folder_failed = Signal(object, str)
+    progress = Signal(object, int)
+    def __init__(self, max_tokens=24000, max_bytes=512 * 1024, extra_excludes=(), workers=8, compact=True,
+                 strip_comments=False, trim_json=False, parent=None):
+        super().__init__(parent)
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.excludes = DEFAULT_EXCLUDES + list(extra_excludes)
+        self.workers = workers
+        self.compact = compact
+        self.strip_comments = strip_comments
+        self.trim_json = trim_json
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+    def submit(self, file_info, path):
+        self.pool.start(FolderJob(self, file_info, path))
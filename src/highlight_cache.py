@@ -0,0 +1,82 @@
+# src/highlight_cache.py
+# Owner TMCooper
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import markdown
+from pygments.formatters import HtmlFormatter
+
+def highlight_code(raw_code, lang, style='monokai'):
+    formatter_callable = lambda **kwargs: HtmlFormatter(style=style, nobackground=True, noclasses=True)
+    return markdown.markdown(
+        f"```{lang}\n{raw_code}\n```",
+        extensions=['fenced_code', 'codehilite'],
+        extension_configs={'codehilite': {'pygments_formatter': formatter_callable}}
+    )
+
+class HighlightCache:
+    """ Cache LRU du HTML coloré des blocs de code, sauvegardable sur disque entre deux lancements. """
+    def __init__(self, max_entries=256, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if self.path:
+            self.load()
+
+    @staticmethod
+    def make_key(raw_code, lang, style):
+        return hashlib.sha256(f"{lang}\0{style}\0{raw_code}".encode("utf-8")).hexdigest()
+
+    def get_html(self, raw_code, lang, style='monokai'):
+        key = self.make_key(raw_code, lang, style)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        html_code = highlight_code(raw_code, lang, style)
+        with self.lock:
+            self.entries[key] = html_code
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return html_code
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self.entries),
+        }
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved_entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for key, html_code in saved_entries[-self.max_entries:]:
+                self.entries[key] = html_code
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            saved_entries = list(self.entries.items())
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(saved_entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Impossible de sauvegarder le cache de coloration : {e}")
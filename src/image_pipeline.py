@@ -0,0 +1,101 @@
+# src/image_pipeline.py
+# Owner TMCooper
+
+import io
+import hashlib
+from PIL import Image, ImageOps
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+from PySide6.QtGui import QImage
+
+from src.attachment_store import dhash_from_rows
+
+IMAGE_EXTS = ['.png', '.jpg', '.jpeg', '.webp', '.bmp']
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+def qimage_to_pil(qimage):
+    """ Convertit une QImage en image PIL directement depuis ses pixels, sans passer par un PNG. """
+    if qimage.hasAlphaChannel():
+        qimage = qimage.convertToFormat(QImage.Format.Format_RGBA8888)
+        mode = "RGBA"
+    else:
+        qimage = qimage.convertToFormat(QImage.Format.Format_RGB888)
+        mode = "RGB"
+    # copy() détache l'image PIL du tampon de la QImage, qui peut être libéré ensuite
+    return Image.frombuffer(mode, (qimage.width(), qimage.height()), qimage.constBits(),
+                            "raw", mode, qimage.bytesPerLine(), 1).copy()
+
+def pil_dhash(img):
+    small = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = small.tobytes()
+    return dhash_from_rows(img.width, img.height, [pixels[y * 9:(y + 1) * 9] for y in range(8)])
+
+def pixel_digest(img):
+    # Empreinte exacte des pixels, indépendante de l'encodage (deux PNG différents d'une même image)
+    return hashlib.sha256(f"{img.width}x{img.height}".encode() + img.convert("RGBA").tobytes()).hexdigest()
+
+def prepare_image(source, max_edge=1600, image_format="WEBP", quality=85):
+    """ Réduit l'image à max_edge pixels sur son plus grand côté puis la ré-encode.
+    Retourne un blob {'mime_type', 'data'} directement utilisable dans prompt_parts, l'empreinte
+    perceptuelle de l'image et celle de ses pixels pour repérer les doublons. """
+    original_bytes = None
+    original_mime = None
+    if isinstance(source, QImage):
+        img = qimage_to_pil(source)
+    else:
+        with open(source, 'rb') as f:
+            original_bytes = f.read()
+        img = Image.open(io.BytesIO(original_bytes))
+        original_mime = MIME_TYPES.get(img.format)
+        img = ImageOps.exif_transpose(img)
+
+    image_hash = pil_dhash(img)
+    digest = pixel_digest(img)
+    resized = max(img.size) > max_edge
+    if resized:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    if image_format == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L"):
+        img = img.convert("RGBA")
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, quality=quality)
+    data = buffer.getvalue()
+
+    # Un fichier déjà petit et dans un format accepté est envoyé tel quel s'il est plus compact
+    if original_mime and not resized and len(original_bytes) <= len(data):
+        return {'mime_type': original_mime, 'data': original_bytes}, image_hash, digest
+    return {'mime_type': MIME_TYPES[image_format], 'data': data}, image_hash, digest
+
+
+class ImageJob(QRunnable):
+    def __init__(self, pipeline, file_info, source):
+        super().__init__()
+        self.pipeline = pipeline
+        self.file_info = file_info
+        self.source = source
+    def run(self):
+        try:
+            blob, image_hash, digest = prepare_image(self.source, self.pipeline.max_edge,
+                                                     self.pipeline.image_format, self.pipeline.quality)
+            self.file_info['image_hash'] = image_hash
+            self.file_info['pixel_digest'] = digest
+            self.pipeline.image_ready.emit(self.file_info, blob)
+        except Exception as e:
+            self.pipeline.image_failed.emit(self.file_info, str(e))
+
+
+class ImagePipeline(QObject):
+    """ Prépare les images jointes (conversion, réduction, ré-encodage) dans un pool de threads. """
+    image_ready = Signal(object, object)
+    image_failed = Signal(object, str)
+    def __init__(self, max_edge=1600, image_format="WEBP", quality=85, max_workers=2, parent=None):
+        super().__init__(parent)
+        self.max_edge = max_edge
+        self.image_format = image_format.upper() if image_format.upper() in MIME_TYPES else "WEBP"
+        self.quality = quality
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+    def submit(self, file_info, source):
+        self.pool.start(ImageJob(self, file_info, source))
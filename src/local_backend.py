@@ -0,0 +1,135 @@
+# src/local_backend.py
+# Owner TMCooper
+
+import json
+import time
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+def default_responder(contents):
+    """ Réponse factice : reprend la dernière question avec un peu de markdown et un bloc de code. """
+    question = ""
+    for part in contents[-1].get('parts', []) if contents else []:
+        if 'text' in part:
+            question = part['text']
+    return (f"Réponse du backend local à : **{question[:200]}**\n\n"
+            "Cette réponse ne vient pas de Gemini, elle sert à tester la barre hors ligne.\n\n"
+            "```python\nprint('AIBar')\n```\n\n"
+            f"Historique reçu : {len(contents)} message(s).")
+
+
+class LocalGeminiHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 pour que le client garde la connexion ouverte entre deux demandes
+    protocol_version = "HTTP/1.1"
+    # Sans TCP_NODELAY, les petits morceaux SSE attendent l'ACK retardé du client (~40 ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # Le client a annulé la demande (bouton Arrêter, Échap)
+            pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        # Équivalent de GET /models/{modèle}, utilisé pour pré-ouvrir la connexion
+        self.send_json(200, {'name': self.path.strip("/").split("?")[0]})
+
+    def do_POST(self):
+        server = self.server.backend
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            contents = json.loads(body).get('contents', [])
+        except ValueError:
+            self.send_json(400, {'error': {'code': 400, 'message': "Corps JSON invalide"}})
+            return
+        server.request_count += 1
+        if server.failures:
+            # Erreur injectée (429 avec délai conseillé, 503...) pour tester les nouveaux essais
+            status = server.failures.popleft()
+            error = {'code': status, 'message': "Erreur simulée par le backend local"}
+            if status == 429:
+                error['details'] = [{'@type': "type.googleapis.com/google.rpc.RetryInfo",
+                                     'retryDelay': f"{server.retry_delay_s}s"}]
+            self.send_json(status, {'error': error})
+            return
+        text = server.responder(contents)
+        path = self.path.split("?")[0]
+        model_name = path.rsplit("/", 1)[-1].split(":")[0]
+        time.sleep(server.model_latency_ms.get(model_name, server.latency_ms) / 1000)
+        if path.endswith(":generateContent"):
+            server.first_chunk_at = time.perf_counter()
+            self.send_json(200, self.candidate(text))
+        elif path.endswith(":streamGenerateContent"):
+            # Flux SSE, un événement "data:" par morceau, en transfert chunked
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(text), server.chunk_chars):
+                if start:
+                    time.sleep(server.chunk_ms / 1000)
+                else:
+                    server.first_chunk_at = time.perf_counter()
+                event = "data: " + json.dumps(self.candidate(text[start:start + server.chunk_chars])) + "\r\n\r\n"
+                self.write_chunk(event.encode("utf-8"))
+            self.write_chunk(b"")
+        else:
+            self.send_json(404, {'error': {'code': 404, 'message': f"Méthode inconnue : {path}"}})
+
+    @staticmethod
+    def candidate(text):
+        return {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}]}
+
+
+class LocalGeminiServer:
+    """ Petit serveur HTTP qui imite l'API REST de Gemini (generateContent et streamGenerateContent
+    en SSE), pour tester et mesurer tout le chemin réseau de la barre sans clé ni connexion. """
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=300, chunk_ms=20, chunk_chars=40, responder=None,
+                 model_latency_ms=None):
+        self.latency_ms = latency_ms
+        # Latence propre à certains modèles ({"gemini-1.5-pro-latest": 2000}), pour tester la relance
+        self.model_latency_ms = model_latency_ms or {}
+        # Codes HTTP renvoyés, un par requête, avant de répondre normalement
+        self.failures = deque()
+        self.retry_delay_s = 1
+        self.chunk_ms = chunk_ms
+        self.chunk_chars = chunk_chars
+        self.responder = responder or default_responder
+        self.request_count = 0
+        # Instant d'envoi du premier morceau de la dernière réponse (pour les benchmarks)
+        self.first_chunk_at = None
+        self.httpd = ThreadingHTTPServer((host, port), LocalGeminiHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.backend = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1beta"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="aibar-local-backend", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
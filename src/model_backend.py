@@ -0,0 +1,443 @@
+# src/model_backend.py
+# Owner TMCooper
+
+import abc
+import json
+import queue
+import base64
+import asyncio
+import threading
+import concurrent.futures
+import importlib.util
+
+import httpx
+
+from src.config import env_flag, env_str, env_float
+
+DEFAULT_API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+_STREAM_DONE = object()
+# Limite de débit, délai dépassé ou serveur momentanément indisponible
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class BackendError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        # Délai conseillé par l'API avant un nouvel essai (en-tête Retry-After ou RetryInfo), en secondes
+        self.retry_after = retry_after
+
+
+class RequestCancelled(BackendError):
+    pass
+
+
+class Blob:
+    def __init__(self, mime_type="", data=b""):
+        self.mime_type = mime_type
+        self.data = data
+
+
+class Part:
+    """ Partie d'un message, même interface que les protos Part du SDK (text, inline_data, "inline_data" in part). """
+    def __init__(self, text="", inline_data=None):
+        self.text = text
+        self.inline_data = inline_data
+    def __contains__(self, field):
+        return getattr(self, field, None) not in (None, "")
+    def to_json(self):
+        if self.inline_data is not None:
+            return {'inlineData': {'mimeType': self.inline_data.mime_type,
+                                   'data': base64.b64encode(self.inline_data.data).decode("ascii")}}
+        return {'text': self.text}
+
+
+class Content:
+    def __init__(self, role="user", parts=None):
+        self.role = role
+        self.parts = list(parts or [])
+    def to_json(self):
+        return {'role': self.role, 'parts': [part.to_json() for part in self.parts]}
+
+
+def model_path(model_name):
+    return model_name if model_name.startswith("models/") else f"models/{model_name}"
+
+def to_part(value):
+    if isinstance(value, Part):
+        return value
+    if isinstance(value, dict) and 'data' in value:
+        return Part(inline_data=Blob(value.get('mime_type', ''), value['data']))
+    return Part(text=str(value))
+
+def to_content(value):
+    # Accepte aussi les dicts {'role', 'parts'} comme le setter d'historique du SDK
+    if isinstance(value, Content):
+        return value
+    return Content(value['role'], [to_part(part) for part in value['parts']])
+
+def parse_retry_after(value):
+    # "7", "7s" ou "1.5s" ; les dates HTTP ne sont pas prises en charge
+    try:
+        return max(0.0, float(str(value).strip().removesuffix("s")))
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(error):
+    """ Erreur passagère qui mérite un nouvel essai (429, 5xx, coupure réseau). """
+    if isinstance(error, RequestCancelled):
+        return False
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    # BackendError.status, ou .code des exceptions google.api_core du SDK
+    status = getattr(error, 'status', None) or getattr(error, 'code', None)
+    try:
+        return int(status) in RETRYABLE_STATUS
+    except (TypeError, ValueError):
+        return False
+
+def response_text(data):
+    texts = []
+    for candidate in data.get('candidates', [])[:1]:
+        for part in candidate.get('content', {}).get('parts', []):
+            texts.append(part.get('text', ""))
+    return "".join(texts)
+
+
+class BackendResponse:
+    """ Réponse ou morceau de réponse : comme le SDK, .text lève ValueError s'il n'y a pas de texte. """
+    def __init__(self, text):
+        self._text = text
+    @property
+    def text(self):
+        if not self._text:
+            raise ValueError("La réponse ne contient pas de texte")
+        return self._text
+
+
+class ChatBackend(abc.ABC):
+    """ Interface attendue par CommandBar et GeminiWorker : un historique et send_message,
+    plus warm_up pour ouvrir la connexion à l'avance et close à la fermeture. """
+    model_name = ""
+
+    @property
+    @abc.abstractmethod
+    def history(self):
+        ...
+
+    @history.setter
+    @abc.abstractmethod
+    def history(self, value):
+        ...
+
+    @abc.abstractmethod
+    def send_message(self, prompt_parts, stream=False):
+        ...
+
+    def warm_up(self):
+        pass
+
+    def cancel(self):
+        # Interrompt la requête en cours si le backend le permet (appelé depuis l'interface)
+        pass
+
+    def fan_out(self, prompt_parts, model_names):
+        raise BackendError("La comparaison entre modèles demande le backend http")
+
+    def stats(self):
+        # Compteurs propres au backend, affichés par /stats
+        return {}
+
+    def close(self):
+        pass
+
+
+class SdkBackend(ChatBackend):
+    """ ChatSession bloquant de google.generativeai, tel qu'utilisé jusqu'ici. """
+    def __init__(self, model_name, api_key):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self.genai = genai
+        self.chat = genai.GenerativeModel(model_name).start_chat(history=[])
+        self.model_name = self.chat.model.model_name
+
+    @property
+    def history(self):
+        return self.chat.history
+
+    @history.setter
+    def history(self, value):
+        self.chat.history = value
+
+    def send_message(self, prompt_parts, stream=False):
+        return self.chat.send_message(prompt_parts, stream=stream)
+
+    def warm_up(self):
+        def get_model():
+            try:
+                self.genai.get_model(self.model_name)
+            except Exception as e:
+                print(f"Pré-chauffage de la connexion Gemini impossible : {e}")
+        threading.Thread(target=get_model, daemon=True).start()
+
+
+class AsyncHttpBackend(ChatBackend):
+    """ Client REST de Gemini sur httpx.AsyncClient : une boucle asyncio dans son propre thread
+    garde un pool de connexions HTTP/2 ouvert et réutilisé d'une demande à l'autre. """
+    def __init__(self, model_name, api_key, base_url=DEFAULT_API_BASE_URL, http2=True, timeout=60.0,
+                 hedge_delay_ms=0, hedge_model=None):
+        self.model_name = model_path(model_name)
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        # HTTP/2 demande le paquet h2, sinon on reste en HTTP/1.1 avec keep-alive
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+        self.timeout = timeout
+        # Relance (hedging) : 0 ms la désactive, sans modèle précisé on relance le même
+        self.hedge_delay = hedge_delay_ms / 1000 if hedge_delay_ms > 0 else None
+        self.hedge_model = model_path(hedge_model) if hedge_model else self.model_name
+        self.hedge_counts = {'requests': 0, 'hedged': 0, 'hedge_won': 0}
+        self._history = []
+        self.loop = None
+        self.thread = None
+        self.client = None
+        self.current_future = None
+        self.loop_lock = threading.Lock()
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, value):
+        self._history = [to_content(content) for content in value]
+
+    def ensure_loop(self):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name="aibar-http", daemon=True)
+                self.thread.start()
+        return self.loop
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.ensure_loop())
+
+    def get_client(self):
+        # Appelé uniquement depuis la boucle asyncio
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                http2=self.http2,
+                headers={'x-goog-api-key': self.api_key or ""},
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=300),
+            )
+        return self.client
+
+    def warm_up(self):
+        # Ouvre la connexion (DNS, TLS, HTTP/2) sans bloquer l'appelant
+        future = self.submit(self._warm_up())
+        def report(done):
+            if not done.cancelled() and done.exception() is not None:
+                print(f"Pré-chauffage de la connexion impossible : {done.exception()}")
+        future.add_done_callback(report)
+        return future
+
+    async def _warm_up(self):
+        response = await self.get_client().get(f"/{self.model_name}")
+        await response.aread()
+
+    def request_body(self, user_content):
+        return {'contents': [content.to_json() for content in self._history + [user_content]]}
+
+    @staticmethod
+    async def raise_for_error(response):
+        if response.status_code >= 400:
+            body = await response.aread()
+            retry_after = parse_retry_after(response.headers.get("retry-after"))
+            try:
+                error = json.loads(body)['error']
+                message = error['message']
+                for detail in error.get('details', []):
+                    if detail.get('@type', "").endswith("google.rpc.RetryInfo"):
+                        retry_after = parse_retry_after(detail.get('retryDelay'))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                message = body.decode("utf-8", "replace")[:200]
+            raise BackendError(f"HTTP {response.status_code} : {message}", response.status_code, retry_after)
+
+    async def _attempt(self, model_name, body, stream, emit):
+        """ Une requête vers un modèle : emit(texte) pour chaque morceau reçu, puis emit(_STREAM_DONE). """
+        client = self.get_client()
+        if stream:
+            async with client.stream("POST", f"/{model_name}:streamGenerateContent",
+                                     params={'alt': 'sse'}, json=body) as response:
+                await self.raise_for_error(response)
+                async for line in response.aiter_lines():
+                    if line.startswith("data:"):
+                        emit(response_text(json.loads(line[5:])))
+        else:
+            response = await client.post(f"/{model_name}:generateContent", json=body)
+            await self.raise_for_error(response)
+            emit(response_text(response.json()))
+        emit(_STREAM_DONE)
+
+    async def _race(self, body, stream, chunks):
+        """ Requête principale, doublée par une seconde (autre modèle ou même modèle) si aucun texte
+        n'est arrivé après hedge_delay : la première qui répond est gardée, l'autre est annulée. """
+        events = asyncio.Queue()
+        attempts = []
+        def launch(model_name):
+            index = len(attempts)
+            async def run():
+                try:
+                    await self._attempt(model_name, body, stream, lambda item: events.put_nowait((index, item)))
+                except Exception as e:
+                    events.put_nowait((index, e))
+            attempts.append(asyncio.create_task(run()))
+        def launch_hedge():
+            self.hedge_counts['hedged'] += 1
+            launch(self.hedge_model)
+        can_hedge = self.hedge_delay is not None
+        self.hedge_counts['requests'] += 1
+        launch(self.model_name)
+        winner = None
+        failed = set()
+        try:
+            while True:
+                waiting_first = winner is None and can_hedge and len(attempts) == 1
+                try:
+                    index, item = await asyncio.wait_for(events.get(), self.hedge_delay if waiting_first else None)
+                except asyncio.TimeoutError:
+                    launch_hedge()
+                    continue
+                if winner is None:
+                    if isinstance(item, Exception):
+                        failed.add(index)
+                        if waiting_first and is_retryable(item):
+                            # 429, 5xx : l'ordonnanceur réessaie après son attente (backoff, Retry-After),
+                            # une relance immédiate ne ferait qu'aggraver la limite de débit
+                            chunks.put(item)
+                            return
+                        if waiting_first:
+                            # Autre échec avant le premier texte : la relance sert aussi de nouvelle tentative
+                            launch_hedge()
+                        elif len(failed) == len(attempts):
+                            chunks.put(item)
+                            return
+                        continue
+                    if item == "":
+                        continue
+                    winner = index
+                    if index > 0:
+                        self.hedge_counts['hedge_won'] += 1
+                    for other, task in enumerate(attempts):
+                        if other != winner:
+                            task.cancel()
+                if index != winner:
+                    continue
+                chunks.put(item)
+                if item is _STREAM_DONE or isinstance(item, Exception):
+                    return
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    def send_message(self, prompt_parts, stream=False):
+        user_content = Content("user", [to_part(part) for part in prompt_parts])
+        body = self.request_body(user_content)
+        if not stream:
+            return BackendResponse("".join(self.iter_text(body, False, user_content)))
+        return self.iter_stream(body, user_content)
+
+    def cancel(self):
+        # Annuler le futur annule la tâche asyncio, ce qui ferme la requête HTTP en cours
+        future = self.current_future
+        if future is not None:
+            future.cancel()
+
+    def iter_stream(self, body, user_content):
+        for text in self.iter_text(body, True, user_content):
+            yield BackendResponse(text)
+
+    def iter_text(self, body, stream, user_content):
+        # Pont entre les réponses lues dans la boucle asyncio et le thread du worker
+        chunks = queue.Queue()
+        future = self.current_future = self.submit(self._race(body, stream, chunks))
+        def on_done(done):
+            # Annulé avant ou pendant la lecture : débloque le thread qui attend un morceau
+            if done.cancelled():
+                chunks.put(RequestCancelled("Demande annulée"))
+        future.add_done_callback(on_done)
+        full_text = ""
+        try:
+            while (item := chunks.get()) is not _STREAM_DONE:
+                if isinstance(item, BaseException):
+                    raise item
+                if item:
+                    full_text += item
+                    yield item
+        finally:
+            if not future.done():
+                future.cancel()
+            self.current_future = None
+        self.record_turn(user_content, full_text)
+
+    def fan_out(self, prompt_parts, model_names):
+        """ Envoie le même prompt à plusieurs modèles à la fois. Retourne [(modèle, texte ou exception)] ;
+        seule la réponse du premier modèle entre dans l'historique. """
+        user_content = Content("user", [to_part(part) for part in prompt_parts])
+        body = self.request_body(user_content)
+        async def ask(model_name):
+            texts = []
+            await self._attempt(model_path(model_name), body, False, texts.append)
+            return "".join(text for text in texts if text is not _STREAM_DONE)
+        async def ask_all():
+            return await asyncio.gather(*(ask(model_name) for model_name in model_names), return_exceptions=True)
+        self.current_future = self.submit(ask_all())
+        try:
+            results = self.current_future.result()
+        except concurrent.futures.CancelledError:
+            raise RequestCancelled("Demande annulée") from None
+        finally:
+            self.current_future = None
+        if results and isinstance(results[0], str):
+            self.record_turn(user_content, results[0])
+        return list(zip(model_names, results))
+
+    def stats(self):
+        return dict(self.hedge_counts) if self.hedge_delay is not None else {}
+
+    def record_turn(self, user_content, text):
+        self._history = self._history + [user_content, Content("model", [Part(text=text)])]
+
+    def close(self):
+        if self.loop is None:
+            return
+        async def shutdown():
+            if self.client is not None:
+                await self.client.aclose()
+        try:
+            self.submit(shutdown()).result(timeout=2)
+        except Exception as e:
+            print(f"Fermeture du client HTTP incomplète : {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(2)
+
+
+def create_backend(model_name, api_key):
+    """ Backend choisi par AIBAR_BACKEND : "http" (client async, par défaut), "sdk" ou "local". """
+    kind = env_str("AIBAR_BACKEND", "http").lower()
+    if kind == "sdk":
+        return SdkBackend(model_name, api_key)
+    if kind == "local":
+        from src.local_backend import LocalGeminiServer
+        server = LocalGeminiServer(latency_ms=env_float("AIBAR_LOCAL_LATENCY_MS", 300))
+        server.start()
+        print(f"Backend local de test sur {server.base_url}")
+        return AsyncHttpBackend(model_name, "local", server.base_url, http2=False,
+                                hedge_delay_ms=env_float("AIBAR_HEDGE_DELAY_MS", 0),
+                                hedge_model=env_str("AIBAR_HEDGE_MODEL", ""))
+    return AsyncHttpBackend(model_name, api_key, env_str("AIBAR_API_BASE_URL", DEFAULT_API_BASE_URL),
+                            http2=env_flag("AIBAR_HTTP2", True),
+                            hedge_delay_ms=env_float("AIBAR_HEDGE_DELAY_MS", 0),
+                            hedge_model=env_str("AIBAR_HEDGE_MODEL", ""))
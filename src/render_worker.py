@@ -0,0 +1,139 @@
+# src/render_worker.py
+# Owner TMCooper
+
+import time
+import itertools
+
+import markdown
+
+from PySide6.QtCore import Qt, QObject, QThread, QTimer, QTimerEvent, QCoreApplication, Signal, Slot
+from PySide6.QtGui import QTextDocument
+
+# La mise en page garde le GIL : elle est faite par tranches de blocs pour laisser la main
+# au thread de l'interface entre deux tranches (une tranche ~ 10 ms pour du code coloré)
+LAYOUT_SLICE_BLOCKS = 100
+
+def layout_in_slices(document):
+    layout = document.documentLayout()
+    block = document.begin()
+    index = 0
+    while block.isValid():
+        if index % LAYOUT_SLICE_BLOCKS == 0:
+            layout.blockBoundingRect(block)
+        block = block.next()
+        index += 1
+    return document.size()
+
+def flush_layout_timers(document):
+    # La mise en page laisse un minuteur à 0 ms (taille du document changée) : déclenché ici, sinon il serait
+    # arrêté depuis le thread de l'interface après moveToThread (avertissement QBasicTimer)
+    layout = document.documentLayout()
+    for timer in QThread.currentThread().eventDispatcher().registeredTimers(layout):
+        QCoreApplication.sendEvent(layout, QTimerEvent(timer.timerId))
+
+
+class RenderWorker(QObject):
+    """ Vit dans son propre QThread : markdown -> HTML, coloration Pygments et mise en page du
+    QTextDocument, rendu ensuite au thread de l'interface qui n'a plus qu'à l'afficher. """
+    rendered = Signal(int, object, object, float)
+    def __init__(self, highlight_cache, target_thread):
+        super().__init__()
+        self.highlight_cache = highlight_cache
+        self.target_thread = target_thread
+        # Convertisseur propre à ce thread (celui de chat_view reste au thread de l'interface)
+        self.markdown = markdown.Markdown()
+
+    @Slot(object)
+    def render(self, job):
+        started = time.perf_counter()
+        try:
+            if job['kind'] == 'code':
+                html = self.highlight_cache.get_html(job['text'], job['lang'])
+            elif job['kind'] == 'markdown':
+                html = self.markdown.reset().convert(job['text'])
+            else:
+                html = job['text']
+            document = QTextDocument()
+            if job['font'] is not None:
+                document.setDefaultFont(job['font'])
+            document.setHtml(html)
+            if job['layout']:
+                if job['text_width'] is not None:
+                    document.setTextWidth(job['text_width'])
+                # Mise en page faite ici plutôt qu'au premier affichage
+                layout_in_slices(document)
+                flush_layout_timers(document)
+            # Le document appartient désormais au thread de l'interface
+            document.moveToThread(self.target_thread)
+        except Exception as e:
+            print(f"Erreur de rendu : {e}")
+            html, document = job['text'], None
+        self.rendered.emit(job['id'], html, document, (time.perf_counter() - started) * 1000)
+
+
+class RenderPipeline(QObject):
+    """ File de rendu vers le RenderWorker : chaque résultat est remis, dans l'ordre des demandes,
+    au callback donné à submit(), appelé sur le thread de l'interface. """
+    job_submitted = Signal(object)
+    def __init__(self, highlight_cache, parent=None):
+        super().__init__(parent)
+        self.callbacks = {}
+        self.job_ids = itertools.count(1)
+        self.thread = QThread(self)
+        self.worker = RenderWorker(highlight_cache, self.thread.thread())
+        self.worker.moveToThread(self.thread)
+        self.job_submitted.connect(self.worker.render)
+        self.worker.rendered.connect(self.on_rendered)
+        self.thread.finished.connect(self.worker.deleteLater)
+        self.thread.start()
+
+    def submit(self, kind, text, callback, lang="", font=None, text_width=None, layout=True):
+        """ kind : 'code' (texte brut à colorer), 'markdown' ou 'html'. callback(html, document, worker_ms). """
+        job_id = next(self.job_ids)
+        self.callbacks[job_id] = callback
+        self.job_submitted.emit({'id': job_id, 'kind': kind, 'text': text, 'lang': lang, 'font': font,
+                                 'text_width': text_width, 'layout': layout})
+        return job_id
+
+    @Slot(int, object, object, float)
+    def on_rendered(self, job_id, html, document, worker_ms):
+        if callback := self.callbacks.pop(job_id, None):
+            callback(html, document, worker_ms)
+
+    def stop(self):
+        self.callbacks.clear()
+        self.thread.quit()
+        self.thread.wait(2000)
+
+
+class StallMonitor(QObject):
+    """ Plus long blocage du thread de l'interface : un minuteur court qui note son propre retard. """
+    def __init__(self, interval_ms=10, parent=None):
+        super().__init__(parent)
+        self.interval_ms = interval_ms
+        self.worst_ms = 0.0
+        self.last_tick = None
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.tick)
+
+    def start(self):
+        if not self.timer.isActive():
+            self.worst_ms = 0.0
+            self.last_tick = time.perf_counter()
+            self.timer.start()
+
+    def tick(self):
+        now = time.perf_counter()
+        self.worst_ms = max(self.worst_ms, (now - self.last_tick) * 1000 - self.interval_ms)
+        self.last_tick = now
+
+    def take(self, keep_running=False):
+        """ Pire blocage depuis le dernier appel ; le minuteur s'arrête sauf si keep_running. """
+        self.tick()
+        worst = self.worst_ms
+        self.worst_ms = 0.0
+        if not keep_running:
+            self.timer.stop()
+        return worst
@@ -0,0 +1,133 @@
+# src/request_scheduler.py
+# Owner TMCooper
+
+import time
+import threading
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from src.model_backend import RequestCancelled, is_retryable
+
+
+class TokenBucket:
+    """ Seau à jetons rempli en continu : per_minute jetons par minute, au plus per_minute en réserve.
+    per_minute <= 0 désactive la limite. """
+    def __init__(self, per_minute):
+        self.capacity = max(0, per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, amount):
+        """ Secondes à attendre avant de pouvoir prendre amount jetons. """
+        if not self.capacity:
+            return 0.0
+        with self.lock:
+            self.refill()
+            # Une demande plus grosse que le seau attend simplement qu'il soit plein
+            missing = min(amount, self.capacity) - self.level
+            return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        if not self.capacity:
+            return
+        with self.lock:
+            self.refill()
+            self.level -= min(amount, self.capacity)
+
+
+class RequestScheduler:
+    """ Limite le débit côté client (requêtes et tokens par minute) et relance les erreurs passagères
+    avec un délai exponentiel aléatoire, en respectant le délai conseillé par l'API. Les attentes
+    sont interruptibles par le jeton d'annulation de la demande. """
+    def __init__(self, requests_per_minute=15, tokens_per_minute=1000000, max_attempts=6,
+                 base_delay=1.0, max_delay=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = wait_random_exponential(multiplier=base_delay, max=max_delay)
+        # Pause imposée à toutes les demandes après un 429 accompagné d'un délai
+        self.paused_until = 0.0
+        # Temps total passé à attendre (pour la mesure par étape du worker)
+        self.waited = 0.0
+        self.retry_count = 0
+
+    def pause(self, seconds, cancel_event, on_wait, describe):
+        # Attente découpée en pas d'une seconde pour afficher un compte à rebours
+        deadline = time.monotonic() + seconds
+        started = time.monotonic()
+        try:
+            while (remaining := deadline - time.monotonic()) > 0:
+                on_wait(describe(remaining))
+                if cancel_event.wait(min(remaining, 1.0)):
+                    raise RequestCancelled("Demande annulée")
+        finally:
+            self.waited += time.monotonic() - started
+
+    def wait_for_slot(self, tokens, cancel_event, on_wait, requests=1):
+        """ Bloque jusqu'à ce que la demande passe sous les limites, puis la décompte. """
+        throttled = False
+        while True:
+            paused = self.paused_until - time.monotonic()
+            request_delay = self.requests.delay(requests)
+            token_delay = self.tokens.delay(tokens)
+            delay = max(paused, request_delay, token_delay)
+            if delay <= 0:
+                break
+            if paused >= max(request_delay, token_delay):
+                reason = "Limite de l'API atteinte"
+            elif request_delay >= token_delay:
+                reason = "Limite de requêtes par minute"
+            else:
+                reason = "Limite de tokens par minute"
+            # Les seaux sont réévalués après chaque pas : une seule seconde d'attente à la fois
+            throttled = True
+            self.pause(min(delay, 1.0), cancel_event, on_wait,
+                       lambda remaining, delay=delay: f"{reason}, envoi dans {delay:.0f} s")
+        if throttled:
+            on_wait("")
+        self.requests.take(requests)
+        self.tokens.take(tokens)
+
+    def retry_delay(self, retry_state):
+        error = retry_state.outcome.exception()
+        delay = self.backoff(retry_state)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, retry_after)
+            # Les demandes suivantes attendent aussi la fin du délai imposé par l'API
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        return delay
+
+    def call(self, attempt, cancel_event, on_wait, can_retry=None):
+        """ Appelle attempt() et le relance tant que l'erreur est passagère, au plus max_attempts fois.
+        can_retry() permet d'interdire la relance (réponse déjà en partie affichée). """
+        state = {'attempt': 1}
+        def should_retry(error):
+            return not cancel_event.is_set() and is_retryable(error) and (can_retry is None or can_retry())
+        def before_sleep(retry_state):
+            self.retry_count += 1
+            state['attempt'] = retry_state.attempt_number + 1
+            state['error'] = retry_state.outcome.exception()
+            print(f"Erreur passagère ({state['error']}), nouvel essai {state['attempt']}/{self.max_attempts} "
+                  f"dans {retry_state.next_action.sleep:.1f} s")
+        def sleep(seconds):
+            status = getattr(state['error'], 'status', None) or getattr(state['error'], 'code', None)
+            reason = "Limite de l'API atteinte" if status == 429 else "Erreur passagère"
+            self.pause(seconds, cancel_event, on_wait,
+                       lambda remaining: f"{reason}, essai {state['attempt']}/{self.max_attempts} dans {remaining:.0f} s")
+            on_wait("")
+        retrying = Retrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=self.retry_delay,
+            retry=retry_if_exception(should_retry),
+            before_sleep=before_sleep,
+            sleep=sleep,
+            reraise=True,
+        )
+        return retrying(attempt)
@@ -0,0 +1,141 @@
+# src/request_timing.py
+# Owner TMCooper
+
+import os
+import json
+import math
+import time
+from contextlib import contextmanager
+
+# Étapes du traitement d'une demande, dans l'ordre d'affichage de /stats
+STAGE_LABELS = {
+    'queue': "Attente en file",
+    'prompt': "Assemblage du prompt",
+    'cache': "Cache de réponses",
+    'context': "Compaction de l'historique",
+    'throttle': "Limite de débit / nouveaux essais",
+    'api_first_chunk': "API jusqu'au premier morceau",
+    'api': "Appel API complet",
+    'parse': "Découpage texte / code",
+    'markdown': "Markdown -> HTML (thread de rendu)",
+    'highlight': "Coloration et mise en page du code (thread de rendu)",
+    'render': "Insertion dans l'interface (BlockStreamer)",
+    'stall': "Blocage max de l'interface",
+    'first_paint': "Premier contenu visible",
+    'total': "Total de la demande",
+}
+
+def percentile(values, pct):
+    # Rang le plus proche
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+class RequestTimings:
+    """ Durées cumulées par étape pour une demande. Les spans imbriqués ne comptent
+    que leur temps propre : le temps des spans enfants est retiré du parent. """
+    def __init__(self, log, request_id):
+        self.log = log
+        self.request_id = request_id
+        self.started_at = time.perf_counter()
+        self.timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.stages = {}
+        self.child_stack = []
+        # La demande elle-même, plus chaque BlockStreamer encore en train d'afficher
+        self.holds = 1
+
+    def add(self, stage, ms):
+        self.stages[stage] = self.stages.get(stage, 0.0) + ms
+
+    def peak(self, stage, ms):
+        # Valeur maximale plutôt que cumulée (pire blocage de l'interface)
+        self.stages[stage] = max(self.stages.get(stage, 0.0), ms)
+
+    @contextmanager
+    def span(self, stage):
+        self.child_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            children = self.child_stack.pop()
+            self.add(stage, elapsed - children)
+            if self.child_stack:
+                self.child_stack[-1] += elapsed
+
+    def hold(self):
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0:
+            self.log.close(self)
+
+
+class RequestTimingLog:
+    """ Garde les durées par étape de la session (p50/p95) et les journalise
+    en JSONL, une ligne par demande, dans un fichier tournant. """
+    def __init__(self, path=None, max_bytes=1024 * 1024, backup_count=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.samples = {}
+        self.request_count = 0
+        # Appelé juste avant l'enregistrement d'une demande, pour y ajouter une dernière mesure
+        self.on_close = None
+
+    def begin(self, request_id):
+        return RequestTimings(self, request_id)
+
+    def close(self, timings):
+        if self.on_close is not None:
+            self.on_close(timings)
+        self.request_count += 1
+        for stage, ms in timings.stages.items():
+            self.samples.setdefault(stage, []).append(ms)
+        if self.path:
+            self.write({
+                'timestamp': timings.timestamp,
+                'request_id': timings.request_id,
+                'stages': {stage: round(ms, 3) for stage, ms in timings.stages.items()},
+            })
+
+    def write(self, record):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self.rotate()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Impossible d'écrire le journal des durées : {e}")
+
+    def rotate(self):
+        # timings.jsonl -> timings.jsonl.1 -> ... -> timings.jsonl.N (le plus ancien est supprimé)
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def summary(self):
+        stages = [stage for stage in STAGE_LABELS if stage in self.samples]
+        stages += [stage for stage in self.samples if stage not in STAGE_LABELS]
+        return [(stage, len(self.samples[stage]), percentile(self.samples[stage], 50), percentile(self.samples[stage], 95))
+                for stage in stages]
+
+    def report_html(self):
+        if not self.request_count:
+            return "<i>Aucune demande mesurée pour l'instant.</i>"
+        rows = "".join(
+            f"<tr><td>{STAGE_LABELS.get(stage, stage)}</td><td align='right'>{count}</td>"
+            f"<td align='right'>{p50:.1f}</td><td align='right'>{p95:.1f}</td></tr>"
+            for stage, count, p50, p95 in self.summary()
+        )
+        return (f"<b>Durées par étape</b> ({self.request_count} demande(s), en ms)"
+                "<table cellspacing='0' cellpadding='3'>"
+                "<tr><th align='left'>Étape</th><th>n</th><th>p50</th><th>p95</th></tr>"
+                f"{rows}</table>")
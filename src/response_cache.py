@@ -0,0 +1,101 @@
+# src/response_cache.py
+# Owner TMCooper
+
+import time
+import sqlite3
+import hashlib
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def update_part(digest, part):
+    # Parties du prompt (texte, dict d'image) ou de l'historique (Part du SDK ou du backend REST)
+    if isinstance(part, str):
+        digest.update(b"\0text\0" + normalize_text(part).encode("utf-8"))
+    elif isinstance(part, dict) and 'data' in part:
+        digest.update(b"\0blob\0" + part.get('mime_type', '').encode("utf-8") + b"\0" + part['data'])
+    elif getattr(part, 'inline_data', None):
+        digest.update(b"\0blob\0" + part.inline_data.mime_type.encode("utf-8") + b"\0" + part.inline_data.data)
+    elif hasattr(part, 'text'):
+        digest.update(b"\0text\0" + normalize_text(part.text).encode("utf-8"))
+    else:
+        digest.update(b"\0other\0" + repr(part).encode("utf-8"))
+
+def prompt_hash(model_name, prompt_parts, history=()):
+    """ Empreinte du modèle, de l'historique envoyé avec la demande et des parties du prompt
+    (texte normalisé et octets des images) : la même question n'a pas la même réponse dans
+    deux conversations différentes. """
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for content in history:
+        role, parts = (content['role'], content['parts']) if isinstance(content, dict) else (content.role, content.parts)
+        digest.update(b"\0turn\0" + role.encode("utf-8"))
+        for part in parts:
+            update_part(digest, part)
+    for part in prompt_parts:
+        update_part(digest, part)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """ Cache SQLite des réponses, avec expiration (TTL) et taille maximale (éviction LRU). """
+    def __init__(self, path, ttl_seconds=24 * 3600, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+
+    def connect(self):
+        # Ouverte au premier usage, depuis le thread du worker qui est le seul à s'en servir
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, "
+                "created_at REAL, last_used REAL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def get(self, key):
+        connection = self.connect()
+        row = connection.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or now - row[1] > self.ttl_seconds:
+            if row is not None:
+                connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                connection.commit()
+            self.misses += 1
+            return None
+        connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        connection.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, model_name, response_text):
+        connection = self.connect()
+        now = time.time()
+        connection.execute(
+            "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model_name, response_text, len(response_text.encode("utf-8")), now, now)
+        )
+        self.evict(now)
+        connection.commit()
+
+    def evict(self, now):
+        connection = self.connect()
+        connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY last_used ASC").fetchall():
+            connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
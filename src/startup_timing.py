@@ -0,0 +1,53 @@
+# src/startup_timing.py
+# Owner TMCooper
+
+import sys
+import time
+from contextlib import contextmanager
+
+class StartupTimer:
+    """ Mesure les étapes du démarrage et le coût de chaque import lourd. """
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.marks = []
+        self.imports = []
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.origin) * 1000
+
+    def mark(self, label):
+        self.marks.append((label, self.elapsed_ms()))
+
+    def mark_ms(self, label):
+        for mark_label, ms in self.marks:
+            if mark_label == label:
+                return ms
+        return None
+
+    @contextmanager
+    def measure(self, module_name):
+        # Équivalent simplifié de -X importtime : durée cumulée et nombre de modules chargés
+        modules_before = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            self.imports.append((module_name, duration_ms, len(sys.modules) - modules_before))
+
+    def is_over_budget(self, label, budget_ms):
+        ms = self.mark_ms(label)
+        return ms is not None and ms > budget_ms
+
+    def report(self, budget_label=None, budget_ms=None):
+        lines = ["Temps de démarrage d'AIBar :"]
+        for label, ms in self.marks:
+            lines.append(f"  {ms:8.1f} ms  {label}")
+        if self.imports:
+            lines.append("Imports (cumulé | nouveaux modules) :")
+            for module_name, duration_ms, new_modules in sorted(self.imports, key=lambda item: -item[1]):
+                lines.append(f"  {duration_ms:8.1f} ms | {new_modules:5d}  {module_name}")
+        if budget_label is not None and (ms := self.mark_ms(budget_label)) is not None:
+            status = "DÉPASSÉ" if ms > budget_ms else "OK"
+            lines.append(f"Budget '{budget_label}' : {ms:.0f} / {budget_ms:.0f} ms ({status})")
+        return "\n".join(lines)
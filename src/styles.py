@@ -4,17 +4,10 @@
 
 STYLESHEET = """
 QWidget#main_widget { background-color: #2b2d31; border: 1px solid #1e1f22; border-radius: 18px; }
-QScrollArea { border: none; border-radius: 16px; background-color: #313338; }
-QWidget#scroll_content { background-color: #313338; }
-QTextBrowser { background-color: transparent; border: none; color: #dbdee1; font-size: 14px; }
-QWidget.bubble_widget { border-radius: 18px; }
-QWidget.bubble_widget[role="user"] { background-color: #404eed; }
-QWidget.bubble_widget[role="ai"] { background-color: #45475a; }
-QWidget#code_container { background-color: #1e1f22; border-radius: 8px; }
-QLabel#language_label { color: #8a9099; padding: 2px 8px; font-size: 12px; }
-QPushButton#copy_btn { background-color: #313338; color: #d0d0d0; border: none; border-radius: 5px; padding: 4px 8px; font-size: 12px; }
-QPushButton#copy_btn:hover { background-color: #45475a; }
+/* Les bulles et blocs de code du fil sont dessinés par src/chat_view.py (ChatDelegate) */
+QListView#chat_view { border: none; border-radius: 16px; background-color: #313338; padding: 6px; }
 QWidget#input_container { background-color: #404eed; border-radius: 12px; }
+QLabel#status_label { color: #8a9099; padding: 2px 8px 4px 8px; font-size: 12px; }
 QLineEdit { background-color: transparent; border: none; padding: 12px; font-size: 15px; color: #ffffff; }
 QLineEdit::placeholder-text { color: #bbbcff; }
 
@@ -27,6 +20,11 @@ QPushButton#add_file_btn {
 QPushButton#add_file_btn:hover {
     background-color: #6066ff;
 }
+QPushButton#stop_btn {
+    background-color: #2b2d31; color: #dbdee1; border: none;
+    border-radius: 17px; font-size: 14px;
+}
+QPushButton#stop_btn:hover { background-color: #c42b1c; color: white; }
 
 QWidget#file_preview { background-color: #2b2d31; border-radius: 8px; padding: 8px; }
 QLabel#file_name_label { color: #dbdee1; font-weight: bold; }
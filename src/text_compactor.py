@@ -0,0 +1,127 @@
+# src/text_compactor.py
+# Owner TMCooper
+
+import os
+import re
+import json
+
+from src.context_manager import estimate_text_tokens
+
+# Le code garde sa mise en forme : seuls les blancs de fin de ligne et les lignes vides en trop sont retirés
+CODE_EXTS = ['.py', '.js', '.html', '.css', '.c', '.cpp', '.h', '.sh', '.bat']
+# Commentaires d'une ligne entière, retirés seulement sur demande (AIBAR_COMPACT_STRIP_COMMENTS)
+LINE_COMMENTS = {'.py': ('#',), '.sh': ('#',), '.js': ('//',), '.c': ('//',), '.cpp': ('//',), '.h': ('//',),
+                 '.css': ('/*',), '.bat': ('rem ', '@rem ', '::')}
+# Lignes de log identiques, à l'horodatage près, regroupées à partir de 3 (fichiers .log seulement)
+MIN_REPEAT_RUN = 3
+# Listes et chaînes JSON raccourcies seulement sur demande (AIBAR_COMPACT_TRIM_JSON)
+JSON_MAX_ITEMS = 20
+JSON_KEEP_ITEMS = 10
+JSON_MAX_STRING = 500
+TIMESTAMP = re.compile(r"(?:\d{4}-\d{2}-\d{2}[T ])?\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?")
+INNER_SPACES = re.compile(r"(?<=\S)[ \t]{2,}")
+
+def collapse_repeated_lines(lines):
+    """ Garde la première et la dernière ligne de chaque suite de lignes qui ne diffèrent que par leur horodatage. """
+    result, collapsed = [], 0
+    start = 0
+    while start < len(lines):
+        shape = TIMESTAMP.sub("", lines[start])
+        end = start + 1
+        while end < len(lines) and TIMESTAMP.sub("", lines[end]) == shape:
+            end += 1
+        count = end - start
+        marker = f"[... même ligne répétée {count - 2} fois ...]"
+        if count >= MIN_REPEAT_RUN and shape.strip() and len(marker) < sum(len(line) for line in lines[start + 1:end - 1]):
+            result += [lines[start], marker, lines[end - 1]]
+            collapsed += count - 2
+        else:
+            result += lines[start:end]
+        start = end
+    return result, collapsed
+
+def normalize_whitespace(lines, inner=True):
+    # Blancs de fin de ligne, lignes vides successives et, hors code, alignements au milieu des lignes
+    result = []
+    for line in lines:
+        line = line.rstrip()
+        if inner:
+            line = INNER_SPACES.sub(" ", line)
+        if line or (result and result[-1]):
+            result.append(line)
+    return result
+
+def strip_comments(lines, ext):
+    markers = LINE_COMMENTS.get(ext, ())
+    result = []
+    for index, line in enumerate(lines):
+        stripped = line.lstrip().lower()
+        if not stripped or (stripped.startswith(markers) and not (index == 0 and stripped.startswith("#!"))):
+            continue
+        result.append(line)
+    return result
+
+def trim_json(value):
+    if isinstance(value, list):
+        items = [trim_json(item) for item in value[:JSON_KEEP_ITEMS if len(value) > JSON_MAX_ITEMS else len(value)]]
+        if len(value) > JSON_MAX_ITEMS:
+            items.append(f"... {len(value) - JSON_KEEP_ITEMS} élément(s) omis")
+        return items
+    if isinstance(value, dict):
+        return {key: trim_json(item) for key, item in value.items()}
+    if isinstance(value, str) and len(value) > JSON_MAX_STRING:
+        return value[:JSON_MAX_STRING] + f"… ({len(value)} caractères)"
+    return value
+
+def compact_json(text, trim=False):
+    """ JSON relu (longues listes et chaînes raccourcies si trim), puis indenté s'il reste plus court que
+    l'original, sinon écrit sans espaces. Retourne le texte et s'il a été raccourci, (None, False) si le
+    texte n'est pas du JSON complet. """
+    try:
+        value = json.loads(text)
+        trimmed = trim_json(value) if trim else value
+    except (ValueError, RecursionError):
+        return None, False
+    pretty = json.dumps(trimmed, ensure_ascii=False, indent=1)
+    if len(pretty) > len(text):
+        pretty = json.dumps(trimmed, ensure_ascii=False, separators=(",", ":"))
+    return pretty, trimmed != value
+
+def compact_text(text, name, strip=False, trim_json=False):
+    """ Réduit une pièce jointe texte avant l'envoi. Retourne le texte et un rapport :
+    {'name', 'original_tokens', 'tokens', 'steps', 'dropped'} ; dropped liste ce qui a été retiré du contenu
+    (et pas seulement de sa mise en forme). Le texte d'origine est gardé s'il n'y a rien à gagner. """
+    ext = os.path.splitext(name.lower())[1]
+    original_tokens = estimate_text_tokens(text)
+    steps, dropped = [], []
+    compacted, trimmed = compact_json(text, trim_json) if ext == '.json' else (None, False)
+    if compacted is not None:
+        steps.append("JSON réécrit")
+        if trimmed:
+            dropped.append("longues listes et chaînes JSON raccourcies")
+    else:
+        lines = text.splitlines()
+        if ext == '.log':
+            lines, collapsed = collapse_repeated_lines(lines)
+            if collapsed:
+                dropped.append(f"{collapsed} ligne(s) répétée(s) regroupée(s)")
+        if strip and ext in LINE_COMMENTS:
+            kept = len(lines)
+            lines = strip_comments(lines, ext)
+            if len(lines) < kept:
+                dropped.append(f"{kept - len(lines)} ligne(s) de commentaire ou vide(s) retirée(s)")
+        compacted = "\n".join(normalize_whitespace(lines, inner=ext not in CODE_EXTS and ext != '.md'))
+    tokens = estimate_text_tokens(compacted)
+    if tokens >= original_tokens:
+        return text, {'name': name, 'original_tokens': original_tokens, 'tokens': original_tokens, 'steps': [], 'dropped': []}
+    return compacted, {'name': name, 'original_tokens': original_tokens, 'tokens': tokens,
+                       'steps': steps + dropped, 'dropped': dropped}
+
+def compaction_summary(report):
+    saved = report['original_tokens'] - report['tokens']
+    summary = f"~{report['original_tokens']} -> ~{report['tokens']} tokens"
+    if saved and report['original_tokens']:
+        summary += f" (-{saved / report['original_tokens']:.0%})"
+    if report['steps']:
+        summary += ", " + ", ".join(report['steps'])
+    return summary
@@ -0,0 +1,136 @@
+# src/text_loader.py
+# Owner TMCooper
+
+import os
+import mmap
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+from src.text_compactor import compact_text
+
+READ_CHUNK_SIZE = 1024 * 1024
+# Séparation des scripts et des autres fichiers texte
+SCRIPT_EXTS = ['.bat', '.sh']
+TEXT_EXTS = ['.txt', '.py', '.js', '.html', '.css', '.json', '.md', '.log', '.c', '.cpp', '.h']
+BOMS = [
+    (b'\xef\xbb\xbf', 'utf-8'),
+    (b'\xff\xfe', 'utf-16-le'),
+    (b'\xfe\xff', 'utf-16-be'),
+]
+
+def decode_text(data, truncated=False):
+    """ Détecte l'encodage en une seule passe : BOM, puis UTF-8 strict, sinon latin-1.
+    truncated : extrait coupé par la fin, qui peut s'arrêter au milieu d'un caractère. """
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return data[len(bom):].decode(encoding, errors='replace'), encoding
+    try:
+        return data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError as e:
+        # Un caractère coupé en fin d'extrait n'est pas une vraie erreur d'encodage (pour un fichier
+        # complet, si : b"caf\xe9" est du latin-1)
+        if truncated and e.reason == "unexpected end of data":
+            return data[:e.start].decode('utf-8'), 'utf-8'
+        # Si l'UTF-8 échoue, on garde le latin, courant sur Windows
+        return data.decode('latin-1'), 'latin-1'
+
+def skip_partial_char(data):
+    # Un extrait de fin peut commencer au milieu d'un caractère UTF-8
+    start = 0
+    while start < min(3, len(data)) and 0x80 <= data[start] <= 0xBF:
+        start += 1
+    return data[start:]
+
+def format_size(size):
+    for unit in ("octets", "Ko", "Mo", "Go"):
+        if size < 1024 or unit == "Go":
+            return f"{size:.0f} {unit}" if unit == "octets" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def tail_lines_start(buffer, size, max_lines, max_bytes):
+    # Remonte depuis la fin jusqu'à max_lines retours à la ligne, sans dépasser max_bytes
+    limit = max(0, size - max_bytes)
+    position = size
+    if position and buffer[position - 1:position] == b'\n':
+        position -= 1
+    for _ in range(max_lines):
+        newline = buffer.rfind(b'\n', limit, position)
+        if newline == -1:
+            return limit
+        position = newline
+    return position + 1
+
+def load_text(path, max_bytes=512 * 1024, tail_lines=2000, progress=None):
+    """ Lit un fichier texte en respectant un plafond mémoire de max_bytes.
+    Les logs gardent leurs dernières lignes, les autres fichiers leur début et leur fin. """
+    size = os.path.getsize(path)
+    is_log = path.lower().endswith('.log')
+    with open(path, 'rb') as f:
+        if size <= max_bytes:
+            chunks = []
+            read = 0
+            while chunk := f.read(READ_CHUNK_SIZE):
+                chunks.append(chunk)
+                read += len(chunk)
+                if progress and size:
+                    progress(int(read * 100 / size))
+            return decode_text(b"".join(chunks))[0]
+
+        # Gros fichier : projeté en mémoire, seuls les extraits utiles sont copiés
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if is_log:
+                start = tail_lines_start(buffer, size, tail_lines, max_bytes)
+                if progress:
+                    progress(50)
+                tail, _ = decode_text(skip_partial_char(buffer[start:size]))
+                kept_lines = len(tail.splitlines())
+                header = (f"[Fichier de {format_size(size)} : seules les {kept_lines} dernières lignes "
+                          f"({format_size(size - start)}) sont incluses]\n")
+                return header + tail
+
+            head_size = max_bytes * 2 // 3
+            head_end = buffer.rfind(b'\n', 0, head_size) + 1 or head_size
+            tail_start = buffer.find(b'\n', size - (max_bytes - head_end)) + 1 or size - (max_bytes - head_end)
+            if progress:
+                progress(50)
+            head, _ = decode_text(buffer[:head_end], truncated=True)
+            tail, _ = decode_text(skip_partial_char(buffer[tail_start:size]))
+            omitted = tail_start - head_end
+            return f"{head}\n[... {format_size(omitted)} omis sur {format_size(size)} ...]\n{tail}"
+
+
+class TextJob(QRunnable):
+    def __init__(self, loader, file_info, path):
+        super().__init__()
+        self.loader = loader
+        self.file_info = file_info
+        self.path = path
+    def run(self):
+        try:
+            content = load_text(self.path, self.loader.max_bytes, self.loader.tail_lines,
+                                lambda percent: self.loader.progress.emit(self.file_info, percent))
+            if self.loader.compact:
+                content, self.file_info['compaction'] = compact_text(content, self.file_info['name'],
+                                                                     self.loader.strip_comments, self.loader.trim_json)
+            self.loader.text_ready.emit(self.file_info, content)
+        except Exception as e:
+            self.loader.text_failed.emit(self.file_info, str(e))
+
+
+class TextLoader(QObject):
+    """ Charge les fichiers texte joints en arrière-plan avec un plafond de taille, compactés avant l'envoi. """
+    text_ready = Signal(object, object)
+    text_failed = Signal(object, str)
+    progress = Signal(object, int)
+    def __init__(self, max_bytes=512 * 1024, tail_lines=2000, max_workers=2, compact=True, strip_comments=False,
+                 trim_json=False, parent=None):
+        super().__init__(parent)
+        self.max_bytes = max_bytes
+        self.tail_lines = tail_lines
+        self.compact = compact
+        self.strip_comments = strip_comments
+        self.trim_json = trim_json
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_workers)
+    def submit(self, file_info, path):
+        self.pool.start(TextJob(self, file_info, path))
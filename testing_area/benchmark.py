@@ -0,0 +1,353 @@
+# testing_area/benchmark.py
+# Owner TMCooper
+
+# Mesure le coût propre de la barre (hors API) avec un faux chat local :
+#   python testing_area/benchmark.py --turns 20 --latency-ms 300 --output bench.json
+# Tourne sans écran (plateforme Qt "offscreen") et écrit les résultats en JSON.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import contextlib
+import platform
+import tempfile
+import threading
+import statistics
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+# Aucun cache persistant : chaque lancement part du même état
+os.environ["AIBAR_DATA_DIR"] = tempfile.mkdtemp(prefix="aibar_bench_")
+os.environ["AIBAR_RESPONSE_CACHE"] = "0"
+os.environ["AIBAR_HIGHLIGHT_CACHE_PERSIST"] = "0"
+# Pas de limite de débit côté client : les tours s'enchaînent bien plus vite que 15 par minute
+os.environ["AIBAR_RATE_LIMIT_RPM"] = "0"
+
+import markdown
+import PySide6
+from PySide6.QtCore import QObject, QEvent, QEventLoop, QTimer, Signal
+from PySide6.QtGui import QTextDocument
+from PySide6.QtWidgets import QApplication
+
+from src.model_backend import ChatBackend, AsyncHttpBackend, to_content
+from src.local_backend import LocalGeminiServer
+
+CODE_LANGS = ["python", "javascript", "bash", "json", "cpp"]
+WORDS = ("la barre affiche une réponse markdown avec du texte des listes et parfois "
+         "du code le rendu doit rester fluide même quand la conversation grandit").split()
+
+
+def generate_response(rng, size_chars, code_density):
+    """ Réponse markdown d'environ size_chars caractères, code_density étant la part de blocs de code. """
+    blocks = []
+    total = 0
+    while total < size_chars:
+        if rng.random() < code_density:
+            lang = rng.choice(CODE_LANGS)
+            lines = [f"value_{i} = compute({i}, '{rng.choice(WORDS)}')" for i in range(rng.randint(4, 20))]
+            block = f"```{lang}\n" + "\n".join(lines) + "\n```"
+        elif rng.random() < 0.2:
+            block = "\n".join(f"- {' '.join(rng.choices(WORDS, k=6))}" for _ in range(rng.randint(2, 5)))
+        elif rng.random() < 0.2:
+            # Liste numérotée "aérée", fréquente dans les réponses des modèles
+            block = "\n\n".join(f"{i}. {' '.join(rng.choices(WORDS, k=8))}" for i in range(1, rng.randint(3, 6)))
+        else:
+            block = " ".join(rng.choices(WORDS, k=rng.randint(20, 60))).capitalize() + "."
+        blocks.append(block)
+        total += len(block) + 2
+    return "\n\n".join(blocks)
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChatSession(ChatBackend):
+    """ Backend en mémoire, sans réseau : latence et découpage réglables. """
+    def __init__(self, latency_ms=300, chunk_ms=20, chunk_chars=40, response_chars=2000, code_density=0.3, seed=0):
+        self.latency_ms = latency_ms
+        self.chunk_ms = chunk_ms
+        self.chunk_chars = chunk_chars
+        self.response_chars = response_chars
+        self.code_density = code_density
+        self.rng = random.Random(seed)
+        self._history = []
+        self.first_chunk_at = None
+
+    @property
+    def history(self):
+        return self._history
+
+    @history.setter
+    def history(self, value):
+        self._history = [to_content(content) for content in value]
+
+    def send_message(self, prompt_parts, stream=False):
+        response_text = generate_response(self.rng, self.response_chars, self.code_density)
+        time.sleep(self.latency_ms / 1000)
+        if not stream:
+            time.sleep(self.chunk_ms / 1000 * (len(response_text) // max(1, self.chunk_chars)))
+            self.first_chunk_at = time.perf_counter()
+            self.record_turn(prompt_parts, response_text)
+            return FakeChunk(response_text)
+        return self.stream_chunks(prompt_parts, response_text)
+
+    def stream_chunks(self, prompt_parts, response_text):
+        for start in range(0, len(response_text), self.chunk_chars):
+            if start:
+                time.sleep(self.chunk_ms / 1000)
+            else:
+                self.first_chunk_at = time.perf_counter()
+            yield FakeChunk(response_text[start:start + self.chunk_chars])
+        self.record_turn(prompt_parts, response_text)
+
+    def record_turn(self, prompt_parts, response_text):
+        self._history = self._history + [
+            to_content({'role': 'user', 'parts': prompt_parts}),
+            to_content({'role': 'model', 'parts': [response_text]}),
+        ]
+
+
+class HotkeyEmitter(QObject):
+    show_command_bar_signal = Signal()
+
+
+class PaintWatcher(QObject):
+    """ Note l'instant du premier événement Paint reçu par la barre. """
+    def __init__(self):
+        super().__init__()
+        self.painted_at = None
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint and self.painted_at is None:
+            self.painted_at = time.perf_counter()
+        return False
+
+
+def wait_until(app, predicate, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    # Réveille régulièrement la boucle pour ne pas rester bloqué dans WaitForMoreEvents
+    wake_timer = QTimer()
+    wake_timer.start(1)
+    try:
+        while not predicate():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("le benchmark n'a pas abouti dans le temps imparti")
+            app.processEvents(QEventLoop.ProcessEventsFlag.AllEvents | QEventLoop.ProcessEventsFlag.WaitForMoreEvents)
+    finally:
+        wake_timer.stop()
+
+
+def process_pending(app):
+    app.processEvents()
+    app.sendPostedEvents()
+    app.processEvents()
+
+
+def rss_mb():
+    # Mémoire résidente actuelle, lue dans /proc quand il existe (Linux)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def block_texts(document):
+    texts = []
+    block = document.begin()
+    while block.isValid():
+        if block.text().strip():
+            texts.append(block.text())
+        block = block.next()
+    return texts
+
+
+def check_render_fidelity(bar):
+    """ Réponses affichées bloc par bloc comparées au rendu complet du même markdown : nombre de différences. """
+    mismatches = 0
+    for message in bar.chat_view.chat_model.messages:
+        entry = bar.chat_view.chat_delegate.documents.get(message.id)
+        if message.role != 'ai' or message.kind != 'text' or not message.is_markdown or entry is None:
+            continue
+        reference = QTextDocument()
+        reference.setHtml(markdown.markdown(message.text))
+        if block_texts(entry[0]) != block_texts(reference):
+            mismatches += 1
+            print(f"Rendu différent du markdown complet : {message.text[:80]!r}", file=sys.stderr)
+    return mismatches
+
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'count': len(values),
+        'min': round(ordered[0], 3),
+        'p50': round(statistics.median(ordered), 3),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+def measure_show(app, bar_factory, watcher, state):
+    """ Du signal du raccourci (émis depuis un autre thread, comme keyboard) au premier Paint de la barre. """
+    emitter = HotkeyEmitter()
+    def show():
+        if state.get('bar') is None:
+            state['bar'] = bar_factory()
+            state['bar'].installEventFilter(watcher)
+        state['bar'].show_and_focus()
+    emitter.show_command_bar_signal.connect(show)
+    watcher.painted_at = None
+    started = time.perf_counter()
+    threading.Thread(target=emitter.show_command_bar_signal.emit).start()
+    wait_until(app, lambda: watcher.painted_at is not None)
+    return (watcher.painted_at - started) * 1000
+
+
+def run_turn(app, bar, chat_session, prompt, clock=None):
+    # clock : objet qui note first_chunk_at, le faux backend lui-même ou le serveur local
+    clock = clock or chat_session
+    clock.first_chunk_at = None
+    bar.last_ttft_ms = None
+    bar.input_field.setText(prompt)
+    submitted = time.perf_counter()
+    bar.process_input()
+    wait_until(app, lambda: bar.last_ttft_ms is not None)
+    first_paint = submitted + bar.last_ttft_ms / 1000
+    wait_until(app, lambda: not bar.is_processing and not bar.pending_requests and bar.stream_streamer is None)
+    process_pending(app)
+    finished = time.perf_counter()
+    overhead = (first_paint - clock.first_chunk_at) * 1000 if clock.first_chunk_at else None
+    return {
+        'input_to_first_paint_ms': bar.last_ttft_ms,
+        'first_paint_overhead_ms': overhead,
+        'turn_ms': (finished - submitted) * 1000,
+    }
+
+
+def measure_render(app, bar, rng, response_chars, code_density, repeats):
+    """ Temps de on_gemini_result seul (découpage + rendu), puis de la mise en page qui suit. """
+    results = []
+    for _ in range(repeats):
+        response_text = generate_response(rng, response_chars, code_density)
+        started = time.perf_counter()
+        bar.on_gemini_result(response_text, instant=True)
+        parsed = time.perf_counter()
+        process_pending(app)
+        results.append({'call_ms': (parsed - started) * 1000, 'with_layout_ms': (time.perf_counter() - started) * 1000})
+    return results
+
+
+def run(args):
+    app = QApplication.instance() or QApplication(sys.argv)
+    started = time.perf_counter()
+    from src.command_bar import CommandBar
+    import_ms = (time.perf_counter() - started) * 1000
+
+    server = None
+    if args.backend == "local":
+        # Tout le chemin réseau : client httpx async -> serveur HTTP local qui imite Gemini
+        rng = random.Random(args.seed)
+        server = LocalGeminiServer(latency_ms=args.latency_ms, chunk_ms=args.chunk_ms, chunk_chars=args.chunk_chars,
+                                   responder=lambda contents: generate_response(rng, args.response_chars, args.code_density))
+        server.start()
+        chat_session = AsyncHttpBackend("bench", "local", server.base_url, http2=False)
+    else:
+        chat_session = FakeChatSession(args.latency_ms, args.chunk_ms, args.chunk_chars,
+                                       args.response_chars, args.code_density, args.seed)
+    watcher = PaintWatcher()
+    state = {'bar': None}
+    rss_start = rss_mb()
+
+    show_cold_ms = measure_show(app, lambda: CommandBar(chat_session, streaming=args.stream), watcher, state)
+    bar = state['bar']
+    show_warm = []
+    for _ in range(args.show_repeats):
+        bar.hide()
+        process_pending(app)
+        show_warm.append(measure_show(app, None, watcher, state))
+
+    turns = []
+    for i in range(args.turns):
+        turns.append(run_turn(app, bar, chat_session, f"Question {i} : explique ce code", server))
+    process_pending(app)
+    rss_after_turns = rss_mb()
+    render_mismatches = check_render_fidelity(bar)
+
+    renders = measure_render(app, bar, random.Random(args.seed + 1), args.response_chars, args.code_density, args.render_repeats)
+    messages_in_view = bar.chat_view.chat_model.rowCount()
+    # Pas de app.exec() ici : on arrête le worker comme à la fermeture de l'application
+    bar.on_about_to_quit()
+    if server is not None:
+        server.stop()
+
+    return {
+        'benchmark': 'aibar',
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'environment': {
+            'python': platform.python_version(),
+            'pyside6': PySide6.__version__,
+            'platform': platform.platform(),
+            'qpa': os.environ.get("QT_QPA_PLATFORM"),
+        },
+        'config': vars(args),
+        'results': {
+            'import_command_bar_ms': round(import_ms, 3),
+            'hotkey_to_visible_cold_ms': round(show_cold_ms, 3),
+            'hotkey_to_visible_warm_ms': summarize(show_warm),
+            'input_to_first_paint_ms': summarize([t['input_to_first_paint_ms'] for t in turns]),
+            'first_paint_overhead_ms': summarize([t['first_paint_overhead_ms'] for t in turns]),
+            'turn_ms': summarize([t['turn_ms'] for t in turns]),
+            'on_gemini_result_ms': summarize([r['call_ms'] for r in renders]),
+            'on_gemini_result_with_layout_ms': summarize([r['with_layout_ms'] for r in renders]),
+            'rss_start_mb': rss_start,
+            'rss_after_turns_mb': rss_after_turns,
+            'messages_in_view': messages_in_view,
+            'render_mismatches': render_mismatches,
+            'history_turns': len(chat_session.history) // 2,
+        },
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de la barre AIBar avec un faux backend local.")
+    parser.add_argument("--backend", choices=["fake", "local"], default="fake",
+                        help="fake : backend en mémoire, local : client HTTP async et serveur local")
+    parser.add_argument("--turns", type=int, default=10, help="nombre d'échanges simulés")
+    parser.add_argument("--latency-ms", type=float, default=300, help="délai avant le premier morceau de réponse")
+    parser.add_argument("--chunk-ms", type=float, default=20, help="délai entre deux morceaux")
+    parser.add_argument("--chunk-chars", type=int, default=40, help="taille d'un morceau en caractères")
+    parser.add_argument("--response-chars", type=int, default=2000, help="taille d'une réponse en caractères")
+    parser.add_argument("--code-density", type=float, default=0.3, help="part des blocs de code dans une réponse (0 à 1)")
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="réponse complète au lieu du streaming")
+    parser.add_argument("--show-repeats", type=int, default=5, help="affichages à chaud mesurés")
+    parser.add_argument("--render-repeats", type=int, default=5, help="appels mesurés de on_gemini_result")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="fichier JSON de sortie (sinon la sortie standard)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Les print de l'application vont sur stderr pour garder une sortie JSON exploitable
+    with contextlib.redirect_stdout(sys.stderr):
+        results = json.dumps(run(args), indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == "__main__":
+    main()